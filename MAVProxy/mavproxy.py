@@ -18,6 +18,10 @@ from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import dumpstacks
+from MAVProxy.modules.lib import mp_eventloop
+from MAVProxy.modules.lib import mp_scheduler
+from MAVProxy.modules.lib import mp_profile
+from MAVProxy.modules.lib import mp_logwriter
 
 # adding all this allows pyinstaller to build a working windows executable
 # note that using --hidden-import does not work for these modules
@@ -65,6 +69,7 @@ class MPStatus(object):
         self.last_streamrate2 = -1
         self.last_seq = 0
         self.armed = False
+        self.logwriter = None
 
     def show(self, f, pattern=None):
         '''write status to status.txt'''
@@ -75,6 +80,8 @@ class MPStatus(object):
             f.write('\n')
             f.write('MAV Errors: %u\n' % self.mav_error)
             f.write(str(self.gps)+'\n')
+            if self.logwriter is not None:
+                self.logwriter.show(f)
         for m in sorted(self.msgs.keys()):
             if pattern is not None and not fnmatch.fnmatch(str(m).upper(), pattern.upper()):
                 continue
@@ -127,6 +134,8 @@ class MPState(object):
               MPSetting('heartbeat', int, 1, 'Heartbeat rate', range=(0,5), increment=1),
               MPSetting('mavfwd', bool, True, 'Allow forwarded control'),
               MPSetting('mavfwd_rate', bool, False, 'Allow forwarded rate control'),
+              MPSetting('fastfwd', bool, False, 'Forward raw frames to outputs in batches'),
+              MPSetting('lazydecode', bool, False, 'Only decode messages when fields are used'),
               MPSetting('shownoise', bool, True, 'Show non-MAVLink data'),
               MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0,10000000), increment=1),
               MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
@@ -139,6 +148,9 @@ class MPState(object):
               MPSetting('moddebug', int, opts.moddebug, 'Module Debug Level', range=(0,3), increment=1, tab='Debug'),
               MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0,3), tab='Debug'),
               MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+              MPSetting('logfsync', float, 0, 'Log fsync period (0 to disable)', range=(0,3600)),
+              MPSetting('logoverflow', str, 'drop', 'Log overflow policy', choice=mp_logwriter.OVERFLOW_POLICIES),
+              MPSetting('tlogindex', bool, False, 'Write a seek index alongside the tlog'),
               MPSetting('requireexit', bool, False, 'Require exit command'),
               MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
 
@@ -160,7 +172,11 @@ class MPState(object):
             "script"         : ["(FILENAME)"],
             "set"            : ["(SETTING)"],
             "status"         : ["(VARIABLE)"],
+            "loopstats"      : ["<timers>"],
+            "profile"        : ["<start|stop|reset|show>",
+                                "save (FILENAME)"],
             "module"    : ["list",
+                           "stats",
                            "load (AVAILMODULES)",
                            "<unload|reload> (LOADEDMODULES)"]
             }
@@ -181,7 +197,17 @@ class MPState(object):
         self.modules = []
         self.public_modules = {}
         self.functions = MAVFunctions()
-        self.select_extra = {}
+        # registry of file descriptors for the main loop
+        self.event_loop = mp_eventloop.MPEventLoop()
+        self.select_extra = mp_eventloop.SelectExtraDict(self.event_loop)
+        self.tlog_index = None
+        # timers for modules, and modules still using a legacy idle_task
+        self.scheduler = mp_scheduler.MPScheduler()
+        self.idle_modules = []
+        # handler and main loop profiling, see the profile command
+        self.profiler = mp_profile.MPProfiler()
+        # bumped when modules are loaded, unloaded or change subscriptions
+        self.module_generation = 0
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -208,6 +234,57 @@ class MPState(object):
                 return m
         return self.mav_master[self.settings.link-1]
 
+    def register_master(self, master):
+        '''add a master link to the main loop'''
+        self.unregister_master(master)
+        if master.fd is None or master.portdead:
+            return
+        master.evloop_fd = master.fd
+        master.evloop_port = getattr(master, 'port', None)
+        self.event_loop.register(master.fd, process_master, master)
+
+    def unregister_master(self, master):
+        '''remove a master link from the main loop'''
+        fd = getattr(master, 'evloop_fd', None)
+        if fd is not None:
+            self.event_loop.unregister(fd, master)
+        master.evloop_fd = None
+        master.evloop_port = None
+
+    def master_needs_register(self, master):
+        '''return True if a master link has reconnected, gone dead or hung
+        up since it was registered. A reconnected socket may have the
+        same fd number as the old one, so the port object is compared'''
+        if master.fd is None or master.portdead:
+            return getattr(master, 'evloop_fd', None) is not None
+        return (getattr(master, 'port', None) is not getattr(master, 'evloop_port', None) or
+                not self.event_loop.is_registered(master.evloop_fd, master))
+
+    def register_output(self, output):
+        '''add an output (or sysid output) to the main loop'''
+        self.unregister_output(output)
+        if output.fd is None:
+            return
+        output.evloop_fd = output.fd
+        output.evloop_port = getattr(output, 'port', None)
+        self.event_loop.register(output.fd, process_mavlink, output)
+
+    def unregister_output(self, output):
+        '''remove an output from the main loop'''
+        fd = getattr(output, 'evloop_fd', None)
+        if fd is not None:
+            self.event_loop.unregister(fd, output)
+        output.evloop_fd = None
+        output.evloop_port = None
+
+    def output_needs_register(self, output):
+        '''return True if an output has reopened or hung up since it was
+        registered'''
+        if output.fd is None:
+            return getattr(output, 'evloop_fd', None) is not None
+        return (getattr(output, 'port', None) is not getattr(output, 'evloop_port', None) or
+                not self.event_loop.is_registered(output.evloop_fd, output))
+
 
 def get_mav_param(param, default=None):
     '''return a EEPROM parameter value'''
@@ -255,6 +332,21 @@ def cmd_watch(args):
     mpstate.status.watch = args[0]
     print("Watching %s" % mpstate.status.watch)
 
+def cmd_loopstats(args):
+    '''show main loop statistics'''
+    loop = mpstate.event_loop
+    (irate, wrate) = loop.stats()
+    print("backend=%s fds=%u iterations=%.1f/s wakeups=%.1f/s (total %u iterations %u wakeups %u events)" % (
+        loop.backend, len(loop), irate, wrate,
+        loop.iterations, loop.wakeups, loop.events))
+    timers = mpstate.scheduler.timers()
+    print("%u timers (%u calls), %u modules with idle_task: %s" % (
+        len(timers), mpstate.scheduler.calls, len(mpstate.idle_modules),
+        ' '.join([m.name for m in mpstate.idle_modules])))
+    if len(args) > 0 and args[0] == 'timers':
+        for t in timers:
+            print("  %s" % t)
+
 def load_module(modname, quiet=False):
     '''load a module'''
     modpaths = ['MAVProxy.modules.mavproxy_%s' % modname, modname]
@@ -270,6 +362,9 @@ def load_module(modname, quiet=False):
             module = m.init(mpstate)
             if isinstance(module, mp_module.MPModule):
                 mpstate.modules.append((module, m))
+                if module.has_idle_task():
+                    mpstate.idle_modules.append(module)
+                mpstate.module_generation += 1
                 if not quiet:
                     print("Loaded module %s" % (modname,))
                 return True
@@ -291,6 +386,10 @@ def unload_module(modname):
             if hasattr(m, 'unload'):
                 m.unload()
             mpstate.modules.remove((m,pm))
+            if m in mpstate.idle_modules:
+                mpstate.idle_modules.remove(m)
+            mpstate.scheduler.cancel_owner(m)
+            mpstate.module_generation += 1
             print("Unloaded module %s" % modname)
             return True
     print("Unable to find module %s" % modname)
@@ -298,13 +397,15 @@ def unload_module(modname):
 
 def cmd_module(args):
     '''module commands'''
-    usage = "usage: module <list|load|reload|unload>"
+    usage = "usage: module <list|load|reload|unload|stats>"
     if len(args) < 1:
         print(usage)
         return
     if args[0] == "list":
         for (m,pm) in mpstate.modules:
             print("%s: %s" % (m.name, m.description))
+    elif args[0] == "stats":
+        cmd_module_stats(args[1:])
     elif args[0] == "load":
         if len(args) < 2:
             print("usage: module load <name>")
@@ -341,6 +442,53 @@ def cmd_module(args):
         print(usage)
 
 
+def cmd_module_stats(args):
+    '''show per-module mavlink_packet statistics'''
+    if len(args) > 0 and args[0] == "reset":
+        for (m,pm) in mpstate.modules:
+            m.packet_calls = 0
+            m.packet_time = 0.0
+        return
+    print("%-20s %10s %10s %10s  %s" % ("Module", "Calls", "Time(s)", "Mean(us)", "Types"))
+    mods = [m for (m,pm) in mpstate.modules if m.has_mavlink_packet()]
+    mods.sort(key=lambda m: m.packet_time, reverse=True)
+    for m in mods:
+        if m.packet_calls > 0:
+            mean = 1.0e6 * m.packet_time / m.packet_calls
+        else:
+            mean = 0
+        if m.message_types is None:
+            types = '*'
+        else:
+            types = ' '.join(sorted(m.message_types))
+        print("%-20s %10u %10.3f %10.1f  %s" % (m.name, m.packet_calls, m.packet_time, mean, types))
+
+def cmd_profile(args):
+    '''control handler profiling'''
+    usage = "usage: profile <start|stop|reset|show|save FILENAME>"
+    profiler = mpstate.profiler
+    if len(args) < 1 or args[0] == "show":
+        category = None
+        if len(args) > 1:
+            category = args[1]
+        profiler.show(sys.stdout, category=category)
+    elif args[0] == "start":
+        profiler.start()
+        print("Profiling started")
+    elif args[0] == "stop":
+        profiler.stop()
+        print("Profiling stopped")
+    elif args[0] == "reset":
+        profiler.reset()
+    elif args[0] == "save":
+        if len(args) < 2:
+            print(usage)
+            return
+        profiler.save(args[1])
+        print("Saved profile to %s" % args[1])
+    else:
+        print(usage)
+
 def cmd_alias(args):
     '''alias commands'''
     usage = "usage: alias <add|remove|list>"
@@ -411,7 +559,9 @@ command_map = {
     'set'     : (cmd_set,      'mavproxy settings'),
     'watch'   : (cmd_watch,    'watch a MAVLink pattern'),
     'module'  : (cmd_module,   'module commands'),
-    'alias'   : (cmd_alias,    'command aliases')
+    'alias'   : (cmd_alias,    'command aliases'),
+    'loopstats' : (cmd_loopstats, 'show main loop statistics'),
+    'profile' : (cmd_profile,  'module and main loop profiling')
     }
 
 def process_stdin(line):
@@ -472,12 +622,19 @@ def process_stdin(line):
         print("Unknown command '%s'" % line)
         return
     (fn, help) = command_map[cmd]
+    profiler = mpstate.profiler
+    # the command may start or stop the profiler
+    profiling = profiler.enabled
+    if profiling:
+        t0 = time.time()
     try:
         fn(args[1:])
     except Exception as e:
         print("ERROR in command %s: %s" % (args[1:], str(e)))
         if mpstate.settings.moddebug > 1:
             traceback.print_exc()
+    if profiling:
+        profiler.record('command', cmd, time.time() - t0)
 
 
 def process_master(m):
@@ -509,7 +666,24 @@ def process_master(m):
 
     if m.first_byte and opts.auto_protocol:
         m.auto_mavlink_version(s)
-    msgs = m.mav.parse_buffer(s)
+
+    if mpstate.settings.lazydecode:
+        parse = mpstate.module('link').lazy_parse
+        args = (m, s)
+    else:
+        if mpstate.settings.fastfwd and mpstate.mav_outputs:
+            # forward the raw frames before decoding
+            mpstate.module('link').forward_raw(m, s)
+        parse = m.mav.parse_buffer
+        args = (s,)
+
+    # note that parsing includes the master_callback for each message
+    if mpstate.profiler.enabled:
+        t0 = time.time()
+        msgs = parse(*args)
+        mpstate.profiler.record('stage', 'process_master', time.time() - t0)
+    else:
+        msgs = parse(*args)
     if msgs:
         for msg in msgs:
             sysid = msg.get_srcSystem()
@@ -561,18 +735,6 @@ def mkdir_p(dir):
     mkdir_p(os.path.dirname(dir))
     os.mkdir(dir)
 
-def log_writer():
-    '''log writing thread'''
-    while True:
-        mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue_raw.empty():
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty():
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
-
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
 def log_paths():
@@ -619,17 +781,17 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'a'
     else:
         mode = 'w'
-    mpstate.logfile = open(logpath_telem, mode=mode)
-    mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+    # the log writer does its own batching, so the files are unbuffered
+    mpstate.logfile = open(logpath_telem, mode, 0)
+    mpstate.logfile_raw = open(logpath_telem_raw, mode, 0)
     print("Log Directory: %s" % mpstate.status.logdir)
     print("Telemetry log: %s" % logpath_telem)
 
     # use a separate thread for writing to the logfile to prevent
     # delays during disk writes (important as delays can be long if camera
     # app is running)
-    t = threading.Thread(target=log_writer, name='log_writer')
-    t.daemon = True
-    t.start()
+    mpstate.logwriter.open(mpstate.logqueue, mpstate.logfile)
+    mpstate.logwriter.open(mpstate.logqueue_raw, mpstate.logfile_raw)
 
 def set_stream_rates():
     '''set mavlink stream rates'''
@@ -690,23 +852,41 @@ def periodic_tasks():
 
     set_stream_rates()
 
-    # call optional module idle tasks. These are called at several hundred Hz
-    for (m,pm) in mpstate.modules:
-        if hasattr(m, 'idle_task'):
-            try:
-                m.idle_task()
-            except Exception as msg:
-                if mpstate.settings.moddebug == 1:
-                    print(msg)
-                elif mpstate.settings.moddebug > 1:
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                              limit=2, file=sys.stdout)
-
-        # also see if the module should be unloaded:
+    # call legacy module idle tasks. These are called at several hundred Hz,
+    # so only modules that override idle_task are in this list
+    profiler = mpstate.profiler
+    for m in mpstate.idle_modules:
+        profiling = profiler.enabled
+        if profiling:
+            t0 = time.time()
+        try:
+            m.idle_task()
+        except Exception as msg:
+            module_exception(msg)
+        if profiling:
+            profiler.record('idle_task', m.name, time.time() - t0)
+
+    # call module timers that are due
+    mpstate.scheduler.run(error_fn=timer_exception, profiler=profiler)
+
+    # also see if any modules should be unloaded:
+    for (m,pm) in mpstate.modules[:]:
         if m.needs_unloading:
             unload_module(m.name)
 
+def module_exception(msg):
+    '''report an exception from a module callback'''
+    if mpstate.settings.moddebug == 1:
+        print(msg)
+    elif mpstate.settings.moddebug > 1:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                  limit=2, file=sys.stdout)
+
+def timer_exception(timer, msg):
+    '''report an exception from a module timer'''
+    module_exception(msg)
+
 def main_loop():
     '''main processing loop'''
     if not mpstate.status.setup_mode and not opts.nowait:
@@ -736,65 +916,40 @@ def main_loop():
 
         periodic_tasks()
 
-        rin = []
+        # links can reconnect, hang up or go dead
         for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
+            if mpstate.master_needs_register(master):
+                mpstate.register_master(master)
+
+        # as can outputs, eg. tcp outputs reconnecting
+        for output in mpstate.mav_outputs + mpstate.sysid_outputs.values():
+            if mpstate.output_needs_register(output):
+                mpstate.register_output(output)
+
+        if len(mpstate.event_loop) == 0:
             time.sleep(0.0001)
             continue
 
-        for fd in mpstate.select_extra:
-            rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
+        # links, outputs, sysid outputs and modules using select_extra
+        # are all registered with the event loop, which calls their
+        # handler directly for each ready fd
+        timeout = mpstate.settings.select_timeout
+        deadline = mpstate.scheduler.next_deadline()
+        if deadline is not None:
+            timeout = max(0, min(timeout, deadline - time.time()))
+        mpstate.event_loop.poll(timeout, error_fn=select_extra_error, exit_fn=main_loop_exiting)
 
         if mpstate is None:
             return
 
-        for fd in rin:
-            if mpstate is None:
-                  return
-            for master in mpstate.mav_master:
-                  if fd == master.fd:
-                        process_master(master)
-                        if mpstate is None:
-                              return
-                        continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+def main_loop_exiting():
+    '''return True if the main loop should stop'''
+    return mpstate is None or mpstate.status.exit
+
+def select_extra_error(msg):
+    '''called when a select_extra read function raises an exception'''
+    if mpstate.settings.moddebug == 1:
+        print(msg)
 
 
 
@@ -912,9 +1067,11 @@ if __name__ == '__main__':
     mpstate.status.exit = False
     mpstate.command_map = command_map
     mpstate.continue_mode = opts.continue_mode
-    # queues for logging
-    mpstate.logqueue = Queue.Queue()
-    mpstate.logqueue_raw = Queue.Queue()
+    # bounded ring buffers for logging
+    mpstate.logwriter = mp_logwriter.MPLogWriter(mpstate.settings)
+    mpstate.logqueue = mpstate.logwriter.add_ring('tlog')
+    mpstate.logqueue_raw = mpstate.logwriter.add_ring('raw')
+    mpstate.status.logwriter = mpstate.logwriter
 
 
     if opts.speech:
@@ -977,7 +1134,9 @@ if __name__ == '__main__':
 
     # open any mavlink output ports
     for port in opts.output:
-        mpstate.mav_outputs.append(mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False))
+        conn = mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False)
+        mpstate.mav_outputs.append(conn)
+        mpstate.register_output(conn)
 
     if opts.sitl:
         mpstate.sitl_output = mavutil.mavudp(opts.sitl, input=False)
@@ -1088,5 +1247,7 @@ if __name__ == '__main__':
         if hasattr(m, 'unload'):
             print("Unloading module %s" % m.name)
             m.unload()
-        
+
+    # write out anything still in the log buffers
+    mpstate.logwriter.close()
     sys.exit(1)
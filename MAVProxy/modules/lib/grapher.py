@@ -10,7 +10,9 @@ import matplotlib
 from math import *
 from pymavlink.mavextra import *
 import pylab
+import numpy
 from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_vecexpr
 
 colors = [ 'red', 'green', 'blue', 'orange', 'olive', 'black', 'grey', 'yellow', 'brown', 'darkcyan',
            'cornflowerblue', 'darkmagenta', 'deeppink', 'darkred']
@@ -44,6 +46,24 @@ colourmap = {
 
 edge_colour = (0.1, 0.1, 0.1)
 
+# matplotlib date number of the unix epoch
+epoch_days = matplotlib.dates.date2num(datetime.datetime(1970, 1, 1))
+
+def utc_offset(t):
+    '''seconds local time is ahead of UTC at unix time t'''
+    d = datetime.datetime.fromtimestamp(t) - datetime.datetime.utcfromtimestamp(t)
+    return d.days*86400 + d.seconds
+
+def timestamps_to_days(t):
+    '''vectorised date2num(datetime.fromtimestamp(t)) for an array of times'''
+    if len(t) == 0:
+        return t
+    ofs = utc_offset(t[0])
+    if utc_offset(t[-1]) != ofs:
+        # crosses a daylight saving change
+        return numpy.array([matplotlib.dates.date2num(datetime.datetime.fromtimestamp(x)) for x in t])
+    return epoch_days + (t + ofs) / 86400.0
+
 class MavGraph(object):
     def __init__(self):
         self.lowest_x = None
@@ -228,13 +248,7 @@ class MavGraph(object):
         for i in range(0, len(self.fields)):
             if mtype not in self.field_types[i]:
                 continue
-            f = self.fields[i]
-            if f.endswith(":2"):
-                self.axes[i] = 2
-                f = f[:-2]
-            if f.endswith(":1"):
-                self.first_only[i] = True
-                f = f[:-2]
+            f = self.field_exprs[i]
             v = mavutil.evaluate_expression(f, vars)
             if v is None:
                 continue
@@ -250,6 +264,18 @@ class MavGraph(object):
 
     def process_mav(self, mlog, timeshift):
         '''process one file'''
+        if hasattr(mlog, 'positions'):
+            # an in-memory log, try evaluating with numpy
+            nmodes = len(self.modes)
+            try:
+                self.process_mav_vectorized(mlog, timeshift)
+                return
+            except mp_vecexpr.VecError:
+                for i in range(len(self.x)):
+                    self.x[i] = []
+                    self.y[i] = []
+                self.modes = self.modes[:nmodes]
+                mlog.rewind()
         self.vars = {}
         while True:
             msg = mlog.recv_msg()
@@ -263,6 +289,55 @@ class MavGraph(object):
             tdays = matplotlib.dates.date2num(datetime.datetime.fromtimestamp(msg._timestamp+timeshift))
             self.add_data(tdays, msg, mlog.messages, mlog.flightmode)
 
+    def process_mav_vectorized(self, mlog, timeshift):
+        '''process one in-memory log, evaluating each field over whole
+        columns. Raises VecError if an expression can't be vectorised'''
+        exprs = [mp_vecexpr.VecExpression(f) for f in self.field_exprs]
+        condition = None
+        if self.condition:
+            condition = mp_vecexpr.VecExpression(self.condition)
+            exprs.append(condition)
+        xaxis = None
+        if self.xaxis is not None:
+            xaxis = mp_vecexpr.VecExpression(self.xaxis)
+            exprs.append(xaxis)
+        for e in exprs:
+            if not e.vectorizable():
+                raise mp_vecexpr.VecError(e.expression)
+
+        all_positions = []
+        for i in range(0, len(self.fields)):
+            # sample at every message of the types in the field
+            positions = [mlog.positions(t) for t in self.field_types[i]]
+            positions = [p for p in positions if p is not None]
+            if len(positions) == 0:
+                continue
+            positions = numpy.unique(numpy.concatenate(positions))
+            all_positions.append(positions)
+            (y, valid) = exprs[i].evaluate(mlog, positions)
+            if condition is not None:
+                valid &= condition.evaluate_condition(mlog, positions)
+            if xaxis is None:
+                x = timestamps_to_days(mlog.timestamps()[positions] + timeshift)
+            else:
+                (x, xvalid) = xaxis.evaluate(mlog, positions)
+                valid &= xvalid
+            self.x[i] = x[valid]
+            self.y[i] = y[valid]
+
+        if self.flightmode is not None and all_positions:
+            positions = numpy.unique(numpy.concatenate(all_positions))
+            times = mlog.timestamps()[positions]
+            modes = mlog.flightmode_list()
+            starts = numpy.array([m[1] for m in modes], dtype=float)
+            idx = numpy.searchsorted(starts, times, side='right') - 1
+            changes = numpy.nonzero(numpy.diff(idx))[0] + 1
+            tdays = timestamps_to_days(times + timeshift)
+            for c in [0] + list(changes):
+                mode = modes[idx[c]][0] if idx[c] >= 0 else None
+                if len(self.modes) == 0 or self.modes[-1][1] != mode:
+                    self.modes.append((tdays[c], mode))
+
     def process(self, block=True):
         '''process and display graph'''
         self.msg_types = set()
@@ -275,6 +350,7 @@ class MavGraph(object):
         self.modes = []
         self.axes = []
         self.first_only = []
+        self.field_exprs = []
         re_caps = re.compile('[A-Z_][A-Z0-9_]+')
         for f in self.fields:
             caps = set(re.findall(re_caps, f))
@@ -282,8 +358,18 @@ class MavGraph(object):
             self.field_types.append(caps)
             self.y.append([])
             self.x.append([])
-            self.axes.append(1)
-            self.first_only.append(False)
+            # strip the axis and first-file-only suffixes once
+            axis = 1
+            first_only = False
+            if f.endswith(":2"):
+                axis = 2
+                f = f[:-2]
+            if f.endswith(":1"):
+                first_only = True
+                f = f[:-2]
+            self.axes.append(axis)
+            self.first_only.append(first_only)
+            self.field_exprs.append(f)
 
         if self.labels is not None:
             labels = self.labels.split(',')
@@ -1,20 +1,152 @@
 '''in-memory mavlink log'''
 
+import array
+import numpy
 from pymavlink import mavutil
 
+# rows of each message type are converted to arrays in chunks of this
+# size while loading, to bound the memory used by python objects
+CHUNK_ROWS = 4096
+
+class mavmemlog_message(object):
+    '''a row of a mavmemlog message type, which looks like a pymavlink
+    message to code using the iterator interface'''
+    def __init__(self, mtype, data, row, fieldnames):
+        self._type = mtype
+        self._data = data
+        self._row = row
+        self._fieldnames = fieldnames
+        self._timestamp = float(data['_timestamp'][row])
+
+    def get_type(self):
+        return self._type
+
+    def get_fieldnames(self):
+        return self._fieldnames
+
+    def __getattr__(self, name):
+        # only called for attributes not set on the object
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            v = self._data[name][self._row]
+        except (ValueError, KeyError, IndexError):
+            raise AttributeError(name)
+        if hasattr(v, 'tolist'):
+            # give back python values, not numpy scalars
+            v = v.tolist()
+        return v
+
+    def to_dict(self):
+        d = {'mavpackettype' : self._type}
+        for f in self._fieldnames:
+            d[f] = getattr(self, f)
+        return d
+
+    def __str__(self):
+        ret = '%s {' % self._type
+        for f in self._fieldnames:
+            ret += '%s : %s, ' % (f, getattr(self, f))
+        if self._fieldnames:
+            ret = ret[:-2]
+        return ret + '}'
+
+class mavmemlog_type(object):
+    '''column store for one message type while loading'''
+    def __init__(self, name, fieldnames):
+        self.name = name
+        self.fieldnames = fieldnames
+        self.rows = []
+        self.chunks = []
+        self.count = 0
+
+    def add(self, m):
+        '''add a message, returning its row number'''
+        row = [m._timestamp]
+        for f in self.fieldnames:
+            row.append(getattr(m, f, None))
+        self.rows.append(row)
+        if len(self.rows) >= CHUNK_ROWS:
+            self.flush()
+        self.count += 1
+        return self.count - 1
+
+    def flush(self):
+        '''convert pending rows to a column chunk'''
+        if not self.rows:
+            return
+        columns = zip(*self.rows)
+        self.rows = []
+        chunk = []
+        for c in columns:
+            try:
+                a = numpy.array(c)
+            except ValueError:
+                a = None
+            if a is None or a.dtype.kind not in 'biufS':
+                # arrays of mixed size or missing values
+                a = numpy.empty(len(c), dtype=object)
+                for i in range(len(c)):
+                    a[i] = c[i]
+            chunk.append(a)
+        self.chunks.append(chunk)
+
+    def finish(self):
+        '''return a structured array of all rows'''
+        self.flush()
+        names = ['_timestamp'] + self.fieldnames
+        columns = []
+        for i in range(len(names)):
+            parts = [chunk[i] for chunk in self.chunks]
+            kinds = set([p.dtype.kind for p in parts])
+            shapes = set([p.shape[1:] for p in parts])
+            if len(shapes) > 1 or 'O' in kinds or ('S' in kinds and len(kinds) > 1):
+                parts = [p.astype(object) if len(p.shape) == 1 else object_column(p) for p in parts]
+            columns.append(numpy.concatenate(parts))
+        self.chunks = []
+        data = numpy.empty(len(columns[0]), dtype=[(names[i], columns[i].dtype, columns[i].shape[1:])
+                                                   for i in range(len(names))])
+        for i in range(len(names)):
+            data[names[i]] = columns[i]
+        return data
+
+def object_column(a):
+    '''convert a 2D array to a 1D object array of lists'''
+    ret = numpy.empty(len(a), dtype=object)
+    for i in range(len(a)):
+        ret[i] = list(a[i])
+    return ret
+
+def message_fieldnames(m):
+    fieldnames = getattr(m, '_fieldnames', None)
+    if fieldnames is None:
+        fieldnames = m.get_fieldnames()
+    return list(fieldnames)
+
 class mavmemlog(mavutil.mavfile):
     '''a MAVLink log in memory. This allows loading a log into
-    memory to make it easier to do multiple sweeps over a log'''
+    memory to make it easier to do multiple sweeps over a log.
+
+    Each message type is held as a numpy structured array with a
+    _timestamp column plus one column per field. The record order of the
+    log is kept as arrays of type number and row, so recv_msg() can still
+    step through the log in order. New code should use array() and
+    column() instead'''
     def __init__(self, mav, progress_callback=None):
         mavutil.mavfile.__init__(self, None, 'memlog')
-        self._msgs = []
         self._count = 0
         self.rewind()
         self._flightmodes = []
         last_flightmode = None
         last_timestamp = None
         last_pct = 0
-        
+
+        loaders = {}
+        type_numbers = {}
+        # record order of the log
+        order_type = array.array('h')
+        order_row = array.array('i')
+        timestamps = array.array('d')
         while True:
             m = mav.recv_msg()
             if m is None:
@@ -22,7 +154,15 @@ class mavmemlog(mavutil.mavfile):
             if int(mav.percent) != last_pct and progress_callback:
                 progress_callback(int(mav.percent))
                 last_pct = int(mav.percent)
-            self._msgs.append(m)
+            mtype = m.get_type()
+            loader = loaders.get(mtype, None)
+            if loader is None:
+                loader = mavmemlog_type(mtype, message_fieldnames(m))
+                loaders[mtype] = loader
+                type_numbers[mtype] = len(type_numbers)
+            order_type.append(type_numbers[mtype])
+            order_row.append(loader.add(m))
+            timestamps.append(m._timestamp)
             if mav.flightmode != last_flightmode:
                 if len(self._flightmodes) > 0:
                     (mode, t1, t2) = self._flightmodes[-1]
@@ -35,17 +175,32 @@ class mavmemlog(mavutil.mavfile):
         if last_timestamp is not None and len(self._flightmodes) > 0:
             (mode, t1, t2) = self._flightmodes[-1]
             self._flightmodes[-1] = (mode, t1, last_timestamp)
-        
+
+        self._type_names = [None] * len(type_numbers)
+        for (mtype, n) in type_numbers.items():
+            self._type_names[n] = mtype
+        self._fieldnames = dict([(t, loaders[t].fieldnames) for t in loaders])
+        self._data = dict([(t, loaders[t].finish()) for t in loaders])
+        self._order_type = numpy.array(order_type, dtype=numpy.int16)
+        self._order_row = numpy.array(order_row, dtype=numpy.int32)
+        self._timestamps = numpy.array(timestamps, dtype=float)
+        # indexes of records selected by flight mode, and per type row masks
+        self._selected = numpy.arange(self._count)
+        self._masks = {}
+        self._positions = {}
+        self._params = self.params
+        self.rewind()
 
     def recv_msg(self):
         '''message receive routine'''
         if self._index >= self._count:
             return None
-        m = self._msgs[self._index]
-        type = m.get_type()
+        i = self._selected[self._index]
+        mtype = self._type_names[self._order_type[i]]
+        m = mavmemlog_message(mtype, self._data[mtype], self._order_row[i], self._fieldnames[mtype])
         self._index += 1
         self.percent = (100.0 * self._index) / self._count
-        self.messages[type] = m
+        self.messages[mtype] = m
         self._timestamp = m._timestamp
 
         if self._flightmode_index < len(self._flightmodes):
@@ -73,12 +228,21 @@ class mavmemlog(mavutil.mavfile):
         self._flightmode_index = 0
         self._timestamp = None
         self.flightmode = None
-        self.params = {}
+        # parameters are all known after loading
+        self.params = dict(getattr(self, '_params', {}))
 
     def flightmode_list(self):
         '''return list of all flightmodes as tuple of mode and start time'''
         return self._flightmodes
 
+    def mode_mask(self, timestamps, flightmode_selections):
+        '''return a boolean mask of timestamps in the selected flight modes'''
+        ends = numpy.array([t2 for (mode, t1, t2) in self._flightmodes], dtype=float)
+        idx = numpy.searchsorted(ends, timestamps, side='right')
+        selections = numpy.zeros(len(self._flightmodes)+1, dtype=bool)
+        selections[:len(flightmode_selections)] = flightmode_selections[:len(selections)]
+        return selections[idx]
+
     def reduce_by_flightmodes(self, flightmode_selections):
         '''reduce data using flightmode selections'''
         if len(flightmode_selections) == 0:
@@ -90,13 +254,50 @@ class mavmemlog(mavutil.mavfile):
         if all_false:
             # treat all false as all modes wanted'''
             return
-        new_msgs = []
-        idx = 0
-        for m in self._msgs:
-            while idx < len(self._flightmodes) and m._timestamp >= self._flightmodes[idx][2]:
-                idx += 1
-            if idx < len(flightmode_selections) and flightmode_selections[idx]:
-                new_msgs.append(m)
-        self._msgs = new_msgs
-        self._count = len(new_msgs)
+        self._selected = numpy.nonzero(self.mode_mask(self._timestamps, flightmode_selections))[0]
+        self._masks = {}
+        self._positions = {}
+        for (mtype, data) in self._data.items():
+            self._masks[mtype] = self.mode_mask(data['_timestamp'], flightmode_selections)
+        self._count = len(self._selected)
         self.rewind()
+
+    def message_types(self):
+        '''return list of message types in the log'''
+        return sorted(self._data.keys())
+
+    def array(self, mtype):
+        '''return the structured array for a message type, limited to the
+        selected flight modes'''
+        data = self._data.get(mtype, None)
+        if data is None:
+            return None
+        mask = self._masks.get(mtype, None)
+        if mask is not None:
+            data = data[mask]
+        return data
+
+    def column(self, mtype, field):
+        '''return a numpy array of one field of a message type'''
+        data = self.array(mtype)
+        if data is None:
+            return None
+        return data[field]
+
+    def positions(self, mtype):
+        '''return the positions of a message type within the selected
+        records, in log order. Row i of array(mtype) is at positions[i]'''
+        if not mtype in self._data:
+            return None
+        ret = self._positions.get(mtype, None)
+        if ret is None:
+            n = self._type_names.index(mtype)
+            ret = numpy.nonzero(self._order_type[self._selected] == n)[0]
+            self._positions[mtype] = ret
+        return ret
+
+    def timestamps(self, mtype=None):
+        '''return timestamps of a message type, or of all records in log order'''
+        if mtype is None:
+            return self._timestamps[self._selected]
+        return self.column(mtype, '_timestamp')
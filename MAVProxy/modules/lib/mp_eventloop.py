@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+'''
+event loop for the MAVProxy main loop
+
+File descriptors for links, outputs and module select_extra users are
+registered once with a handler, rather than rebuilding a select() list
+on every pass of the main loop. On Linux epoll is used, elsewhere we
+fall back to select.
+'''
+
+import select, time, errno
+
+class MPEventHandler(object):
+    '''a registered file descriptor handler'''
+    def __init__(self, fd, fn, args, remove_on_error=False):
+        self.fd = fd
+        self.fn = fn
+        self.args = args
+        self.remove_on_error = remove_on_error
+        self.calls = 0
+
+class MPEventLoop(object):
+    '''persistent fd->handler registry with O(1) dispatch per ready fd'''
+    def __init__(self, backend=None):
+        if backend is None:
+            if hasattr(select, 'epoll'):
+                backend = 'epoll'
+            else:
+                backend = 'select'
+        self.backend = backend
+        self.handlers = {}
+        self.epoll = None
+        # fds epoll refused (eg. regular files), polled with select instead
+        self.select_fds = set()
+        if self.backend == 'epoll':
+            self.epoll = select.epoll()
+
+        # statistics
+        self.iterations = 0
+        self.wakeups = 0
+        self.timeouts = 0
+        self.events = 0
+        self.last_stats_time = time.time()
+        self.last_iterations = 0
+        self.last_wakeups = 0
+
+    def register(self, fd, fn, args=None, remove_on_error=False):
+        '''register fn(args) to be called when fd is readable'''
+        if fd is None:
+            return
+        if fd in self.handlers:
+            self.unregister(fd)
+        self.handlers[fd] = MPEventHandler(fd, fn, args, remove_on_error)
+        if self.epoll is not None:
+            try:
+                self.epoll.register(fd, select.EPOLLIN)
+            except (IOError, OSError):
+                self.select_fds.add(fd)
+
+    def unregister(self, fd, args=None):
+        '''remove a file descriptor from the registry. If args is given
+        the handler is only removed if it was registered with those
+        args, as a closed fd may have been reused by another handler'''
+        h = self.handlers.get(fd, None)
+        if h is None or (args is not None and h.args is not args):
+            return None
+        self.handlers.pop(fd)
+        if fd in self.select_fds:
+            self.select_fds.discard(fd)
+        elif self.epoll is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass
+        return h
+
+    def is_registered(self, fd, args=None):
+        '''return True if fd has a handler, registered with args if given'''
+        h = self.handlers.get(fd, None)
+        return h is not None and (args is None or h.args is args)
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def _wait(self, timeout):
+        '''wait for readable fds, returning a list of (fd, hangup)'''
+        if self.epoll is None:
+            try:
+                (rin, win, xin) = select.select(self.handlers.keys(), [], [], timeout)
+            except select.error:
+                return []
+            return [(fd, False) for fd in rin]
+        if self.select_fds:
+            try:
+                (ready, win, xin) = select.select(list(self.select_fds), [], [], 0)
+            except select.error:
+                ready = []
+            if ready:
+                timeout = 0
+            ready = [(fd, False) for fd in ready]
+        else:
+            ready = []
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, OSError) as e:
+            if e.errno == errno.EINTR:
+                return ready
+            raise
+        return ready + [(fd, (ev & (select.EPOLLHUP | select.EPOLLERR)) != 0) for (fd, ev) in events]
+
+    def poll(self, timeout, error_fn=None, exit_fn=None):
+        '''wait up to timeout seconds and dispatch handlers for ready fds.
+        If exit_fn returns True no more handlers are called, as a handler
+        may have shut things down. An fd that hangs up or errors is
+        removed after its handler has been called, so the handler sees
+        the error, and its owner can register the fd again, eg. once a
+        link has reconnected. Returns the number of handlers called'''
+        self.iterations += 1
+        if len(self.handlers) == 0:
+            time.sleep(timeout)
+            self.timeouts += 1
+            return 0
+        ready = self._wait(timeout)
+        if not ready:
+            self.timeouts += 1
+            return 0
+        self.wakeups += 1
+        count = 0
+        for (fd, hangup) in ready:
+            if exit_fn is not None and exit_fn():
+                break
+            # a handler may have unregistered a later fd
+            h = self.handlers.get(fd, None)
+            if h is None:
+                continue
+            h.calls += 1
+            count += 1
+            try:
+                h.fn(h.args)
+            except Exception as msg:
+                if not h.remove_on_error:
+                    raise
+                if error_fn is not None:
+                    error_fn(msg)
+                # on an exception, remove it from the registry
+                self.unregister(fd, h.args)
+                continue
+            if hangup:
+                self.unregister(fd, h.args)
+        self.events += count
+        return count
+
+    def stats(self):
+        '''return (iterations/sec, wakeups/sec) since the last call'''
+        tnow = time.time()
+        dt = tnow - self.last_stats_time
+        if dt <= 0:
+            dt = 1.0
+        irate = (self.iterations - self.last_iterations) / dt
+        wrate = (self.wakeups - self.last_wakeups) / dt
+        self.last_stats_time = tnow
+        self.last_iterations = self.iterations
+        self.last_wakeups = self.wakeups
+        return (irate, wrate)
+
+    def close(self):
+        '''close the backend'''
+        if self.epoll is not None:
+            self.epoll.close()
+            self.epoll = None
+
+
+class SelectExtraDict(dict):
+    '''dictionary of fd -> (fn, args) kept in sync with an event loop.
+    This keeps the old mpstate.select_extra interface for modules'''
+    def __init__(self, loop):
+        dict.__init__(self)
+        self.loop = loop
+
+    def _call(self, fd):
+        (fn, args) = dict.__getitem__(self, fd)
+        try:
+            fn(args)
+        except Exception:
+            # the event loop removes the fd on error, keep in step
+            dict.pop(self, fd, None)
+            raise
+
+    def __setitem__(self, fd, value):
+        dict.__setitem__(self, fd, value)
+        self.loop.register(fd, self._call, fd, remove_on_error=True)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.loop.unregister(fd)
+
+    def pop(self, fd, *args):
+        ret = dict.pop(self, fd, *args)
+        self.loop.unregister(fd)
+        return ret
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+'''
+MAVLink frame splitter
+
+Splits a received byte stream into raw MAVLink frames, validating the
+CRC and extracting msgid, sysid and compid from the header without
+unpacking the payload. This lets MAVProxy forward and log frames as
+raw bytes, and only decode messages that a handler actually looks at
+(see LazyMessage).
+'''
+
+import struct, re, sys
+
+PROTOCOL_MARKER_V1 = 0xFE
+PROTOCOL_MARKER_V2 = 0xFD
+PROTOCOL_MARKER_V09 = 0x55
+
+HEADER_LEN_V1 = 6
+HEADER_LEN_V2 = 10
+SIGNATURE_LEN = 13
+INCOMPAT_FLAG_SIGNED = 0x01
+
+def _make_crc_table():
+    '''build table for the MCRF4XX (X.25) CRC used by MAVLink'''
+    table = []
+    for i in range(256):
+        tmp = i
+        tmp ^= (tmp << 4) & 0xFF
+        table.append(((tmp << 8) ^ (tmp << 3) ^ (tmp >> 4)) & 0xFFFF)
+    return table
+
+# the MAVLink crc of byte b with accumulator crc is
+# (crc >> 8) ^ crc_table[(crc ^ b) & 0xFF]
+crc_table = _make_crc_table()
+
+def x25crc(buf, crc=0xFFFF):
+    '''return the X.25 CRC of a bytearray'''
+    table = crc_table
+    for b in buf:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+def crc_extra_map(mavlink):
+    '''return a dictionary of msgid -> crc_extra for a pymavlink dialect module'''
+    ret = {}
+    for (msgid, cls) in mavlink.mavlink_map.items():
+        ret[msgid] = getattr(cls, 'crc_extra', 0)
+    return ret
+
+def message_name(cls):
+    '''return the message type name of a pymavlink message class'''
+    name = getattr(cls, 'name', None)
+    if name is None:
+        name = cls.__name__[len('MAVLink_'):-len('_message')].upper()
+    return name
+
+def msgid_map(mavlink):
+    '''return a dictionary of message name -> msgid for a pymavlink dialect module'''
+    ret = {}
+    for (msgid, cls) in mavlink.mavlink_map.items():
+        ret[message_name(cls)] = msgid
+    return ret
+
+class MAVFrame(object):
+    '''a raw MAVLink frame'''
+    __slots__ = ['buf', 'msgid', 'sysid', 'compid', 'seq', 'payload_offset', 'payload_len']
+
+    def __init__(self, buf, msgid, sysid, compid, seq, payload_offset, payload_len):
+        self.buf = buf
+        self.msgid = msgid
+        self.sysid = sysid
+        self.compid = compid
+        self.seq = seq
+        self.payload_offset = payload_offset
+        self.payload_len = payload_len
+
+    def payload(self):
+        '''return the payload bytes'''
+        return self.buf[self.payload_offset:self.payload_offset+self.payload_len]
+
+class MAVFramer(object):
+    '''incremental splitter of a byte stream into MAVLink frames'''
+    def __init__(self, crc_extra, check_crc=True, mavlink09=False):
+        self.crc_extra = crc_extra
+        self.check_crc = check_crc
+        self.mavlink09 = mavlink09
+        self.buf = bytearray()
+        self.frames = 0
+        self.bad_crc = 0
+        self.unknown = 0
+        self.skipped_bytes = 0
+
+    def frame_length(self, buf, ofs):
+        '''return (total_length, header_length) of the frame at ofs, or None
+        if we don't have enough of the header yet'''
+        stx = buf[ofs]
+        if stx == PROTOCOL_MARKER_V2:
+            if len(buf) - ofs < 3:
+                return None
+            plen = buf[ofs+1]
+            length = HEADER_LEN_V2 + plen + 2
+            if buf[ofs+2] & INCOMPAT_FLAG_SIGNED:
+                length += SIGNATURE_LEN
+            return (length, HEADER_LEN_V2)
+        if len(buf) - ofs < 2:
+            return None
+        plen = buf[ofs+1]
+        return (HEADER_LEN_V1 + plen + 2, HEADER_LEN_V1)
+
+    def is_marker(self, b):
+        if self.mavlink09:
+            return b == PROTOCOL_MARKER_V09
+        return b == PROTOCOL_MARKER_V1 or b == PROTOCOL_MARKER_V2
+
+    def parse_frame(self, buf, ofs, length, hlen):
+        '''parse a complete frame. Returns a MAVFrame or None if the frame is bad'''
+        frame = buf[ofs:ofs+length]
+        if hlen == HEADER_LEN_V2:
+            (plen, seq, sysid, compid) = (frame[1], frame[4], frame[5], frame[6])
+            msgid = frame[7] | (frame[8]<<8) | (frame[9]<<16)
+            crc_end = hlen + plen
+        else:
+            (plen, seq, sysid, compid, msgid) = (frame[1], frame[2], frame[3], frame[4], frame[5])
+            crc_end = hlen + plen
+        if self.check_crc:
+            crc = x25crc(frame[1:crc_end])
+            if not self.mavlink09:
+                extra = self.crc_extra.get(msgid, None)
+                if extra is None:
+                    self.unknown += 1
+                    return None
+                crc = (crc >> 8) ^ crc_table[(crc ^ extra) & 0xFF]
+            (crc2,) = struct.unpack('<H', bytes(frame[crc_end:crc_end+2]))
+            if crc != crc2:
+                self.bad_crc += 1
+                return None
+        self.frames += 1
+        return MAVFrame(frame, msgid, sysid, compid, seq, hlen, plen)
+
+    def feed(self, data):
+        '''add received bytes, returning a list of complete valid frames'''
+        buf = self.buf
+        buf.extend(data)
+        ret = []
+        ofs = 0
+        n = len(buf)
+        while ofs < n:
+            if not self.is_marker(buf[ofs]):
+                # resync on the next start marker
+                ofs += 1
+                self.skipped_bytes += 1
+                continue
+            fl = self.frame_length(buf, ofs)
+            if fl is None:
+                break
+            (length, hlen) = fl
+            if n - ofs < length:
+                break
+            frame = self.parse_frame(buf, ofs, length, hlen)
+            if frame is None:
+                # skip the marker and look for the next frame
+                ofs += 1
+                self.skipped_bytes += 1
+                continue
+            ret.append(frame)
+            ofs += length
+        if ofs > 0:
+            del buf[:ofs]
+        return ret
+
+
+def field_layout(cls):
+    '''return a dictionary of fieldname -> (offset, struct.Struct) for the
+    scalar fields of a pymavlink message class, so single fields can be
+    read from a raw payload without decoding the whole message. Array
+    and string fields are not included'''
+    fmt = getattr(cls, 'format', None)
+    names = getattr(cls, 'ordered_fieldnames', None)
+    if fmt is None or names is None:
+        return {}
+    tokens = re.findall(r'(\d*)([a-zA-Z?])', fmt.lstrip('<'))
+    if len(tokens) != len(names):
+        return {}
+    ret = {}
+    ofs = 0
+    for (name, (count, code)) in zip(names, tokens):
+        if count == '' and code != 's':
+            ret[name] = (ofs, struct.Struct('<' + code))
+        ofs += struct.calcsize('<' + count + code)
+    return ret
+
+class MAVMessageInfo(object):
+    '''per message type information used by lazy messages'''
+    def __init__(self, msgid, cls):
+        self.msgid = msgid
+        self.cls = cls
+        self.name = message_name(cls)
+        self.fieldnames = getattr(cls, 'fieldnames', [])
+        self.fields = set(self.fieldnames)
+        self.layout = field_layout(cls)
+        # fields mavutil's post_message() takes the vehicle uptime from
+        self.uptime_fields = [n for n in ('usec', 'time_boot_ms') if n in self.layout]
+
+    def frame_field(self, frame, name):
+        '''read a scalar field straight from the payload of a frame'''
+        (ofs, s) = self.layout[name]
+        if ofs + s.size > frame.payload_len:
+            # MAVLink2 payloads may have trailing zeros truncated
+            return 0
+        return s.unpack_from(frame.buf, frame.payload_offset + ofs)[0]
+
+def message_info_map(mavlink):
+    '''return a dictionary of msgid -> MAVMessageInfo for a pymavlink dialect module'''
+    ret = {}
+    for (msgid, cls) in mavlink.mavlink_map.items():
+        ret[msgid] = MAVMessageInfo(msgid, cls)
+    return ret
+
+class LazyMessage(object):
+    '''a MAVLink message that is only decoded when needed.
+
+    The type, ids, sequence number and raw buffer come from the frame
+    header. Scalar fields are read straight from the payload, and any
+    other access decodes the frame with pymavlink and delegates to the
+    decoded message'''
+    def __init__(self, frame, info, mav):
+        self._frame = frame
+        self._info = info
+        self._mav = mav
+        self._decoded = None
+        self._msgbuf = None
+        # post_message() looks for these in __dict__
+        for name in info.uptime_fields:
+            self.__dict__[name] = self.__getattr__(name)
+
+    def get_type(self):
+        return self._info.name
+
+    def get_msgId(self):
+        return self._frame.msgid
+
+    def get_srcSystem(self):
+        return self._frame.sysid
+
+    def get_srcComponent(self):
+        return self._frame.compid
+
+    def get_seq(self):
+        return self._frame.seq
+
+    def get_msgbuf(self):
+        if self._msgbuf is None:
+            self._msgbuf = str(self._frame.buf)
+        return self._msgbuf
+
+    def get_fieldnames(self):
+        return self._info.fieldnames
+
+    def get_signed(self):
+        buf = self._frame.buf
+        return buf[0] == PROTOCOL_MARKER_V2 and (buf[2] & INCOMPAT_FLAG_SIGNED) != 0
+
+    def get_link_id(self):
+        '''return the link id of a signed message, or None'''
+        if not self.get_signed():
+            return None
+        frame = self._frame
+        return frame.buf[frame.payload_offset + frame.payload_len + 2]
+
+    def get_crc(self):
+        frame = self._frame
+        ofs = frame.payload_offset + frame.payload_len
+        return frame.buf[ofs] | (frame.buf[ofs+1] << 8)
+
+    def get_header(self):
+        frame = self._frame
+        buf = frame.buf
+        mavlink = sys.modules[type(self._mav).__module__]
+        if buf[0] == PROTOCOL_MARKER_V2:
+            (incompat_flags, compat_flags) = (buf[2], buf[3])
+        else:
+            (incompat_flags, compat_flags) = (0, 0)
+        try:
+            return mavlink.MAVLink_header(frame.msgid, incompat_flags=incompat_flags, compat_flags=compat_flags,
+                                          mlen=frame.payload_len, seq=frame.seq,
+                                          srcSystem=frame.sysid, srcComponent=frame.compid)
+        except TypeError:
+            # older pymavlink without MAVLink2 header fields
+            return self.decode().get_header()
+
+    def is_decoded(self):
+        '''return True if the full message has been decoded'''
+        return self._decoded is not None
+
+    def decode(self):
+        '''return the fully decoded pymavlink message'''
+        if self._decoded is None:
+            # pymavlink decodes from a bytearray, as built by parse_char()
+            self._decoded = self._mav.decode(self._frame.buf)
+        return self._decoded
+
+    def __getattr__(self, name):
+        # only called for attributes not found normally
+        if name.startswith('_'):
+            if name in ('_timestamp', '_posted'):
+                # set by mavutil when the message is posted
+                raise AttributeError(name)
+            return getattr(self.decode(), name)
+        if name not in self._info.fields:
+            if self._decoded is None and not hasattr(self._info.cls, name):
+                raise AttributeError(name)
+            return getattr(self.decode(), name)
+        if self._decoded is not None:
+            return getattr(self._decoded, name)
+        layout = self._info.layout.get(name, None)
+        if layout is not None:
+            (ofs, s) = layout
+            frame = self._frame
+            # MAVLink2 payloads may have trailing zeros truncated
+            if ofs + s.size <= frame.payload_len:
+                return s.unpack_from(frame.buf, frame.payload_offset + ofs)[0]
+        return getattr(self.decode(), name)
+
+    def to_dict(self):
+        return self.decode().to_dict()
+
+    def __str__(self):
+        return str(self.decode())
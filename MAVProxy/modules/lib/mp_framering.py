@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+shared memory frame buffers
+
+A FrameRing is a fixed number of preallocated frame buffers in shared
+memory, created before a child process is started so both processes
+see the same memory. The writer copies a frame into a slot and sends
+the small FrameRef returned by put() over a queue or pipe, instead of
+pickling the whole frame. The reader uses the FrameRef to copy the
+frame back out.
+
+Each slot holds the sequence number of the frame in it. When the
+reader is behind and every slot is full, the writer reuses the slot of
+the oldest unread frame, so the reader finds a newer sequence number
+in that slot and the stale frame is dropped.
+'''
+
+import ctypes, multiprocessing
+
+# slot states, other values are the sequence number of the frame held
+SLOT_FREE = 0
+SLOT_WRITING = -1
+
+class FrameRef:
+    '''a frame held in a FrameRing'''
+    def __init__(self, slot, seq, shape, dtype, nbytes):
+        self.slot = slot
+        self.seq = seq
+        self.shape = shape
+        self.dtype = dtype
+        self.nbytes = nbytes
+
+class FrameRing:
+    '''a ring of shared memory frame buffers of slot_size bytes'''
+    def __init__(self, slots=3, slot_size=640*480*3):
+        if slots < 2:
+            raise ValueError("a frame ring needs at least 2 slots")
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buf = multiprocessing.RawArray(ctypes.c_char, slots * slot_size)
+        self.slot_seq = multiprocessing.RawArray(ctypes.c_long, slots)
+        self.reading = multiprocessing.RawArray(ctypes.c_byte, slots)
+        self.lock = multiprocessing.Lock()
+        self.next_seq = 1
+
+        # writer statistics
+        self.written = 0
+        self.overwritten = 0
+        self.too_big = 0
+
+    def fits(self, nbytes):
+        '''return True if a frame of nbytes fits in a slot'''
+        return nbytes <= self.slot_size
+
+    def _choose_slot(self):
+        '''pick a slot to write, with the lock held'''
+        oldest = None
+        for i in range(self.slots):
+            if self.reading[i]:
+                continue
+            seq = self.slot_seq[i]
+            if seq == SLOT_FREE:
+                return i
+            if seq != SLOT_WRITING and (oldest is None or seq < self.slot_seq[oldest]):
+                oldest = i
+        if oldest is not None:
+            # drop the oldest unread frame
+            self.overwritten += 1
+        return oldest
+
+    def put(self, data, shape, dtype='uint8'):
+        '''copy a frame into the ring. data is a string or a contiguous
+        numpy array. Returns a FrameRef to send to the reader, or None if
+        the frame doesn't fit'''
+        if isinstance(data, str):
+            nbytes = len(data)
+            src = data
+        else:
+            nbytes = data.nbytes
+            src = data.ctypes.data
+        if not self.fits(nbytes):
+            self.too_big += 1
+            return None
+        with self.lock:
+            slot = self._choose_slot()
+            if slot is None:
+                return None
+            self.slot_seq[slot] = SLOT_WRITING
+        ctypes.memmove(ctypes.addressof(self.buf) + slot * self.slot_size, src, nbytes)
+        seq = self.next_seq
+        self.next_seq += 1
+        with self.lock:
+            self.slot_seq[slot] = seq
+        self.written += 1
+        return FrameRef(slot, seq, shape, dtype, nbytes)
+
+    def get(self, ref):
+        '''return the data of a frame as a string, or None if it has been
+        dropped. The slot is freed for reuse'''
+        with self.lock:
+            if self.slot_seq[ref.slot] != ref.seq:
+                return None
+            self.reading[ref.slot] = 1
+        data = ctypes.string_at(ctypes.addressof(self.buf) + ref.slot * self.slot_size, ref.nbytes)
+        with self.lock:
+            self.reading[ref.slot] = 0
+            if self.slot_seq[ref.slot] == ref.seq:
+                self.slot_seq[ref.slot] = SLOT_FREE
+        return data
+
+    def get_array(self, ref):
+        '''return a frame as a numpy array, or None if it has been dropped'''
+        import numpy
+        data = self.get(ref)
+        if data is None:
+            return None
+        return numpy.fromstring(data, dtype=ref.dtype).reshape(ref.shape)
+
+    def release(self, ref):
+        '''free the slot of a frame that won't be read'''
+        with self.lock:
+            if self.slot_seq[ref.slot] == ref.seq:
+                self.slot_seq[ref.slot] = SLOT_FREE
+
+    def __str__(self):
+        return 'slots=%u slot_size=%u written=%u overwritten=%u too_big=%u' % (
+            self.slots, self.slot_size, self.written, self.overwritten, self.too_big)
@@ -15,6 +15,7 @@ except ImportError:
 
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_widgets
+from MAVProxy.modules.lib import mp_framering
 from MAVProxy.modules.lib.mp_menu import *
 
 
@@ -25,6 +26,13 @@ class MPImageData:
         self.height = img.height
         self.data = img.tostring()
 
+class MPImageSharedData:
+    '''image data held in the shared frame ring'''
+    def __init__(self, width, height, ref):
+        self.width = width
+        self.height = height
+        self.ref = ref
+
 class MPImageTitle:
     '''window title to use'''
     def __init__(self, title):
@@ -74,7 +82,8 @@ class MPImage():
                  key_events = False,
                  auto_size = False,
                  report_size_changes = False,
-                 daemon = False):
+                 daemon = False,
+                 shared_frames = 3):
         import multiprocessing
 
         self.title = title
@@ -93,6 +102,12 @@ class MPImage():
         self.in_queue = makeIPCQueue()
         self.out_queue = makeIPCQueue()
 
+        # images up to the initial window size are passed in shared
+        # memory, larger ones through in_queue
+        self.frame_ring = None
+        if shared_frames:
+            self.frame_ring = mp_framering.FrameRing(shared_frames, width*height*3)
+
         self.default_menu = MPMenuSubMenu('View',
                                           items=[MPMenuItem('Fit Window', 'Fit Window', 'fitWindow'),
                                                  MPMenuItem('Full Zoom',  'Full Zoom', 'fullSize')])
@@ -124,6 +139,11 @@ class MPImage():
         if bgr:
             img = cv.CloneImage(img)
             cv.CvtColor(img, img, cv.CV_BGR2RGB)
+        if self.frame_ring is not None and self.frame_ring.fits(img.width*img.height*3):
+            ref = self.frame_ring.put(img.tostring(), (img.height, img.width, 3))
+            if ref is not None:
+                self.in_queue.put(MPImageSharedData(img.width, img.height, ref))
+                return
         self.in_queue.put(MPImageData(img))
 
     def set_title(self, title):
@@ -319,11 +339,24 @@ class MPImagePanel(wx.Panel):
         '''the redraw timer ensures we show new map tiles as they
         are downloaded'''
         state = self.state
+        objs = []
         while state.in_queue.qsize():
-            obj = state.in_queue.get()
+            objs.append(state.in_queue.get())
+        # only the newest image is shown, drop any older ones
+        images = [obj for obj in objs if isinstance(obj, (MPImageData, MPImageSharedData))]
+        for obj in images[:-1]:
+            objs.remove(obj)
+            if isinstance(obj, MPImageSharedData):
+                state.frame_ring.release(obj.ref)
+        for obj in objs:
+            data = None
             if isinstance(obj, MPImageData):
+                data = obj.data
+            if isinstance(obj, MPImageSharedData):
+                data = state.frame_ring.get(obj.ref)
+            if data is not None:
                 img = wx.EmptyImage(obj.width, obj.height)
-                img.SetData(obj.data)
+                img.SetData(data)
                 self.img = img
                 self.need_redraw = True
                 if state.auto_size:
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+'''
+onboard log download engine
+
+A log is fetched with LOG_REQUEST_DATA range requests, which the
+vehicle answers with a stream of LOG_DATA chunks of LOG_CHUNK bytes.
+The state of each chunk is kept in a bytearray with one byte per
+chunk, so the next missing range is found with bytearray.find()
+instead of set arithmetic. When the log size is known the output file
+is allocated up front and memory mapped, and chunks are copied
+straight into it.
+
+Autopilots serve one range request at a time, a new request replacing
+the one in progress. To keep the link busy the next range is requested
+when the chunks left in the current range will all have been sent
+within one round trip. The range size is the window: it grows while
+ranges arrive without loss, and is halved when chunks are lost, so
+lossy links retry small ranges quickly. Chunks lost from a range are
+requested again once the end of the log has been reached, with nearby
+holes joined into one range when sending the chunks between them
+again is quicker than another round trip.
+
+The chunk states of a partial download are saved next to the output
+file, so a download can be resumed by a later session. This needs the
+log size, so the log module asks for the LOG_ENTRY of a log that
+hasn't been listed before downloading it. The SHA1 of
+each finished log is recorded in a SHA1SUMS file in the same
+directory, in the format of sha1sum, which lets logs already
+downloaded be skipped.
+'''
+
+import hashlib, mmap, os, time
+
+# bytes of log data in each LOG_DATA message
+LOG_CHUNK = 90
+
+# range size limits in chunks
+LOG_WINDOW_MIN = 16
+LOG_WINDOW_MAX = 1024
+
+# round trip time assumed before it has been measured, and the least
+# time without data before ranges are requested again
+LOG_RTT_INITIAL = 0.3
+LOG_TIMEOUT_MIN = 0.7
+
+# chunk states of a partial download are saved to the output filename
+# plus LOG_STATE_EXT, every LOG_STATE_INTERVAL seconds
+LOG_STATE_EXT = '.chunks'
+LOG_STATE_MAGIC = b'MAVLOGCHUNKS'
+LOG_STATE_INTERVAL = 2.0
+
+LOG_MANIFEST = 'SHA1SUMS'
+
+# seconds to wait for the LOG_ENTRY giving the size of a log that
+# hasn't been listed
+LOG_ENTRY_TIMEOUT = 2.0
+
+def file_sha1(filename):
+    '''return the SHA1 hex digest of a file'''
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    while True:
+        data = f.read(65536)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+def manifest_path(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), LOG_MANIFEST)
+
+def manifest_read(filename):
+    '''return the manifest of the directory of a log as a dictionary of
+    basename -> digest'''
+    ret = {}
+    try:
+        f = open(manifest_path(filename), 'r')
+    except IOError:
+        return ret
+    for line in f:
+        a = line.strip().split(None, 1)
+        if len(a) == 2:
+            ret[a[1].lstrip('*')] = a[0]
+    f.close()
+    return ret
+
+def manifest_update(filename, digest):
+    '''record the digest of a log in the manifest of its directory'''
+    entries = manifest_read(filename)
+    entries[os.path.basename(filename)] = digest
+    path = manifest_path(filename)
+    f = open(path + '.tmp', 'w')
+    for name in sorted(entries.keys()):
+        f.write('%s  %s\n' % (entries[name], name))
+    f.close()
+    os.rename(path + '.tmp', path)
+
+def log_downloaded(filename, size):
+    '''return True if a log of size bytes has already been downloaded to
+    filename, checking its size and its SHA1 from the manifest. Logs
+    downloaded before the manifest was kept are only checked by size'''
+    if not os.path.exists(filename) or os.path.exists(filename + LOG_STATE_EXT):
+        return False
+    if os.path.getsize(filename) != size:
+        return False
+    digest = manifest_read(filename).get(os.path.basename(filename), None)
+    return digest is None or digest == file_sha1(filename)
+
+class LogRange(object):
+    '''an outstanding range request of chunks [start, end)'''
+    def __init__(self, start, end, sent):
+        self.start = start
+        self.end = end
+        # next chunk expected from the vehicle
+        self.next = start
+        self.sent = sent
+        self.first = None
+        self.last = sent
+        self.lost = 0
+
+class LogDownload(object):
+    '''download of one log to a file. request(ofs, count) sends a
+    LOG_REQUEST_DATA. size is the log size from LOG_ENTRY, or None if
+    unknown, in which case the end of the log is found from the first
+    short chunk. A partial download of the same size is resumed, taking
+    the size from the saved state if it isn't given'''
+    def __init__(self, filename, size, request, window=LOG_WINDOW_MAX):
+        self.filename = filename
+        self.state_file = filename + LOG_STATE_EXT
+        if not size:
+            size = self.state_size()
+        self.request = request
+        self.max_window = max(window, LOG_WINDOW_MIN)
+        self.window = LOG_WINDOW_MIN
+        self.size = None
+        self.map = None
+        # one byte per chunk, non-zero once received
+        self.chunks = bytearray()
+        self.ranges = []
+        self.resumed = False
+        if size:
+            chunks = self.load_state(size)
+            if chunks is not None:
+                self.file = open(filename, 'r+b')
+                self.chunks = chunks
+                self.resumed = True
+            else:
+                self.file = open(filename, 'w+b')
+                self.file.truncate(size)
+            self.set_size(size)
+            self.map = mmap.mmap(self.file.fileno(), size)
+        else:
+            self.file = open(filename, 'w+b')
+        if not self.resumed and os.path.exists(self.state_file):
+            # the saved state was for a different log
+            os.unlink(self.state_file)
+        # where to look for the next missing range
+        self.cursor = 0
+        self.passes = 0
+
+        self.start_time = time.time()
+        self.last_data = self.start_time
+        self.finish_time = None
+        self.srtt = None
+        self.rttvar = 0.0
+        # measured seconds between chunks
+        self.chunk_interval = None
+
+        self.state_time = self.start_time
+        # save the state straight away, so a full size file without it
+        # is never taken for a finished log
+        self.state_dirty = not self.resumed
+        self.save_state()
+
+        # statistics
+        self.received = self.chunks.count(b'\x01')
+        self.received_bytes = 0
+        if self.received:
+            self.received_bytes = self.received * LOG_CHUNK
+            if self.chunks[-1]:
+                self.received_bytes -= self.nchunks() * LOG_CHUNK - self.size
+        self.resumed_bytes = self.received_bytes
+        self.duplicates = 0
+        self.lost = 0
+        self.requests = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.rate_time = self.start_time
+        self.rate_bytes = self.received_bytes
+        self.throughput = 0.0
+
+    def nchunks(self):
+        '''number of chunks in the log, or None if not known yet'''
+        if self.size is None:
+            return None
+        return (self.size + LOG_CHUNK - 1) // LOG_CHUNK
+
+    def set_size(self, size):
+        '''set the log size once known'''
+        if self.size is not None and self.size <= size:
+            return
+        self.size = size
+        n = self.nchunks()
+        if len(self.chunks) < n:
+            self.chunks.extend(bytearray(n - len(self.chunks)))
+        elif len(self.chunks) > n:
+            del self.chunks[n:]
+        for r in self.ranges:
+            r.end = min(r.end, n)
+        self.ranges = [r for r in self.ranges if r.next < r.end]
+
+    def complete(self):
+        return self.finish_time is not None
+
+    def state_size(self):
+        '''return the log size of a saved partial download, or None'''
+        try:
+            f = open(self.state_file, 'rb')
+            header = f.readline().split()
+            f.close()
+            if len(header) != 2 or header[0] != LOG_STATE_MAGIC:
+                return None
+            return int(header[1])
+        except (IOError, OSError, ValueError):
+            return None
+
+    def load_state(self, size):
+        '''return the saved chunk states of a partial download of size
+        bytes, or None'''
+        if self.state_size() != size:
+            return None
+        try:
+            if os.path.getsize(self.filename) != size:
+                return None
+            f = open(self.state_file, 'rb')
+            f.readline()
+            chunks = bytearray(f.read())
+            f.close()
+        except (IOError, OSError):
+            return None
+        if len(chunks) != (size + LOG_CHUNK - 1) // LOG_CHUNK:
+            return None
+        return chunks
+
+    def save_state(self):
+        '''save the chunk states, so a later session can resume'''
+        if self.size is None or self.map is None or not self.state_dirty:
+            return
+        # chunks must be on disk before they are marked as received
+        self.map.flush()
+        f = open(self.state_file + '.tmp', 'wb')
+        f.write(LOG_STATE_MAGIC + b' ' + str(self.size).encode('ascii') + b'\n')
+        f.write(self.chunks)
+        f.close()
+        os.rename(self.state_file + '.tmp', self.state_file)
+        self.state_dirty = False
+
+    def store(self, ofs, data):
+        '''write a chunk to the output file'''
+        if self.map is not None and ofs + len(data) > len(self.map):
+            # the log has grown beyond the size given at the start
+            self.map.close()
+            self.map = None
+        if self.map is not None:
+            self.map[ofs:ofs+len(data)] = bytes(data)
+        else:
+            self.file.seek(ofs)
+            self.file.write(data)
+
+    def range_for(self, chunk):
+        '''return the outstanding range holding a chunk'''
+        for r in self.ranges:
+            if r.start <= chunk < r.end:
+                return r
+        return None
+
+    def rtt_sample(self, rtt):
+        '''update the smoothed round trip time'''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt * 0.5
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def rtt(self):
+        if self.srtt is None:
+            return LOG_RTT_INITIAL
+        return self.srtt
+
+    def timeout(self):
+        '''seconds without data before the outstanding ranges are dropped'''
+        return max(self.rtt() + 4 * self.rttvar, LOG_TIMEOUT_MIN)
+
+    def range_done(self, r):
+        '''adapt the window when a range has finished'''
+        self.ranges.remove(r)
+        if r.lost == 0:
+            self.window = min(self.window * 2, self.max_window)
+        else:
+            self.window = max(self.window // 2, LOG_WINDOW_MIN)
+
+    def handle_data(self, ofs, count, data, now=None):
+        '''handle a LOG_DATA message'''
+        if self.complete():
+            return
+        if now is None:
+            now = time.time()
+        self.last_data = now
+        if count < LOG_CHUNK:
+            # a short chunk marks the end of the log
+            self.set_size(ofs + count)
+        c = ofs // LOG_CHUNK
+        r = self.range_for(c)
+        if r is not None:
+            if r.first is None:
+                r.first = now
+                self.rtt_sample(now - r.sent)
+                # the vehicle has moved on from older ranges
+                for old in self.ranges[:]:
+                    if old.sent < r.sent:
+                        self.ranges.remove(old)
+            if c > r.next:
+                r.lost += c - r.next
+                self.lost += c - r.next
+            elif c == r.next and r.next > r.start:
+                interval = now - r.last
+                if self.chunk_interval is None:
+                    self.chunk_interval = interval
+                else:
+                    self.chunk_interval = 0.9 * self.chunk_interval + 0.1 * interval
+            r.next = max(r.next, c + 1)
+            r.last = now
+            if r.next >= r.end:
+                self.range_done(r)
+        if count > 0:
+            if c >= len(self.chunks):
+                self.chunks.extend(bytearray(c + 1 - len(self.chunks)))
+            if self.chunks[c]:
+                self.duplicates += 1
+            else:
+                self.store(ofs, bytearray(data[:count]))
+                self.chunks[c] = 1
+                self.state_dirty = True
+                self.received += 1
+                self.received_bytes += count
+        n = self.nchunks()
+        if n is not None and self.received >= n and self.chunks.find(b'\x00') == -1:
+            self.finish(now)
+            return
+        self.fill(now)
+
+    def start(self, now=None):
+        '''start or resume the download'''
+        if now is None:
+            now = time.time()
+        n = self.nchunks()
+        if n is not None and self.received >= n and self.chunks.find(b'\x00') == -1:
+            # everything was received by an earlier session
+            self.finish(now)
+            return
+        self.fill(now)
+
+    def next_range(self):
+        '''return (start, end) of the next missing range to request, or
+        None if everything missing is already requested'''
+        n = self.nchunks()
+        cursor = self.cursor
+        wrapped = False
+        while True:
+            start = self.chunks.find(b'\x00', cursor)
+            if start == -1:
+                start = max(cursor, len(self.chunks))
+            if n is not None and start >= n:
+                if wrapped:
+                    return None
+                # start again from the beginning for lost chunks
+                wrapped = True
+                cursor = 0
+                continue
+            r = self.range_for(start)
+            if r is not None and start >= r.next:
+                cursor = r.end
+                continue
+            break
+        limit = start + self.window
+        if n is not None:
+            limit = min(limit, n)
+        # take in runs of received chunks that cost less to send again
+        # than a round trip
+        gap_max = 0
+        if self.chunk_interval:
+            gap_max = int(self.rtt() / self.chunk_interval)
+        end = limit
+        pos = start
+        while pos < len(self.chunks):
+            have = self.chunks.find(b'\x01', pos, limit)
+            if have == -1:
+                break
+            end = have
+            pos = self.chunks.find(b'\x00', have, limit)
+            if pos == -1 or pos - have > gap_max:
+                break
+            end = limit
+        for r in self.ranges:
+            if start < r.start < end:
+                end = r.start
+        if wrapped:
+            self.passes += 1
+        return (start, end)
+
+    def send_range(self, now):
+        '''request the next missing range'''
+        rng = self.next_range()
+        if rng is None:
+            return False
+        (start, end) = rng
+        if start < self.cursor:
+            self.retries += 1
+        self.cursor = end
+        self.ranges.append(LogRange(start, end, now))
+        self.requests += 1
+        self.request(start * LOG_CHUNK, (end - start) * LOG_CHUNK)
+        return True
+
+    def fill(self, now):
+        '''request the next range when the current one will be finished
+        within a round trip'''
+        if not self.ranges:
+            self.send_range(now)
+            return
+        if len(self.ranges) > 1:
+            return
+        r = self.ranges[0]
+        if r.first is None or self.chunk_interval is None:
+            return
+        if (r.end - r.next) * self.chunk_interval <= self.rtt():
+            self.send_range(now)
+
+    def update(self, now=None):
+        '''check for timeouts, to be called regularly'''
+        if self.complete():
+            return
+        if now is None:
+            now = time.time()
+        if now - self.last_data > self.timeout():
+            if self.ranges:
+                self.timeouts += 1
+                self.window = max(self.window // 2, LOG_WINDOW_MIN)
+            self.ranges = []
+            self.last_data = now
+            self.fill(now)
+        if now - self.rate_time >= 1.0:
+            rate = (self.received_bytes - self.rate_bytes) / (now - self.rate_time)
+            if self.throughput == 0:
+                self.throughput = rate
+            else:
+                self.throughput = 0.7 * self.throughput + 0.3 * rate
+            self.rate_time = now
+            self.rate_bytes = self.received_bytes
+        if now - self.state_time >= LOG_STATE_INTERVAL:
+            self.state_time = now
+            self.save_state()
+
+    def finish(self, now):
+        '''close the output file once all chunks are received'''
+        self.finish_time = now
+        self.ranges = []
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.truncate(self.size)
+        self.file.close()
+        if os.path.exists(self.state_file):
+            os.unlink(self.state_file)
+        manifest_update(self.filename, file_sha1(self.filename))
+
+    def close(self):
+        '''stop a download, keeping the chunks received so far'''
+        if self.complete():
+            return
+        self.save_state()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if not self.file.closed:
+            self.file.close()
+
+    def missing(self):
+        '''number of chunks known to be missing'''
+        n = self.nchunks()
+        if n is None:
+            n = len(self.chunks)
+        return n - self.received
+
+    def eta(self):
+        '''estimated seconds to finish, or None if not known'''
+        if self.size is None or self.throughput <= 0:
+            return None
+        return (self.size - self.received_bytes) / self.throughput
+
+    def elapsed(self):
+        if self.finish_time is not None:
+            return self.finish_time - self.start_time
+        return time.time() - self.start_time
+
+    def speed(self):
+        '''average kbyte/s over the whole download'''
+        dt = self.elapsed()
+        if dt <= 0:
+            return 0.0
+        return (self.received_bytes - self.resumed_bytes) / (1000.0 * dt)
+
+    def status(self):
+        eta = self.eta()
+        if eta is None:
+            eta_str = '?'
+        else:
+            eta_str = '%.0fs' % eta
+        size = self.size
+        if size is None:
+            size = 0
+        return ('%u/%u bytes %.1f kbyte/s ETA %s (window %u rtt %.0fms %u requests %u retries %u lost %u missing)' %
+                (self.received_bytes, size, self.throughput / 1000.0, eta_str,
+                 self.window, self.rtt() * 1000, self.requests, self.retries,
+                 self.lost, self.missing()))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''
+bounded, batched telemetry log writer
+
+Records are copied into a fixed ring of preallocated blocks for each
+log file. A single writer thread takes all the filled blocks of a ring
+at once and writes them with one writev() call where available, so a
+slow disk costs a bounded amount of memory rather than an ever growing
+queue. When a ring is full the overflow policy decides whether new
+records are dropped or the caller waits for the writer.
+'''
+
+import os, time, threading
+
+# default ring size per log file, 64 blocks of 64k
+LOG_BLOCK_SIZE = 64*1024
+LOG_NUM_BLOCKS = 64
+
+# how often partially filled blocks are written when not flushing on
+# every record
+LOG_FLUSH_INTERVAL = 0.5
+
+OVERFLOW_POLICIES = ['drop', 'block']
+
+def block_view(block, length):
+    '''return a zero copy view of the first length bytes of a bytearray'''
+    try:
+        return buffer(block, 0, length)
+    except NameError:
+        return memoryview(block)[:length]
+
+class MPLogRing(object):
+    '''ring of preallocated blocks holding records for one log file'''
+    def __init__(self, name, cond, num_blocks=LOG_NUM_BLOCKS, block_size=LOG_BLOCK_SIZE):
+        self.name = name
+        self.cond = cond
+        self.block_size = block_size
+        self.blocks = [bytearray(block_size) for i in range(num_blocks)]
+        self.lengths = [0] * num_blocks
+        # oldest unwritten block, and number of blocks holding data,
+        # including any being written by the writer thread
+        self.tail = 0
+        self.used = 0
+        # can the last used block take more data?
+        self.open = False
+        self.pending = 0
+        # file offset of the next record. Until the file is opened this
+        # is relative to the end of the file
+        self.offset = 0
+        # called with the size of the file when it is opened
+        self.rebase_callbacks = []
+        self.logfile = None
+        self.writer = None
+
+        # statistics
+        self.records = 0
+        self.bytes_written = 0
+        self.writes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.high_water = 0
+        self.fsyncs = 0
+        self.last_fsync = time.time()
+        self.last_stats_time = time.time()
+        self.last_bytes_written = 0
+
+    def free_space(self):
+        '''number of bytes that can be added without overflowing'''
+        nblocks = len(self.blocks)
+        ret = (nblocks - self.used) * self.block_size
+        if self.open:
+            ret += self.block_size - self.lengths[(self.tail + self.used - 1) % nblocks]
+        return ret
+
+    def put(self, data):
+        '''add a record. Returns the file offset of the record, or None if
+        it was dropped'''
+        n = len(data)
+        nblocks = len(self.blocks)
+        with self.cond:
+            while self.free_space() < n:
+                writer = self.writer
+                if (writer is None or self.logfile is None or writer.closing or
+                    writer.settings.logoverflow != 'block' or
+                    n > nblocks * self.block_size):
+                    self.dropped += 1
+                    self.dropped_bytes += n
+                    return None
+                self.cond.notify_all()
+                self.cond.wait(0.1)
+            ofs = 0
+            while ofs < n:
+                if not self.open:
+                    # start a new block
+                    self.lengths[(self.tail + self.used) % nblocks] = 0
+                    self.used += 1
+                    self.open = True
+                idx = (self.tail + self.used - 1) % nblocks
+                fill = self.lengths[idx]
+                count = min(n - ofs, self.block_size - fill)
+                self.blocks[idx][fill:fill+count] = data[ofs:ofs+count]
+                self.lengths[idx] = fill + count
+                ofs += count
+                if fill + count == self.block_size:
+                    self.open = False
+            self.records += 1
+            self.pending += n
+            ret = self.offset
+            self.offset += n
+            if self.pending > self.high_water:
+                self.high_water = self.pending
+            if self.writer is not None and (not self.open or self.writer.settings.flushlogs):
+                self.cond.notify_all()
+        return ret
+
+    def add_rebase_callback(self, callback):
+        '''ask for callback(shift) to be called when the file is opened,
+        so offsets returned by put() before then can be made absolute.
+        Returns False if the file is already open and offsets are
+        already absolute'''
+        with self.cond:
+            if self.logfile is not None:
+                return False
+            self.rebase_callbacks.append(callback)
+        return True
+
+    def ready(self, flush):
+        '''return True if there is data the writer should write now'''
+        if self.logfile is None or self.used == 0:
+            return False
+        return flush or self.used > 1 or not self.open
+
+    def take(self):
+        '''take all blocks holding data for writing, returning a list of
+        (index, length). Called with the lock held'''
+        if self.logfile is None or self.used == 0:
+            return []
+        nblocks = len(self.blocks)
+        self.open = False
+        return [((self.tail + i) % nblocks, self.lengths[(self.tail + i) % nblocks]) for i in range(self.used)]
+
+    def release(self, taken):
+        '''free blocks after they have been written. Called with the lock held'''
+        count = len(taken)
+        self.tail = (self.tail + count) % len(self.blocks)
+        self.used -= count
+        self.pending -= sum([length for (idx, length) in taken])
+        self.cond.notify_all()
+
+    def write(self, taken, fsync_period):
+        '''write taken blocks to the log file, without the lock held'''
+        views = [block_view(self.blocks[idx], length) for (idx, length) in taken]
+        total = sum([length for (idx, length) in taken])
+        fd = self.logfile.fileno()
+        if hasattr(os, 'writev'):
+            done = os.writev(fd, views)
+            self.writes += 1
+            if done < total:
+                # short write, write the rest one block at a time
+                self.logfile.write(b''.join(views)[done:])
+                self.writes += 1
+        else:
+            # no writev() on python2, the writes are still one per block
+            for v in views:
+                self.logfile.write(v)
+                self.writes += 1
+        self.bytes_written += total
+        if fsync_period > 0 and time.time() - self.last_fsync >= fsync_period:
+            os.fsync(fd)
+            self.fsyncs += 1
+            self.last_fsync = time.time()
+
+    def rate(self):
+        '''return bytes/sec written since the last call'''
+        tnow = time.time()
+        dt = tnow - self.last_stats_time
+        if dt <= 0:
+            dt = 1.0
+        ret = (self.bytes_written - self.last_bytes_written) / dt
+        self.last_stats_time = tnow
+        self.last_bytes_written = self.bytes_written
+        return ret
+
+    def __str__(self):
+        return ("%s: %.1f kB/s written=%u writes=%u pending=%u high=%u/%u dropped=%u (%u bytes) fsyncs=%u" %
+                (self.name, self.rate()/1024.0, self.bytes_written, self.writes, self.pending,
+                 self.high_water, len(self.blocks) * self.block_size,
+                 self.dropped, self.dropped_bytes, self.fsyncs))
+
+class MPLogWriter(object):
+    '''thread writing a set of log rings to their files. settings must
+    have flushlogs, logfsync and logoverflow attributes'''
+    def __init__(self, settings):
+        self.settings = settings
+        self.cond = threading.Condition()
+        self.rings = []
+        self.closing = False
+        self.thread = None
+
+    def add_ring(self, name, num_blocks=LOG_NUM_BLOCKS, block_size=LOG_BLOCK_SIZE):
+        '''create a ring for a log file'''
+        ring = MPLogRing(name, self.cond, num_blocks=num_blocks, block_size=block_size)
+        ring.writer = self
+        with self.cond:
+            self.rings.append(ring)
+        return ring
+
+    def open(self, ring, logfile):
+        '''start writing a ring to an open file'''
+        with self.cond:
+            ring.logfile = logfile
+            # we may be appending to an existing log, and records may
+            # have been queued before it was opened
+            shift = os.fstat(logfile.fileno()).st_size
+            ring.offset += shift
+            callbacks = ring.rebase_callbacks
+            ring.rebase_callbacks = []
+            self.cond.notify_all()
+        for callback in callbacks:
+            callback(shift)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='log_writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        '''writer thread'''
+        while True:
+            with self.cond:
+                flush = self.settings.flushlogs or self.closing
+                if not [r for r in self.rings if r.ready(flush)]:
+                    if self.closing:
+                        return
+                    self.cond.wait(LOG_FLUSH_INTERVAL)
+                taken = [(r, r.take()) for r in self.rings]
+            fsync_period = self.settings.logfsync
+            for (ring, blocks) in taken:
+                if blocks:
+                    ring.write(blocks, fsync_period)
+            with self.cond:
+                for (ring, blocks) in taken:
+                    if blocks:
+                        ring.release(blocks)
+
+    def close(self, timeout=2.0):
+        '''write out remaining data and stop the writer thread'''
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def show(self, f):
+        '''write log statistics to file object f'''
+        for r in self.rings:
+            f.write('%s\n' % r)
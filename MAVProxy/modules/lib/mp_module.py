@@ -13,6 +13,11 @@ class MPModule(object):
         self.mpstate = mpstate
         self.name = name
         self.needs_unloading = False
+        # message types passed to mavlink_packet, None for all messages
+        self.message_types = None
+        # per-module mavlink_packet statistics
+        self.packet_calls = 0
+        self.packet_time = 0.0
 
         if description is None:
             self.description = name + " handling"
@@ -110,3 +115,31 @@ class MPModule(object):
 
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
+
+    def add_periodic(self, callback, period, name=None, delay=None):
+        '''call callback every period seconds from the main loop. The timer
+        is cancelled automatically when the module is unloaded'''
+        return self.mpstate.scheduler.add_periodic(callback, period, name=name,
+                                                   owner=self, delay=delay)
+
+    def add_timer(self, callback, delay, name=None):
+        '''call callback once after delay seconds'''
+        return self.mpstate.scheduler.add_timer(callback, delay, name=name, owner=self)
+
+    def subscribe(self, *types):
+        '''only pass messages of the given types to mavlink_packet.
+        A type of '*' subscribes to all messages, which is the default'''
+        if '*' in types:
+            self.message_types = None
+        else:
+            self.message_types = frozenset(types)
+        # ask the link module to rebuild its dispatch table
+        self.mpstate.module_generation += 1
+
+    def has_mavlink_packet(self):
+        '''return True if this module overrides mavlink_packet'''
+        return type(self).mavlink_packet.__func__ is not MPModule.mavlink_packet.__func__
+
+    def has_idle_task(self):
+        '''return True if this module overrides idle_task'''
+        return type(self).idle_task.__func__ is not MPModule.idle_task.__func__
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''
+lightweight profiling of module handlers and main loop stages
+
+Each (category, name) pair, such as ('mavlink_packet', 'map') or
+('stage', 'master_callback'), keeps a call count, total and maximum
+time and a fixed size log-scale histogram of call times, from which
+the mean and p99 are derived. Callers check profiler.enabled before
+taking timestamps, so the cost when disabled is a single attribute
+lookup.
+'''
+
+import math, time, json
+
+# 4 buckets per power of two from 1 usec, covering up to about 16 seconds
+HIST_BUCKETS_PER_OCTAVE = 4
+HIST_NUM_BUCKETS = 24 * HIST_BUCKETS_PER_OCTAVE
+HIST_MIN = 1.0e-6
+
+# how many message types to report per stat
+SLOWEST_TYPES = 5
+
+class MPHistogram(object):
+    '''fixed size histogram of durations in seconds'''
+    def __init__(self):
+        self.buckets = [0] * HIST_NUM_BUCKETS
+
+    def bucket(self, dt):
+        '''return bucket index for a duration'''
+        if dt <= HIST_MIN:
+            return 0
+        b = int(math.log(dt / HIST_MIN, 2) * HIST_BUCKETS_PER_OCTAVE)
+        if b >= HIST_NUM_BUCKETS:
+            b = HIST_NUM_BUCKETS - 1
+        return b
+
+    def bucket_limit(self, b):
+        '''upper limit in seconds of bucket b'''
+        return HIST_MIN * 2.0 ** (float(b+1) / HIST_BUCKETS_PER_OCTAVE)
+
+    def add(self, dt):
+        self.buckets[self.bucket(dt)] += 1
+
+    def percentile(self, pct):
+        '''return upper bound of the given percentile in seconds'''
+        total = sum(self.buckets)
+        if total == 0:
+            return 0
+        target = total * pct / 100.0
+        count = 0
+        for b in range(HIST_NUM_BUCKETS):
+            count += self.buckets[b]
+            if count >= target:
+                return self.bucket_limit(b)
+        return self.bucket_limit(HIST_NUM_BUCKETS-1)
+
+class MPProfileStat(object):
+    '''timing statistics for one handler'''
+    def __init__(self, category, name):
+        self.category = category
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hist = MPHistogram()
+        # message type -> [count, total, max]
+        self.types = {}
+
+    def add(self, dt, mtype=None):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        self.hist.add(dt)
+        if mtype is not None:
+            t = self.types.get(mtype, None)
+            if t is None:
+                t = [0, 0.0, 0.0]
+                self.types[mtype] = t
+            t[0] += 1
+            t[1] += dt
+            if dt > t[2]:
+                t[2] = dt
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return self.total / self.count
+
+    def slowest_types(self, n=SLOWEST_TYPES):
+        '''return list of (mtype, count, total, max), highest total time first'''
+        ret = [(k, v[0], v[1], v[2]) for (k, v) in self.types.items()]
+        ret.sort(key=lambda x: x[2], reverse=True)
+        return ret[:n]
+
+    def to_dict(self):
+        return { 'category' : self.category,
+                 'name' : self.name,
+                 'count' : self.count,
+                 'total' : self.total,
+                 'mean' : self.mean(),
+                 'max' : self.max,
+                 'p99' : self.hist.percentile(99),
+                 'histogram' : self.hist.buckets,
+                 'slowest_types' : [ { 'type' : t[0], 'count' : t[1], 'total' : t[2], 'max' : t[3] }
+                                     for t in self.slowest_types() ] }
+
+class MPProfiler(object):
+    '''collection of profile statistics'''
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+        self.start_time = time.time()
+
+    def start(self):
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stats = {}
+        self.start_time = time.time()
+
+    def record(self, category, name, dt, mtype=None):
+        '''record a call of dt seconds'''
+        key = (category, name)
+        s = self.stats.get(key, None)
+        if s is None:
+            s = MPProfileStat(category, name)
+            self.stats[key] = s
+        s.add(dt, mtype)
+
+    def sorted_stats(self, category=None):
+        '''return stats sorted by total time'''
+        ret = [s for s in self.stats.values() if category is None or s.category == category]
+        ret.sort(key=lambda s: s.total, reverse=True)
+        return ret
+
+    def show(self, f, category=None):
+        '''write a report to file object f'''
+        elapsed = time.time() - self.start_time
+        f.write("Profile over %.1fs (%s)\n" % (elapsed, 'enabled' if self.enabled else 'disabled'))
+        f.write("%-16s %-20s %9s %9s %9s %9s %9s\n" % ("Category", "Name", "Calls", "Total(s)",
+                                                      "Mean(us)", "p99(us)", "Max(us)"))
+        for s in self.sorted_stats(category):
+            f.write("%-16s %-20s %9u %9.3f %9.1f %9.1f %9.1f\n" % (
+                s.category, s.name, s.count, s.total,
+                s.mean()*1.0e6, s.hist.percentile(99)*1.0e6, s.max*1.0e6))
+            for (mtype, count, total, mx) in s.slowest_types():
+                f.write("    %-32s %9u %9.3f %9.1f\n" % (mtype, count, total, mx*1.0e6))
+
+    def save(self, filename):
+        '''save stats as JSON'''
+        d = { 'start_time' : self.start_time,
+              'elapsed' : time.time() - self.start_time,
+              'stats' : [ s.to_dict() for s in self.sorted_stats() ] }
+        f = open(filename, mode='w')
+        json.dump(d, f, indent=2)
+        f.close()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+'''
+receiver for dataflash logs sent over MAVLink
+
+The vehicle sends numbered REMOTE_LOG_DATA_BLOCK messages, each of
+which is ACKed. Gaps in the block numbers are NACKed every
+NACK_INTERVAL seconds until the block arrives, or is abandoned once
+it is ABANDON_BLOCKS behind the newest block or has been NACKed for
+ABANDON_TIME seconds.
+
+Recent blocks are tracked in a ring indexed by block number, holding
+the block number in each slot and its missing/ACK pending flags, so
+no per-block dictionaries or list scans are needed. NACKs are
+scheduled in a heap of deadlines, and gaps too far behind to be
+NACKed are abandoned in one step rather than block by block.
+
+Blocks are written in batches. Blocks following on from the last are
+appended to one buffer, retransmitted blocks are held separately, and
+both are written every FLUSH_INTERVAL seconds or FLUSH_BYTES bytes.
+'''
+
+import array, collections, heapq, time
+
+# block status values of REMOTE_LOG_BLOCK_STATUS
+BLOCK_NACK = 0
+BLOCK_ACK = 1
+
+NACK_INTERVAL = 0.1
+ABANDON_BLOCKS = 200
+ABANDON_TIME = 60
+
+# must be a power of two greater than ABANDON_BLOCKS
+RING_SIZE = 1024
+
+FLUSH_BYTES = 64*1024
+FLUSH_INTERVAL = 0.5
+
+# ring slot flags
+SLOT_MISSING = 1
+SLOT_ACKING = 2
+
+class RemoteLogReceiver(object):
+    '''receive a dataflash log into a file. send_status(block, status)
+    sends a REMOTE_LOG_BLOCK_STATUS'''
+    def __init__(self, filename, send_status, verbose=False):
+        self.filename = filename
+        self.logfile = open(filename, 'w+b')
+        self.send_status = send_status
+        self.verbose = verbose
+
+        self.ring_block = array.array('l', [-1] * RING_SIZE)
+        self.ring_state = bytearray(RING_SIZE)
+        self.ring_first = array.array('d', [0.0] * RING_SIZE)
+        self.ack_queue = collections.deque()
+        # (deadline, block) of missing blocks to NACK
+        self.nack_heap = []
+
+        # write batching
+        self.run = bytearray()
+        self.run_ofs = 0
+        self.scattered = []
+        self.last_flush = time.time()
+
+        # newest block seen
+        self.block_cnt = 0
+        self.download = 0
+        self.missing = 0
+        self.missing_found = 0
+        self.abandoned = 0
+        self.writes = 0
+
+    def write(self, ofs, data):
+        '''queue a block to be written'''
+        end = self.run_ofs + len(self.run)
+        if ofs == end:
+            self.run.extend(data)
+        elif ofs > end:
+            # a gap, start a new run
+            self.flush()
+            self.run_ofs = ofs
+            self.run.extend(data)
+        else:
+            self.scattered.append((ofs, bytearray(data)))
+        if len(self.run) >= FLUSH_BYTES or len(self.scattered) >= 64:
+            self.flush()
+
+    def flush(self):
+        '''write out queued blocks'''
+        if self.run:
+            self.logfile.seek(self.run_ofs)
+            self.logfile.write(self.run)
+            self.run_ofs += len(self.run)
+            self.run = bytearray()
+            self.writes += 1
+        if self.scattered:
+            for (ofs, data) in self.scattered:
+                self.logfile.seek(ofs)
+                self.logfile.write(data)
+            self.writes += len(self.scattered)
+            self.scattered = []
+        self.logfile.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.logfile.close()
+
+    def claim(self, block):
+        '''take the ring slot for a block, abandoning an older missing
+        block in it'''
+        slot = block & (RING_SIZE-1)
+        old = self.ring_block[slot]
+        if old != block:
+            if self.ring_state[slot] & SLOT_MISSING:
+                self.abandon(old, slot)
+            self.ring_block[slot] = block
+            self.ring_state[slot] = 0
+        return slot
+
+    def abandon(self, block, slot):
+        print("DFLogger: Abandoning block (%d)" % (block,))
+        self.ring_state[slot] &= ~SLOT_MISSING
+        self.missing -= 1
+        self.abandoned += 1
+
+    def queue_ack(self, block, slot):
+        if slot is not None:
+            self.ring_state[slot] |= SLOT_ACKING
+        self.ack_queue.append(block)
+
+    def mark_missing(self, first, last, now):
+        '''NACK blocks first to last-1'''
+        if last - first > ABANDON_BLOCKS:
+            # too far behind to ask for
+            skipped = (last - ABANDON_BLOCKS) - first
+            print("DFLogger: Abandoning blocks (%d-%d)" % (first, first + skipped - 1))
+            self.abandoned += skipped
+            first += skipped
+        for block in range(first, last):
+            slot = self.claim(block)
+            self.ring_state[slot] = SLOT_MISSING
+            self.ring_first[slot] = now
+            self.missing += 1
+            heapq.heappush(self.nack_heap, (now, block))
+            if self.verbose:
+                print("DFLogger: setting %d for nacking" % (block,))
+
+    def handle_block(self, block, size, data, now=None):
+        '''handle a received block'''
+        if now is None:
+            now = time.time()
+        self.write(size * block, data[:size])
+        self.download += size
+        slot = block & (RING_SIZE-1)
+        owner = self.ring_block[slot]
+        state = self.ring_state[slot]
+        if owner == block and state & SLOT_MISSING:
+            if self.verbose:
+                print("DFLogger: Received missing block: %d" % (block,))
+            self.ring_state[slot] = state & ~SLOT_MISSING
+            self.missing -= 1
+            self.missing_found += 1
+            if not state & SLOT_ACKING:
+                self.queue_ack(block, slot)
+        elif owner == block and state & SLOT_ACKING:
+            # already ACKing this one, it was probably sent more than once
+            pass
+        elif block < owner:
+            # too old to track, just ACK it
+            self.queue_ack(block, None)
+        else:
+            slot = self.claim(block)
+            self.queue_ack(block, slot)
+            if block - self.block_cnt > 1:
+                self.mark_missing(self.block_cnt + 1, block, now)
+        if self.block_cnt < block:
+            self.block_cnt = block
+
+    def send_acks_and_nacks(self, now=None, max_blocks=10):
+        '''send queued ACKs and due NACKs, at most max_blocks of them'''
+        if now is None:
+            now = time.time()
+        sent = 0
+        while sent < max_blocks:
+            progress = False
+            if self.ack_queue:
+                block = self.ack_queue.popleft()
+                slot = block & (RING_SIZE-1)
+                if self.ring_block[slot] == block:
+                    self.ring_state[slot] &= ~SLOT_ACKING
+                self.send_status(block, BLOCK_ACK)
+                sent += 1
+                progress = True
+            if sent < max_blocks and self.nack_heap and self.nack_heap[0][0] <= now:
+                progress = True
+                (deadline, block) = heapq.heappop(self.nack_heap)
+                slot = block & (RING_SIZE-1)
+                if self.ring_block[slot] != block or not self.ring_state[slot] & SLOT_MISSING:
+                    # received or abandoned since
+                    continue
+                if self.block_cnt - block > ABANDON_BLOCKS or now - self.ring_first[slot] > ABANDON_TIME:
+                    self.abandon(block, slot)
+                    continue
+                if self.verbose:
+                    print("DFLogger: NACKing block (%d)" % (block,))
+                self.send_status(block, BLOCK_NACK)
+                sent += 1
+                heapq.heappush(self.nack_heap, (now + NACK_INTERVAL, block))
+            if not progress:
+                break
+        if now - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+        return sent
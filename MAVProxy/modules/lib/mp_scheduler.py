@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+'''
+timer scheduler for MAVProxy modules
+
+Modules register callbacks with a period or a one-shot delay and are
+only called when they are due, instead of polling time.time() from an
+idle_task() that runs on every pass of the main loop. Timers are kept
+in a heap ordered by deadline.
+'''
+
+import heapq, time
+
+class MPTimer(object):
+    '''a scheduled callback'''
+    def __init__(self, callback, period, deadline, name=None, owner=None):
+        self.callback = callback
+        self.period = period
+        self.deadline = deadline
+        self.owner = owner
+        if name is None:
+            name = getattr(callback, '__name__', str(callback))
+        self.name = name
+        self.cancelled = False
+        self.calls = 0
+
+    def cancel(self):
+        '''stop this timer firing'''
+        self.cancelled = True
+
+    def __str__(self):
+        return "%s period=%s due=%.3f calls=%u" % (self.name, self.period,
+                                                  self.deadline - time.time(), self.calls)
+
+class MPScheduler(object):
+    '''heap based scheduler of periodic and one-shot timers'''
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.calls = 0
+
+    def _push(self, timer):
+        self.seq += 1
+        heapq.heappush(self.heap, (timer.deadline, self.seq, timer))
+
+    def add_periodic(self, callback, period, name=None, owner=None, delay=None):
+        '''call callback() every period seconds. The first call is after
+        delay seconds, defaulting to period'''
+        if period <= 0:
+            raise ValueError("timer period must be positive")
+        if delay is None:
+            delay = period
+        timer = MPTimer(callback, period, time.time() + delay, name=name, owner=owner)
+        self._push(timer)
+        return timer
+
+    def add_timer(self, callback, delay, name=None, owner=None):
+        '''call callback() once after delay seconds'''
+        timer = MPTimer(callback, None, time.time() + delay, name=name, owner=owner)
+        self._push(timer)
+        return timer
+
+    def timer_name(self, timer):
+        '''return name of a timer, including the owning module name'''
+        owner = getattr(timer.owner, 'name', None)
+        if owner is None:
+            return timer.name
+        return "%s.%s" % (owner, timer.name)
+
+    def cancel_owner(self, owner):
+        '''cancel all timers belonging to owner (eg. a module being unloaded)'''
+        for (deadline, seq, timer) in self.heap:
+            if timer.owner is owner:
+                timer.cancel()
+
+    def timers(self):
+        '''return list of active timers, soonest first'''
+        return [t for (d, s, t) in sorted(self.heap) if not t.cancelled]
+
+    def next_deadline(self):
+        '''return time of the next due timer, or None'''
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def run(self, tnow=None, error_fn=None, profiler=None):
+        '''call all timers that are due. Returns number of callbacks made'''
+        if tnow is None:
+            tnow = time.time()
+        if profiler is not None and not profiler.enabled:
+            profiler = None
+        count = 0
+        while self.heap and self.heap[0][0] <= tnow:
+            (deadline, seq, timer) = heapq.heappop(self.heap)
+            if timer.cancelled:
+                continue
+            if timer.period is not None:
+                # reschedule before the call so the callback can cancel
+                # itself. If we have fallen behind don't try to catch up
+                timer.deadline = deadline + timer.period
+                if timer.deadline <= tnow:
+                    timer.deadline = tnow + timer.period
+                self._push(timer)
+            else:
+                timer.cancelled = True
+            timer.calls += 1
+            count += 1
+            if profiler is not None:
+                t0 = time.time()
+            try:
+                timer.callback()
+            except Exception as msg:
+                if error_fn is None:
+                    raise
+                error_fn(timer, msg)
+            if profiler is not None:
+                profiler.record('timer', self.timer_name(timer), time.time() - t0)
+        self.calls += count
+        return count
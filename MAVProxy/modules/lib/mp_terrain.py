@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+'''
+terrain grids for answering TERRAIN_REQUEST messages
+
+A TERRAIN_REQUEST covers 8x7 blocks of 4x4 points, at grid_spacing
+meters apart, starting at the SW corner of the request. The heights
+of all 56 blocks are computed together with one vectorised elevation
+lookup. Grids are cached by (lat, lon, spacing), so a repeated
+request is answered without looking up the terrain again.
+
+Grids can also be computed ahead of time for the grids an autopilot
+will request along a mission. These are found the same way
+AP_Terrain::calculate_grid_info() does.
+'''
+
+import collections, math, time
+
+import numpy
+
+from MAVProxy.modules.lib import mp_util
+
+# a request is GRID_BLOCKS_X blocks east by GRID_BLOCKS_Y blocks north
+GRID_BLOCKS_X = 8
+GRID_BLOCKS_Y = 7
+GRID_BLOCKS = GRID_BLOCKS_X * GRID_BLOCKS_Y
+BLOCK_SIZE = 4
+
+# AP_Terrain grids overlap by one block
+GRID_SPACING_NORTH = (GRID_BLOCKS_Y - 1) * BLOCK_SIZE
+GRID_SPACING_EAST = (GRID_BLOCKS_X - 1) * BLOCK_SIZE
+
+# number of grids cached, and seconds before retrying incomplete grids
+TERRAIN_GRID_CACHE = 256
+TERRAIN_GRID_RETRY = 1.0
+
+# ArduPilot location scaling, meters per 1e-7 degree and inverse
+LOCATION_SCALING_FACTOR = 0.011131884502145034
+LOCATION_SCALING_FACTOR_INV = 89.83204953368922
+
+def gps_offset_array(lat, lon, east, north):
+    '''mp_util.gps_offset() over numpy arrays'''
+    bearing = numpy.arctan2(east, north)
+    distance = numpy.sqrt(east**2 + north**2)
+    lat1 = numpy.radians(lat)
+    lon1 = numpy.radians(lon)
+    dr = distance / mp_util.radius_of_earth
+    lat2 = numpy.arcsin(numpy.sin(lat1)*numpy.cos(dr) +
+                        numpy.cos(lat1)*numpy.sin(dr)*numpy.cos(bearing))
+    lon2 = lon1 + numpy.arctan2(numpy.sin(bearing)*numpy.sin(dr)*numpy.cos(lat1),
+                                numpy.cos(dr)-numpy.sin(lat1)*numpy.sin(lat2))
+    return (numpy.degrees(lat2), mp_util.wrap_valid_longitude(numpy.degrees(lon2)))
+
+def grid_points(lat, lon, spacing):
+    '''return (lats, lons) arrays of shape (GRID_BLOCKS, 16) of the points
+    of each block of a request, indexed by block bit'''
+    bits = numpy.arange(GRID_BLOCKS)
+    block_spacing = spacing * BLOCK_SIZE
+    (blat, blon) = gps_offset_array(lat, lon,
+                                    block_spacing * (bits % GRID_BLOCKS_X) * 1.0,
+                                    block_spacing * (bits // GRID_BLOCKS_X) * 1.0)
+    i = numpy.arange(BLOCK_SIZE*BLOCK_SIZE)
+    east = spacing * (i % BLOCK_SIZE) * 1.0
+    north = spacing * (i // BLOCK_SIZE) * 1.0
+    return gps_offset_array(blat[:,None], blon[:,None], east[None,:], north[None,:])
+
+def longitude_scale(lat_e7):
+    '''ArduPilot longitude_scale()'''
+    return max(math.cos(math.radians(lat_e7 * 1.0e-7)), 0.01)
+
+def grid_corner(lat, lon, spacing):
+    '''return (lat_e7, lon_e7) of the grid an autopilot requests for a
+    location. ArduPilot does this in single precision, so the result
+    may occasionally differ in the last digit'''
+    lat_e7 = int(lat * 1.0e7)
+    lon_e7 = int(lon * 1.0e7)
+    # grids start on integer degrees
+    ref_lat = (lat_e7 // 10000000) * 10000000
+    ref_lon = (lon_e7 // 10000000) * 10000000
+    north = (lat_e7 - ref_lat) * LOCATION_SCALING_FACTOR
+    east = (lon_e7 - ref_lon) * LOCATION_SCALING_FACTOR * longitude_scale(lat_e7)
+    idx_north = int(north / spacing) // GRID_SPACING_NORTH
+    idx_east = int(east / spacing) // GRID_SPACING_EAST
+    dlat = int(idx_north * GRID_SPACING_NORTH * float(spacing) * LOCATION_SCALING_FACTOR_INV)
+    dlon = int(idx_east * GRID_SPACING_EAST * float(spacing) * LOCATION_SCALING_FACTOR_INV / longitude_scale(ref_lat))
+    return (ref_lat + dlat, ref_lon + dlon)
+
+class TerrainGrid:
+    '''terrain heights of one request. data[bit] is the list of 16
+    heights of a block, valid[bit] is False where terrain data was not
+    available'''
+    def __init__(self, data, valid):
+        self.data = data
+        self.valid = valid
+        self.complete = bool(valid.all())
+        self.time = time.time()
+
+class TerrainGridCache:
+    '''LRU cache of terrain grids, keyed by (lat_e7, lon_e7, spacing)'''
+    def __init__(self, elevation, size=TERRAIN_GRID_CACHE):
+        self.elevation = elevation
+        self.size = size
+        self.grids = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.computes = 0
+        self.compute_time = 0.0
+
+    def compute(self, lat_e7, lon_e7, spacing):
+        '''compute the heights of a request'''
+        t0 = time.time()
+        (lats, lons) = grid_points(lat_e7 * 1.0e-7, lon_e7 * 1.0e-7, spacing)
+        alts = self.elevation.GetElevationArray(lats.ravel(), lons.ravel()).reshape(lats.shape)
+        missing = numpy.isnan(alts)
+        valid = ~missing.any(axis=1)
+        alts[missing] = 0
+        grid = TerrainGrid(alts.astype(int).tolist(), valid)
+        self.computes += 1
+        self.compute_time += time.time() - t0
+        return grid
+
+    def get(self, lat_e7, lon_e7, spacing):
+        '''return the TerrainGrid of a request. Incomplete grids are
+        recomputed every TERRAIN_GRID_RETRY seconds'''
+        key = (lat_e7, lon_e7, spacing)
+        grid = self.grids.pop(key, None)
+        if grid is not None and (grid.complete or time.time() - grid.time < TERRAIN_GRID_RETRY):
+            self.hits += 1
+        else:
+            self.misses += 1
+            grid = self.compute(lat_e7, lon_e7, spacing)
+        self.grids[key] = grid
+        while len(self.grids) > self.size:
+            self.grids.popitem(last=False)
+        return grid
+
+    def contains(self, lat_e7, lon_e7, spacing):
+        '''return True if a complete grid is cached'''
+        grid = self.grids.get((lat_e7, lon_e7, spacing), None)
+        return grid is not None and grid.complete
+
+    def __str__(self):
+        ms = 0.0
+        if self.computes:
+            ms = 1000.0 * self.compute_time / self.computes
+        return 'grids=%u hits=%u misses=%u computes=%u compute=%.1fms' % (
+            len(self.grids), self.hits, self.misses, self.computes, ms)
+
+def path_grids(points, spacing):
+    '''return the grid corners an autopilot would request flying along
+    a path of (lat, lon) points'''
+    ret = []
+    seen = set()
+    # sample the path at a quarter of a grid
+    step = spacing * GRID_SPACING_NORTH * 0.25
+    for i in range(len(points)):
+        (lat, lon) = points[i]
+        samples = [(lat, lon)]
+        if i+1 < len(points):
+            (lat2, lon2) = points[i+1]
+            dist = mp_util.gps_distance(lat, lon, lat2, lon2)
+            bearing = mp_util.gps_bearing(lat, lon, lat2, lon2)
+            n = int(dist / step)
+            for j in range(1, n+1):
+                samples.append(mp_util.gps_newpos(lat, lon, bearing, j*step))
+        for (slat, slon) in samples:
+            corner = grid_corner(slat, slon, spacing)
+            if not corner in seen:
+                seen.add(corner)
+                ret.append(corner)
+    return ret
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+'''
+sidecar index for telemetry logs
+
+A tlog is a flat stream of 8 byte timestamps followed by MAVLink
+messages, so finding anything means scanning the whole file. The index
+(FILE.tlog.idx) is written alongside the log and holds periodic
+time->offset checkpoints, the offsets of every message of each type and
+the flight mode change points, so that tools can seek straight to the
+messages they want.
+
+The index is a stream of records appended as the log is written, so it
+remains usable if MAVProxy is killed:
+
+  C  <QQ  checkpoint: usec, offset
+  B  <B name <QI base, count, then count <I offsets relative to base
+  F  <QQ <B name  flight mode change: usec, offset, mode
+  E  <Q  end of the log covered by the records before it
+
+Each flush ends with an E record, and each checkpoint must start where
+the covered part of the log ends. An index is only used if it covers
+the whole log without gaps, so an index started part way through a
+log, a log appended to without indexing or offsets lost when MAVProxy
+was killed all mean a full scan instead.
+'''
+
+import os, struct, bisect
+
+INDEX_MAGIC = 'MPTLOGIX'
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('<8sH')
+
+# seconds of log between checkpoints. Message offsets are also flushed
+# at each checkpoint
+CHECKPOINT_INTERVAL = 1.0
+
+REC_CHECKPOINT = 'C'
+REC_BLOCK = 'B'
+REC_FLIGHTMODE = 'F'
+REC_END = 'E'
+
+def index_filename(logname):
+    '''return the index filename for a tlog'''
+    return logname + '.idx'
+
+def pack_name(name):
+    name = name[:255]
+    return struct.pack('<B', len(name)) + name
+
+class TLogIndexWriter(object):
+    '''build an index while a tlog is written. write is called with
+    each block of index data, eg. the put method of a log ring.
+
+    If based is False the offsets passed in are relative to a log file
+    that has not been opened yet. Records are then held until rebase()
+    is called with the size of the file'''
+    def __init__(self, write, new_file=True, interval=CHECKPOINT_INTERVAL, based=True):
+        self.write = write
+        self.interval = interval
+        self.last_checkpoint = None
+        # type -> (base offset, list of relative offsets)
+        self.pending = {}
+        self.flightmode = None
+        # end of the last message added, and as last written
+        self.end = None
+        self.written_end = None
+        self.held = None if based else []
+        if new_file:
+            self.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION))
+
+    def write_record(self, prefix, offset, suffix=''):
+        '''write a record holding a log offset'''
+        if self.held is not None:
+            self.held.append((prefix, offset, suffix))
+        else:
+            self.write(prefix + struct.pack('<Q', offset) + suffix)
+
+    def rebase(self, shift):
+        '''the log file has been opened with shift bytes already in it'''
+        held = self.held
+        if held is None:
+            return
+        self.held = None
+        for (prefix, offset, suffix) in held:
+            self.write_record(prefix, offset + shift, suffix)
+        for mtype in self.pending.keys():
+            (base, offsets) = self.pending[mtype]
+            self.pending[mtype] = (base + shift, offsets)
+        if self.end is not None:
+            self.end += shift
+        if self.written_end is not None:
+            self.written_end += shift
+
+    def add(self, usec, offset, mtype, size):
+        '''record a message of type mtype logged at offset, with size
+        bytes including the timestamp'''
+        if self.last_checkpoint is None or usec - self.last_checkpoint >= self.interval * 1.0e6:
+            self.flush()
+            self.write_record(REC_CHECKPOINT + struct.pack('<Q', usec), offset)
+            self.last_checkpoint = usec
+        p = self.pending.get(mtype, None)
+        if p is None or offset - p[0] > 0xFFFFFFFF:
+            if p is not None:
+                self.flush_type(mtype)
+            p = (offset, [])
+            self.pending[mtype] = p
+        p[1].append(offset - p[0])
+        self.end = offset + size
+
+    def cover(self, end):
+        '''mark the log up to end as covered without indexing it, eg. for
+        bad data'''
+        if self.end is None or end > self.end:
+            self.end = end
+
+    def set_flightmode(self, usec, offset, mode):
+        '''record a flight mode change'''
+        if mode == self.flightmode or mode is None:
+            return
+        self.flightmode = mode
+        self.write_record(REC_FLIGHTMODE + struct.pack('<Q', usec), offset, pack_name(mode))
+
+    def flush_type(self, mtype):
+        (base, offsets) = self.pending.pop(mtype)
+        self.write_record(REC_BLOCK + pack_name(mtype), base,
+                          struct.pack('<I', len(offsets)) + struct.pack('<%uI' % len(offsets), *offsets))
+
+    def flush(self):
+        '''write out pending message offsets, and how much of the log
+        they cover'''
+        for mtype in self.pending.keys():
+            self.flush_type(mtype)
+        if self.end is not None and self.end != self.written_end:
+            self.write_record(REC_END, self.end)
+            self.written_end = self.end
+
+class TLogIndex(object):
+    '''a loaded tlog index'''
+    def __init__(self, filename):
+        self.filename = filename
+        # list of (usec, offset)
+        self.checkpoints = []
+        # type -> sorted list of offsets
+        self.types = {}
+        # list of (mode, usec, offset)
+        self.flightmodes = []
+        self.flightmode_offsets = []
+        # end of the log covered without gaps, or None if there is a gap
+        self.covered = 0
+        self.load(filename)
+
+    def load(self, filename):
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        if len(data) < INDEX_HEADER.size:
+            raise ValueError("%s: not a tlog index" % filename)
+        (magic, version) = INDEX_HEADER.unpack_from(data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("%s: not a tlog index" % filename)
+        ofs = INDEX_HEADER.size
+        n = len(data)
+        types = {}
+        try:
+            while ofs < n:
+                rtype = data[ofs]
+                ofs += 1
+                if rtype == REC_CHECKPOINT:
+                    (usec, offset) = struct.unpack_from('<QQ', data, ofs)
+                    ofs += 16
+                    self.checkpoints.append((usec, offset))
+                    if offset != self.covered:
+                        # indexing started part way through the log, or
+                        # some of it was not indexed
+                        self.covered = None
+                elif rtype == REC_END:
+                    (end,) = struct.unpack_from('<Q', data, ofs)
+                    ofs += 8
+                    if self.covered is not None:
+                        self.covered = end
+                elif rtype == REC_BLOCK:
+                    nlen = ord(data[ofs])
+                    name = data[ofs+1:ofs+1+nlen]
+                    ofs += 1 + nlen
+                    (base, count) = struct.unpack_from('<QI', data, ofs)
+                    ofs += 12
+                    offsets = struct.unpack_from('<%uI' % count, data, ofs)
+                    ofs += 4*count
+                    if not name in types:
+                        types[name] = []
+                    types[name].extend([base + o for o in offsets])
+                elif rtype == REC_FLIGHTMODE:
+                    (usec, offset) = struct.unpack_from('<QQ', data, ofs)
+                    nlen = ord(data[ofs+16])
+                    name = data[ofs+17:ofs+17+nlen]
+                    if len(name) != nlen:
+                        break
+                    ofs += 17 + nlen
+                    self.flightmodes.append((name, usec, offset))
+                else:
+                    # corrupt, keep what we have
+                    break
+        except struct.error:
+            # truncated trailing record from an interrupted write
+            pass
+        # blocks for different types are interleaved, but each type is in order
+        self.types = types
+        self.checkpoints.sort()
+        self.flightmode_offsets = [f[2] for f in self.flightmodes]
+
+    def covers(self, size):
+        '''return True if the index covers a log of size bytes'''
+        return self.covered == size
+
+    def message_types(self):
+        '''return list of message types in the log'''
+        return sorted(self.types.keys())
+
+    def count(self, mtype):
+        '''return number of messages of a type'''
+        return len(self.types.get(mtype, []))
+
+    def offset_for_time(self, usec):
+        '''return the offset of the last checkpoint at or before usec'''
+        if not self.checkpoints:
+            return 0
+        i = bisect.bisect_right(self.checkpoints, (usec, 0xFFFFFFFFFFFFFFFF))
+        if i == 0:
+            return 0
+        return self.checkpoints[i-1][1]
+
+    def offsets(self, types, start_usec=None, end_usec=None):
+        '''return sorted list of offsets of messages with the given types,
+        optionally limited to a time range (to checkpoint resolution)'''
+        ret = []
+        for t in types:
+            ret.extend(self.types.get(t, []))
+        ret.sort()
+        if start_usec is not None:
+            start = self.offset_for_time(start_usec)
+            ret = ret[bisect.bisect_left(ret, start):]
+        if end_usec is not None:
+            i = bisect.bisect_right(self.checkpoints, (end_usec, 0xFFFFFFFFFFFFFFFF))
+            if i < len(self.checkpoints):
+                ret = ret[:bisect.bisect_left(ret, self.checkpoints[i][1])]
+        return ret
+
+    def flightmode_list(self):
+        '''return list of (mode, start_time, end_time) in seconds, like mavmemlog'''
+        ret = []
+        for i in range(len(self.flightmodes)):
+            (mode, usec, offset) = self.flightmodes[i]
+            if i+1 < len(self.flightmodes):
+                t2 = self.flightmodes[i+1][1] * 1.0e-6
+            elif self.checkpoints:
+                t2 = self.checkpoints[-1][0] * 1.0e-6
+            else:
+                t2 = None
+            ret.append((mode, usec * 1.0e-6, t2))
+        return ret
+
+    def flightmode_at(self, offset):
+        '''return the flight mode in force at a log offset'''
+        i = bisect.bisect_right(self.flightmode_offsets, offset)
+        if i == 0:
+            return None
+        return self.flightmodes[i-1][0]
+
+
+def load_index(logname):
+    '''return a TLogIndex for a tlog, or None if it has no usable index.
+    An index that does not cover the whole log is not usable'''
+    filename = index_filename(logname)
+    if not os.path.exists(filename):
+        return None
+    try:
+        index = TLogIndex(filename)
+        size = os.path.getsize(logname)
+    except (IOError, OSError, ValueError):
+        return None
+    if not index.covers(size):
+        return None
+    return index
+
+def build_index(logname, progress_callback=None):
+    '''index an existing tlog, returning the index filename'''
+    from pymavlink import mavutil
+    mlog = mavutil.mavlink_connection(logname)
+    filename = index_filename(logname)
+    f = open(filename, 'wb')
+    index = TLogIndexWriter(f.write)
+    size = os.path.getsize(logname)
+    last_pct = 0
+    while True:
+        m = mlog.recv_msg()
+        if m is None:
+            break
+        mtype = m.get_type()
+        end = mlog.f.tell()
+        if mtype == 'BAD_DATA':
+            index.cover(end)
+            continue
+        usec = int(m._timestamp * 1.0e6)
+        # the record starts with the timestamp, before the message
+        offset = end - len(m.get_msgbuf()) - 8
+        index.add(usec, offset, mtype, end - offset)
+        index.set_flightmode(usec, offset, mlog.flightmode)
+        pct = (100 * offset) // max(size, 1)
+        if progress_callback is not None and pct != last_pct:
+            progress_callback(pct)
+            last_pct = pct
+    # the whole log has been scanned, including any trailing partial record
+    index.cover(size)
+    index.flush()
+    f.close()
+    return filename
+
+
+class IndexedTLog(object):
+    '''read selected messages from a tlog using its index. This provides
+    the parts of the mavutil log interface used by the log tools'''
+    def __init__(self, logname, index):
+        from pymavlink import mavutil
+        self.mavutil = mavutil
+        self.index = index
+        self.f = open(logname, 'rb')
+        self.mav = mavutil.mavlink.MAVLink(None)
+        self.start_usec = None
+        self.end_usec = None
+        self.offset_list = None
+        self.offset_types = None
+        self.rewind()
+
+    def rewind(self):
+        '''rewind to start'''
+        self.pos = 0
+        self.messages = {}
+        self.params = {}
+        self.flightmode = 'UNKNOWN'
+        self.percent = 0
+        self._timestamp = None
+
+    def set_time_range(self, start=None, end=None):
+        '''limit messages to a time range in seconds'''
+        self.start_usec = None if start is None else int(start * 1.0e6)
+        self.end_usec = None if end is None else int(end * 1.0e6)
+        self.offset_list = None
+
+    def read_message(self, offset):
+        '''read and decode the record at offset'''
+        self.f.seek(offset)
+        hdr = self.f.read(8+3)
+        if len(hdr) < 11:
+            return None
+        (usec,) = struct.unpack('>Q', hdr[:8])
+        if ord(hdr[8]) == 0xFD:
+            mlen = 10 + ord(hdr[9]) + 2
+            if ord(hdr[10]) & 1:
+                mlen += 13
+        else:
+            mlen = 6 + ord(hdr[9]) + 2
+        msgbuf = hdr[8:] + self.f.read(mlen - 3)
+        try:
+            m = self.mav.decode(bytearray(msgbuf))
+        except Exception:
+            return None
+        m._timestamp = usec * 1.0e-6
+        return m
+
+    def recv_match(self, condition=None, type=None, blocking=False):
+        '''return the next message of the given types'''
+        if type is not None and not isinstance(type, list):
+            type = [type]
+        if type is None:
+            type = self.index.message_types()
+        if self.offset_list is None or self.offset_types != type:
+            self.offset_list = self.index.offsets(type, self.start_usec, self.end_usec)
+            self.offset_types = type
+            self.pos = 0
+        while self.pos < len(self.offset_list):
+            offset = self.offset_list[self.pos]
+            self.pos += 1
+            self.percent = (100.0 * self.pos) / len(self.offset_list)
+            m = self.read_message(offset)
+            if m is None:
+                continue
+            usec = int(m._timestamp * 1.0e6)
+            if ((self.start_usec is not None and usec < self.start_usec) or
+                (self.end_usec is not None and usec > self.end_usec)):
+                continue
+            mode = self.index.flightmode_at(offset)
+            if mode is not None:
+                self.flightmode = mode
+            self._timestamp = m._timestamp
+            self.messages[m.get_type()] = m
+            if m.get_type() == 'PARAM_VALUE':
+                self.params[str(m.param_id)] = m.param_value
+            if not self.mavutil.evaluate_condition(condition, self.messages):
+                continue
+            return m
+        return None
+
+    def recv_msg(self):
+        return self.recv_match()
+
+    def check_condition(self, condition):
+        '''check if a condition is true'''
+        return self.mavutil.evaluate_condition(condition, self.messages)
+
+    def flightmode_list(self):
+        return self.index.flightmode_list()
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+'''
+vectorised evaluation of graph expressions
+
+A graph field such as "degrees(ATTITUDE.roll)" or a condition such as
+"GPS_RAW_INT.fix_type >= 3 and VFR_HUD.airspeed > 5" is parsed once,
+and then evaluated with numpy over all the samples of a log held in a
+mavmemlog, instead of once per message with eval().
+
+Each MSG reference is joined to the sample points using the last value
+of that message at or before the sample, the same as the per message
+evaluation sees in mlog.messages. Boolean operators are rewritten to
+numpy logical functions so conditions become masks.
+
+Only expressions using message fields, arithmetic, comparisons and the
+functions in vec_namespace can be vectorised. Anything else (such as
+the stateful mavextra helpers) is left to the per message path.
+'''
+
+import ast, math, re
+import numpy
+
+re_msgname = re.compile('^[A-Z][A-Z0-9_]*$')
+
+def _divide(op):
+    '''return an elementwise division function that gives nan where the
+    divisor is zero, as numpy integer division gives 0 there'''
+    def fn(a, b):
+        b = numpy.asarray(b)
+        zero = (b == 0)
+        return numpy.where(zero, numpy.nan, op(a, numpy.where(zero, 1, b)))
+    return fn
+
+# functions and constants with elementwise numpy equivalents
+vec_namespace = {
+    'sin' : numpy.sin, 'cos' : numpy.cos, 'tan' : numpy.tan,
+    'asin' : numpy.arcsin, 'acos' : numpy.arccos, 'atan' : numpy.arctan,
+    'atan2' : numpy.arctan2, 'sinh' : numpy.sinh, 'cosh' : numpy.cosh,
+    'tanh' : numpy.tanh, 'sqrt' : numpy.sqrt, 'exp' : numpy.exp,
+    'log' : numpy.log, 'log10' : numpy.log10, 'fabs' : numpy.fabs,
+    'abs' : numpy.abs, 'floor' : numpy.floor, 'ceil' : numpy.ceil,
+    'degrees' : numpy.degrees, 'radians' : numpy.radians,
+    'hypot' : numpy.hypot, 'pow' : numpy.power, 'fmod' : numpy.fmod,
+    'pi' : math.pi, 'e' : math.e,
+    'True' : True, 'False' : False, 'None' : None,
+    '_vec_and' : numpy.logical_and,
+    '_vec_or' : numpy.logical_or,
+    '_vec_not' : numpy.logical_not,
+    '_vec_div' : _divide(lambda a, b: a / b),
+    '_vec_floordiv' : _divide(lambda a, b: a // b),
+    '_vec_mod' : _divide(lambda a, b: a % b),
+    }
+
+class VecError(Exception):
+    '''raised when an expression can't be evaluated as arrays'''
+    pass
+
+def _call(name, args, node):
+    '''return a call node for a function in vec_namespace'''
+    call = ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[])
+    if 'starargs' in ast.Call._fields:
+        call.starargs = None
+        call.kwargs = None
+    return ast.copy_location(call, node)
+
+class VecTransformer(ast.NodeTransformer):
+    '''rewrite and/or/not, chained comparisons and division as numpy calls'''
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.And):
+            name = '_vec_and'
+        else:
+            name = '_vec_or'
+        ret = node.values[0]
+        for v in node.values[1:]:
+            ret = _call(name, [ret, v], node)
+        return ret
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return _call('_vec_not', [node.operand], node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        # a < b < c becomes (a < b) and (b < c)
+        terms = []
+        left = node.left
+        for (op, right) in zip(node.ops, node.comparators):
+            terms.append(ast.copy_location(ast.Compare(left=left, ops=[op], comparators=[right]), node))
+            left = right
+        ret = terms[0]
+        for t in terms[1:]:
+            ret = _call('_vec_and', [ret, t], node)
+        return ret
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        ops = { ast.Div : '_vec_div', ast.FloorDiv : '_vec_floordiv', ast.Mod : '_vec_mod' }
+        name = ops.get(type(node.op), None)
+        if name is None:
+            return node
+        return _call(name, [node.left, node.right], node)
+
+    def visit_IfExp(self, node):
+        raise VecError("conditional expression")
+
+    def visit_Subscript(self, node):
+        # would index the sample axis, not the field
+        raise VecError("subscript")
+
+class AlignedMessage(object):
+    '''a message type whose fields are arrays joined to the sample points'''
+    def __init__(self, data, idx):
+        self._data = data
+        self._idx = idx
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            column = self._data[name]
+        except (ValueError, KeyError):
+            raise AttributeError(name)
+        if column.dtype.kind == 'O':
+            raise VecError("field %s is not numeric" % name)
+        return column[self._idx]
+
+class VecExpression(object):
+    '''an expression compiled for evaluation over mavmemlog columns'''
+    def __init__(self, expression):
+        self.expression = expression
+        self.code = None
+        self.msg_names = set()
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+            tree = VecTransformer().visit(tree)
+        except (SyntaxError, VecError):
+            return
+        ast.fix_missing_locations(tree)
+        names = set([n.id for n in ast.walk(tree) if isinstance(n, ast.Name)])
+        for n in names:
+            if n in vec_namespace:
+                continue
+            if not re_msgname.match(n):
+                # a python or mavextra function we can't vectorise
+                return
+            self.msg_names.add(n)
+        self.code = compile(tree, '<expression>', 'eval')
+
+    def vectorizable(self):
+        return self.code is not None
+
+    def evaluate(self, mlog, positions):
+        '''evaluate at the given record positions of a mavmemlog. Returns
+        (values, valid) where valid is a boolean mask of the samples at
+        which every referenced message had been seen'''
+        if self.code is None:
+            raise VecError(self.expression)
+        n = len(positions)
+        valid = numpy.ones(n, dtype=bool)
+        env = {}
+        for name in self.msg_names:
+            tpos = mlog.positions(name)
+            if tpos is None or len(tpos) == 0:
+                # the per message evaluation would get a NameError
+                return (numpy.zeros(n), numpy.zeros(n, dtype=bool))
+            # last value hold join
+            idx = numpy.searchsorted(tpos, positions, side='right') - 1
+            valid &= idx >= 0
+            env[name] = AlignedMessage(mlog.array(name), numpy.maximum(idx, 0))
+        old = numpy.seterr(all='ignore')
+        try:
+            v = eval(self.code, vec_namespace, env)
+        except AttributeError:
+            # an unknown field, which gives None per message too
+            return (numpy.zeros(n), numpy.zeros(n, dtype=bool))
+        except (TypeError, ValueError) as ex:
+            raise VecError("%s: %s" % (self.expression, ex))
+        finally:
+            numpy.seterr(**old)
+        if isinstance(v, AlignedMessage):
+            raise VecError("%s is a message" % self.expression)
+        v = numpy.asarray(v)
+        if v.shape == ():
+            v = numpy.repeat(v, n)
+        if v.shape != (n,):
+            raise VecError("%s: bad shape %s" % (self.expression, str(v.shape)))
+        if v.dtype.kind == 'f':
+            # where the per message evaluation would raise an error
+            valid &= numpy.isfinite(v)
+        return (v, valid)
+
+    def evaluate_condition(self, mlog, positions):
+        '''evaluate a condition as a boolean mask'''
+        (v, valid) = self.evaluate(mlog, positions)
+        if v.dtype.kind not in 'biuf':
+            raise VecError("%s: not a condition" % self.expression)
+        return valid & (v != 0)
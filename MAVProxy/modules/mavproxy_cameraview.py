@@ -23,6 +23,8 @@ from MAVProxy.modules.lib import mp_module
 class CameraViewModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(CameraViewModule, self).__init__(mpstate, "cameraview")
+        self.subscribe('GLOBAL_POSITION_INT', 'ATTITUDE', 'GPS_RAW', 'GPS_RAW_INT',
+                       'SERVO_OUTPUT_RAW')
         self.add_command('cameraview', self.cmd_cameraview, "camera view")
         self.roll = 0
         self.pitch = 0
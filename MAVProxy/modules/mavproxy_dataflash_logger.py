@@ -22,6 +22,7 @@ import errno
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_remotelog
 import time
 from MAVProxy.modules.lib import mp_settings
 
@@ -30,17 +31,21 @@ class dataflash_logger(mp_module.MPModule):
     def __init__(self, mpstate):
         """Initialise module.  We start poking the UAV for messages after this is called"""
         super(dataflash_logger, self).__init__(mpstate, "dataflash_logger", "logging of mavlink dataflash messages")
+        # HEARTBEAT drives the start packets sent until logging begins
+        self.subscribe('REMOTE_LOG_DATA_BLOCK', 'HEARTBEAT')
         self.new_log_started = False
         self.stopped = False
         self.time_last_start_packet_sent = 0
         self.time_last_stop_packet_sent = 0
         self.dataflash_dir = self._dataflash_dir(mpstate)
+        self.receiver = None
 
         self.log_settings = mp_settings.MPSettings(
             [ ('verbose', bool, False),
           ])
         self.add_command('dataflash_logger', self.cmd_dataflash_logger, "dataflash logging control", ['status','start','stop','set (LOGSETTING)'])
         self.add_completion_function('(LOGSETTING)', self.log_settings.completion)
+        self.add_periodic(self.idle_print_status, 10)
 
     def usage(self):
         '''show help on a command line options'''
@@ -53,6 +58,7 @@ class dataflash_logger(mp_module.MPModule):
         elif args[0] == "status":
             print self.status()
         elif args[0] == "stop":
+            self.close_log()
             self.new_log_started = False
             self.stopped = True
         elif args[0] == "start":
@@ -99,92 +105,59 @@ class dataflash_logger(mp_module.MPModule):
         '''open a new dataflash log, reset state'''
         filename = self.new_log_filepath()
 
-        self.block_cnt = 0
-        self.logfile = open(filename, 'w+b')
+        self.close_log()
+        self.receiver = mp_remotelog.RemoteLogReceiver(filename, self.send_block_status,
+                                                       verbose=self.log_settings.verbose)
         print("DFLogger: logging started (%s)" % (filename))
-        self.prev_cnt = 0
-        self.download = 0
         self.prev_download = 0
         self.last_idle_status_printed_time = time.time()
         self.last_status_time = time.time()
-        self.missing_blocks = {}
-        self.acking_blocks = {}
-        self.blocks_to_ack_and_nack = []
-        self.missing_found = 0
-        self.abandoned = 0
+
+    def close_log(self):
+        '''close the current dataflash log'''
+        if self.receiver is not None:
+            self.receiver.close()
+            self.receiver = None
+
+    def send_block_status(self, block, status):
+        self.master.mav.remote_log_block_status_send(block, status)
+
+    def unload(self):
+        self.close_log()
 
     def status(self):
         '''returns information about module'''
-        transfered = self.download - self.prev_download
+        if self.receiver is None:
+            return "DFLogger: %s" % ("Inactive" if self.stopped else "Waiting")
+        r = self.receiver
+        transfered = r.download - self.prev_download
         now = time.time()
         interval = now - self.last_status_time
         self.last_status_time = now
         return("DFLogger: %(state)s Rate(%(interval)ds):%(rate).3fkB/s Block:%(block_cnt)d Missing:%(missing)d Fixed:%(fixed)d Abandoned:%(abandoned)d" %
               {"interval": interval,
                "rate": transfered/(interval*1000),
-               "block_cnt": self.block_cnt,
-               "missing": len(self.missing_blocks),
-               "fixed": self.missing_found,
-               "abandoned": self.abandoned,
+               "block_cnt": r.block_cnt,
+               "missing": r.missing,
+               "fixed": r.missing_found,
+               "abandoned": r.abandoned,
                "state": "Inactive" if self.stopped else "Active"
            })
     def idle_print_status(self):
-        '''print out statistics every 10 seconds from idle loop'''
-        now = time.time()
-        if (now - self.last_idle_status_printed_time) >= 10:
-            print self.status()
-            self.last_idle_status_printed_time = now
-            self.prev_download = self.download
+        '''print out statistics every 10 seconds from the scheduler'''
+        if not self.new_log_started or not self.log_settings.verbose:
+            return
+        print self.status()
+        self.last_idle_status_printed_time = time.time()
+        self.prev_download = self.receiver.download
 
     def idle_send_acks_and_nacks(self):
         '''Send packets to UAV in idle loop'''
-        max_blocks_to_send = 10
-        blocks_sent = 0
-        i=0
-        now = time.time()
-        while i < len(self.blocks_to_ack_and_nack) and blocks_sent < max_blocks_to_send:
-#            print("ACKLIST: %s" % ([x[1] for x in self.blocks_to_ack_and_nack],))
-            stuff = self.blocks_to_ack_and_nack[i]
-
-            [master, block, status, first_sent, last_sent] = stuff
-            if status == 1:
-#                print("DFLogger: ACKing block (%d)" % (block,))
-                self.master.mav.remote_log_block_status_send(block,status)
-                blocks_sent += 1
-                del self.acking_blocks[block]
-                del self.blocks_to_ack_and_nack[i]
-                continue
-
-            if block not in self.missing_blocks:
-                # we've received this block now
-                del self.blocks_to_ack_and_nack[i]
-                continue
-
-            # give up on packet if we have seen one with a much higher
-            # number:
-            if self.block_cnt - block > 200 or \
-               now - first_sent > 60:
-                print("DFLogger: Abandoning block (%d)" % (block,))
-                del self.blocks_to_ack_and_nack[i]
-                del self.missing_blocks[block]
-                self.abandoned += 1
-                continue
-
-            i += 1
-            # only send each nack every-so-often:
-            if last_sent is not None:
-                if now - last_sent < 0.1:
-                    continue
-
-            print("DFLogger: NACKing block (%d)" % (block,))
-            self.master.mav.remote_log_block_status_send(block,status)
-            blocks_sent += 1
-            stuff[4] = now
+        self.receiver.verbose = self.log_settings.verbose
+        self.receiver.send_acks_and_nacks()
 
     def idle_task_started(self):
         '''called in idle task only when logging is started'''
-        if self.log_settings.verbose:
-            self.idle_print_status()
         self.idle_send_acks_and_nacks()
 
     def idle_task(self):
@@ -213,43 +186,7 @@ class dataflash_logger(mp_module.MPModule):
                 self.start_new_log()
                 self.new_log_started = True
             if self.new_log_started == True:
-                size = m.block_size
-                data = ''.join(str(chr(x)) for x in m.data[:size])
-                ofs = size*(m.block_cnt)
-                self.logfile.seek(ofs)
-                self.logfile.write(data)
-
-                if m.block_cnt in self.missing_blocks:
-                    if self.log_settings.verbose:
-                        print("DFLogger: Received missing block: %d" % (m.block_cnt,))
-                    del self.missing_blocks[m.block_cnt]
-                    self.missing_found += 1
-                    self.blocks_to_ack_and_nack.append([self.master,m.block_cnt,1,now,None])
-                    self.acking_blocks[m.block_cnt] = 1
-#                    print("DFLogger: missing blocks: %s" % (str(self.missing_blocks),))
-                else:
-                    # ACK the block we just got:
-                    if m.block_cnt in self.acking_blocks:
-                        # already acking this one; we probably sent
-                        # multiple nacks and received this one
-                        # multiple times
-                        pass
-                    else:
-                        self.blocks_to_ack_and_nack.append([self.master,m.block_cnt,1,now,None])
-                        self.acking_blocks[m.block_cnt] = 1
-                        # NACK any blocks we haven't seen and should have:
-                        if(m.block_cnt - self.block_cnt > 1):
-                            for block in range(self.block_cnt+1, m.block_cnt):
-                                if block not in self.missing_blocks and \
-                                   block not in self.acking_blocks:
-                                    self.missing_blocks[block] = 1
-                                    if self.log_settings.verbose:
-                                        print "DFLogger: setting %d for nacking" % (block,)
-                                    self.blocks_to_ack_and_nack.append([self.master,block,0,now,None])
-                        #print "\nmissed blocks: ",self.missing_blocks
-                    if self.block_cnt < m.block_cnt:
-                        self.block_cnt = m.block_cnt
-                self.download += size
+                self.receiver.handle_block(m.block_cnt, m.block_size, m.data, now)
         elif not self.new_log_started and not self.stopped:
             # send a start packet every second until the other end gets the idea:
             if now - self.time_last_start_packet_sent > 1:
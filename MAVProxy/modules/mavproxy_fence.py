@@ -46,9 +46,10 @@ class FenceModule(mp_module.MPModule):
                                                                                  title='Fence Save',
                                                                                  wildcard='*.fen')),
                                          MPMenuItem('Draw', 'Draw', '# fence draw')])
+        self.add_periodic(self.check_menus, 1.0)
 
-    def idle_task(self):
-        '''called on idle'''
+    def check_menus(self):
+        '''add our menu once the console or map is loaded'''
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -7,10 +7,12 @@
 '''    
 
 from pymavlink import mavutil
-import time, struct, math, sys, fnmatch, traceback
+import time, struct, math, sys, fnmatch, traceback, os
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_framer
+from MAVProxy.modules.lib import mp_tlogindex
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -21,6 +23,10 @@ delayedPackets = frozenset([ 'MISSION_CURRENT', 'SYS_STATUS', 'VFR_HUD',
                   'NAV_CONTROLLER_OUTPUT' ])
 activityPackets = frozenset([ 'HEARTBEAT', 'GPS_RAW_INT', 'GPS_RAW', 'GLOBAL_POSITION_INT', 'SYS_STATUS' ])
 
+# largest batch of frames written to an output in one go with fastfwd,
+# chosen to keep UDP datagrams under a typical MTU
+FAST_FWD_MAX_BYTES = 1400
+
 class LinkModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
@@ -33,6 +39,19 @@ class LinkModule(mp_module.MPModule):
         self.no_fwd_types.add("BAD_DATA")
         self.add_completion_function('(SERIALPORT)', self.complete_serial_ports)
         self.add_completion_function('(LINKS)', self.complete_links)
+        # message type -> list of modules wanting that type
+        self.dispatch_table = {}
+        self.dispatch_generation = -1
+        # lookup tables for raw frame forwarding
+        self.crc_extra = mp_framer.crc_extra_map(mavutil.mavlink)
+        self.msgids = mp_framer.msgid_map(mavutil.mavlink)
+        self.msginfo = mp_framer.message_info_map(mavutil.mavlink)
+        self.delayed_msgids = self.type_ids(delayedPackets)
+        # messages handle_msec_timestamp() uses to decide if a link is delayed
+        self.msec_msgids = set([msgid for (msgid, info) in self.msginfo.items()
+                                if 'time_boot_ms' in info.layout and info.name != 'GLOBAL_POSITION_INT'])
+        self.fwd_frames = 0
+        self.fwd_writes = 0
 
         self.menu_added_console = False
         if mp_util.has_wxpython:
@@ -101,6 +120,15 @@ class LinkModule(mp_module.MPModule):
                                                                                       linkdelay,
                                                                                       master.mav_loss,
                                                                                       master.packet_loss()))
+            framer = getattr(master, 'framer', None)
+            if self.mpstate.settings.fastfwd and framer is not None:
+                print("  fastfwd: %u frames %u bad crc %u unknown %u skipped bytes" % (framer.frames,
+                                                                                    framer.bad_crc,
+                                                                                    framer.unknown,
+                                                                                    framer.skipped_bytes))
+        if self.mpstate.settings.fastfwd:
+            print("fastfwd: %u frames forwarded in %u writes" % (self.fwd_frames, self.fwd_writes))
+
     def cmd_link_list(self):
         '''list links'''
         print("%u links" % len(self.mpstate.mav_master))
@@ -133,6 +161,7 @@ class LinkModule(mp_module.MPModule):
         conn.highest_msec = 0
         self.mpstate.mav_master.append(conn)
         self.status.counters['MasterIn'].append(0)
+        self.mpstate.register_master(conn)
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -166,6 +195,7 @@ class LinkModule(mp_module.MPModule):
                         mp_util.child_fd_list_remove(conn.port.fileno())
                     except Exception:
                         pass
+                    self.mpstate.unregister_master(conn)
                     self.mpstate.mav_master[i].close()
                 except Exception as msg:
                     print(msg)
@@ -178,6 +208,119 @@ class LinkModule(mp_module.MPModule):
                     conn.linknum = j
                 return
 
+    def dispatch_list(self, mtype):
+        '''return the list of modules subscribed to a message type, in
+        module load order'''
+        if self.dispatch_generation != self.mpstate.module_generation:
+            self.dispatch_table = {}
+            self.dispatch_generation = self.mpstate.module_generation
+        mods = self.dispatch_table.get(mtype, None)
+        if mods is None:
+            mods = []
+            for (mod,pm) in self.mpstate.modules:
+                if not mod.has_mavlink_packet():
+                    continue
+                if mod.message_types is None or mtype in mod.message_types:
+                    mods.append(mod)
+            self.dispatch_table[mtype] = mods
+        return mods
+
+    def type_ids(self, types):
+        '''return a set of msgids for a list of message type names'''
+        return set([self.msgids[t] for t in types if t in self.msgids])
+
+    def get_framer(self, master):
+        '''return the raw frame splitter for a link'''
+        framer = getattr(master, 'framer', None)
+        if framer is None:
+            framer = mp_framer.MAVFramer(self.crc_extra, mavlink09=not master.mavlink10())
+            master.framer = framer
+        return framer
+
+    def forward_raw(self, master, buf):
+        '''forward the valid MAVLink frames in buf from master to all
+        outputs without decoding them'''
+        self.forward_frames(master, self.get_framer(master).feed(buf))
+
+    def forward_frames(self, master, frames):
+        '''forward a list of raw frames to all outputs, using one write
+        per output per batch of frames. This runs before the frames are
+        parsed, so whether the link is delayed is worked out for each
+        frame as handle_msec_timestamp() will find it'''
+        profiler = self.mpstate.profiler
+        profiling = profiler.enabled
+        if profiling:
+            t0 = time.time()
+        no_fwd = self.type_ids(self.no_fwd_types)
+        if not self.mpstate.settings.mavfwd_rate:
+            # see master_callback for why we don't pass these along
+            no_fwd.add(mavutil.mavlink.MAVLINK_MSG_ID_REQUEST_DATA_STREAM)
+        sysid_outputs = self.mpstate.sysid_outputs
+        delayed = master.link_delayed
+        multiple_links = len(self.mpstate.mav_master) > 1
+        highest_msec = self.status.highest_msec
+        master_msec = master.highest_msec
+
+        batches = []
+        batch = []
+        batch_len = 0
+        for f in frames:
+            if f.msgid in self.msec_msgids:
+                msec = self.msginfo[f.msgid].frame_field(f, 'time_boot_ms')
+                if msec + 30000 < master_msec:
+                    # time has wrapped
+                    highest_msec = msec
+                    delayed = False
+                else:
+                    highest_msec = max(highest_msec, msec)
+                    delayed = msec < highest_msec and multiple_links
+                master_msec = msec
+            if f.msgid in no_fwd or f.sysid in sysid_outputs:
+                continue
+            if delayed and f.msgid in self.delayed_msgids:
+                continue
+            if f.msgid == mavutil.mavlink.MAVLINK_MSG_ID_HEARTBEAT and f.compid == mavutil.mavlink.MAV_COMP_ID_GIMBAL:
+                continue
+            if batch_len + len(f.buf) > FAST_FWD_MAX_BYTES and batch:
+                batches.append(str(bytearray().join(batch)))
+                batch = []
+                batch_len = 0
+            batch.append(f.buf)
+            batch_len += len(f.buf)
+            self.fwd_frames += 1
+        if batch:
+            batches.append(str(bytearray().join(batch)))
+        for r in self.mpstate.mav_outputs:
+            for b in batches:
+                r.write(b)
+                self.fwd_writes += 1
+        if profiling:
+            profiler.record('stage', 'fast_forward', time.time() - t0)
+
+    def lazy_parse(self, master, buf):
+        '''split buf into frames and pass them to master_callback as
+        LazyMessage objects, which are only decoded if a handler reads a
+        field that can't be read straight from the payload. This replaces
+        master.mav.parse_buffer() when lazydecode is set'''
+        framer = self.get_framer(master)
+        bad_crc = framer.bad_crc
+        frames = framer.feed(buf)
+        # bad frames would have been BAD_DATA messages from pymavlink
+        self.status.mav_error += framer.bad_crc - bad_crc
+        if self.mpstate.settings.fastfwd and self.mpstate.mav_outputs:
+            self.forward_frames(master, frames)
+        msgs = []
+        mav = master.mav
+        for f in frames:
+            info = self.msginfo.get(f.msgid, None)
+            if info is None:
+                continue
+            m = mp_framer.LazyMessage(f, info, mav)
+            mav.total_packets_received += 1
+            self.master_callback(m, master)
+            msgs.append(m)
+        return msgs
+
     def get_usec(self):
         '''time since 1970 in microseconds'''
         return int(time.time() * 1.0e6)
@@ -192,7 +335,45 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(str(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.log_message(m, usec)
+
+    def get_tlog_index(self):
+        '''return the index writer for the telemetry log, opening it if
+        needed. This is kept in mpstate so it survives a module reload'''
+        if self.mpstate.tlog_index is None:
+            logfile = getattr(self.mpstate, 'logfile', None)
+            if logfile is None:
+                return None
+            filename = mp_tlogindex.index_filename(logfile.name)
+            new_file = not os.path.exists(filename) or os.path.getsize(filename) == 0
+            # the index is written by the log writer thread too
+            ring = self.mpstate.logwriter.add_ring('index')
+            self.mpstate.logwriter.open(ring, open(filename, 'ab', 0))
+            index = mp_tlogindex.TLogIndexWriter(ring.put, new_file=new_file, based=False)
+            # offsets of records queued before the tlog is opened are
+            # made absolute when it is
+            if not self.mpstate.logqueue.add_rebase_callback(index.rebase):
+                index.rebase(0)
+            self.mpstate.tlog_index = index
+        return self.mpstate.tlog_index
+
+    def log_message(self, m, usec, master=None):
+        '''add a message to the telemetry log, and to the log index if enabled'''
+        data = str(struct.pack('>Q', usec) + m.get_msgbuf())
+        offset = self.mpstate.logqueue.put(data)
+        if offset is None or not self.mpstate.settings.tlogindex:
+            return
+        index = self.get_tlog_index()
+        if index is None:
+            return
+        index.add(usec, offset, m.get_type(), len(data))
+        if master is not None and master == self.mpstate.master():
+            index.set_flightmode(usec, offset, master.flightmode)
+
+    def unload(self):
+        '''write out the pending part of the log index'''
+        if self.mpstate.tlog_index is not None:
+            self.mpstate.tlog_index.flush()
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -241,6 +422,17 @@ class LinkModule(mp_module.MPModule):
 
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
+        profiler = self.mpstate.profiler
+        if profiler.enabled:
+            t0 = time.time()
+            self.process_message(m, master)
+            profiler.record('stage', 'master_callback', time.time() - t0, m.get_type())
+        else:
+            self.process_message(m, master)
+
+    def process_message(self, m, master):
+        '''process mavlink message m on master'''
+        profiler = self.mpstate.profiler
 
         # see if it is handled by a specialised sysid connection
         sysid = m.get_srcSystem()
@@ -256,11 +448,16 @@ class LinkModule(mp_module.MPModule):
 
         # and log them
         if mtype not in dataPackets and self.mpstate.logqueue:
+            profiling = profiler.enabled
+            if profiling:
+                t0 = time.time()
             # put link number in bottom 2 bits, so we can analyse packet
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(str(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.log_message(m, usec, master)
+            if profiling:
+                profiler.record('stage', 'log_enqueue', time.time() - t0)
 
         # keep the last message of each type around
         self.status.msgs[m.get_type()] = m
@@ -411,15 +608,22 @@ class LinkModule(mp_module.MPModule):
             # pass messages along to listeners, except for REQUEST_DATA_STREAM, which
             # would lead a conflict in stream rate setting between mavproxy and the other
             # GCS
-            if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
+            # with fastfwd the raw frames have already been forwarded
+            if self.mpstate.settings.fastfwd:
+                pass
+            elif self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if not mtype in self.no_fwd_types:
+                    profiling = profiler.enabled
+                    if profiling:
+                        t0 = time.time()
                     for r in self.mpstate.mav_outputs:
                         r.write(m.get_msgbuf())
+                    if profiling:
+                        profiler.record('stage', 'output_forward', time.time() - t0, mtype)
 
-            # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            # pass to modules subscribed to this message type
+            for mod in self.dispatch_list(mtype):
+                t0 = time.time()
                 try:
                     mod.mavlink_packet(m)
                 except Exception as msg:
@@ -429,6 +633,11 @@ class LinkModule(mp_module.MPModule):
                         exc_type, exc_value, exc_traceback = sys.exc_info()
                         traceback.print_exception(exc_type, exc_value, exc_traceback,
                                                   limit=2, file=sys.stdout)
+                dt = time.time() - t0
+                mod.packet_calls += 1
+                mod.packet_time += dt
+                if profiler.enabled:
+                    profiler.record('mavlink_packet', mod.name, dt, mtype)
 
 def init(mpstate):
     '''initialise module'''
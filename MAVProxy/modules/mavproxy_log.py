@@ -4,23 +4,28 @@
 import time, os
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_logdownload
 
 class LogModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
-        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
+        self.subscribe('LOG_ENTRY', 'LOG_DATA')
+        self.add_command('log', self.cmd_log, "log file handling", ['<download|download-all|status|erase|resume|cancel|list>',
+                                                                    'set (LOGSETTING)'])
+        self.log_settings = mp_settings.MPSettings(
+            [ ('window', int, mp_logdownload.LOG_WINDOW_MAX) ])
+        self.add_completion_function('(LOGSETTING)', self.log_settings.completion)
         self.reset()
 
     def reset(self):
-        self.download_set = set()
-        self.download_file = None
+        self.download = None
         self.download_lognum = None
-        self.download_filename = None
-        self.download_start = None
-        self.download_last_timestamp = None
-        self.download_ofs = 0
-        self.retries = 0
+        # (log_num, filename) of logs waiting to be downloaded
+        self.download_queue = []
         self.entries = {}
+        # (log_num, filename, time) of a download waiting for its LOG_ENTRY
+        self.entry_wait = None
 
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
@@ -36,118 +41,120 @@ class LogModule(mp_module.MPModule):
         else:
             tstring = time.ctime(m.time_utc)
         self.entries[m.id] = m
+        if self.entry_wait is not None:
+            (log_num, filename, t) = self.entry_wait
+            if m.id == log_num:
+                # the size of a log asked for without a log list
+                self.entry_wait = None
+                if not self.log_download(log_num, filename):
+                    self.next_download()
+                return
         print("Log %u  numLogs %u lastLog %u size %u %s" % (m.id, m.num_logs, m.last_log_num, m.size, tstring))
 
 
     def handle_log_data(self, m):
         '''handling incoming log data'''
-        if self.download_file is None:
+        if self.download is None or m.id != self.download_lognum:
             return
-        # lose some data
-        # import random
-        # if random.uniform(0,1) < 0.05:
-        #    print('dropping ', str(m))
-        #    return
-        if m.ofs != self.download_ofs:
-            self.download_file.seek(m.ofs)
-            self.download_ofs = m.ofs
-        if m.count != 0:
-            data = m.data[:m.count]
-            s = ''.join(str(chr(x)) for x in data)
-            self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
-            self.download_ofs += m.count
-        self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
-            dt = time.time() - self.download_start
-            self.download_file.close()
-            size = os.path.getsize(self.download_filename)
-            speed = size / (1000.0 * dt)
+        self.download.handle_data(m.ofs, m.count, m.data)
+        if self.download.complete():
             print("Finished downloading %s (%u bytes %u seconds, %.1f kbyte/sec %u retries)" % (
-                self.download_filename,
-                size,
-                dt, speed,
-                self.retries))
-            self.download_file = None
-            self.download_filename = None
-            self.download_set = set()
-
-    def handle_log_data_missing(self):
-        '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
-            return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
-            self.master.mav.log_request_data_send(self.target_system,
-                                                       self.target_component,
-                                                       self.download_lognum, (1 + highest) * 90, 0xffffffff)
-            self.retries += 1
-        else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(self.target_system,
-                                                           self.target_component,
-                                                           self.download_lognum, start * 90, (end + 1 - start) * 90)
-                num_requests += 1
-                self.retries += 1
-                if len(diff) == 0:
-                    break
-
+                self.download.filename,
+                self.download.size,
+                self.download.elapsed(),
+                self.download.speed(),
+                self.download.retries))
+            self.download = None
+            self.next_download()
+
+    def send_log_request(self, ofs, count):
+        '''request a range of the log being downloaded'''
+        self.master.mav.log_request_data_send(self.target_system,
+                                              self.target_component,
+                                              self.download_lognum, ofs, count)
 
     def log_status(self):
         '''show download status'''
-        if self.download_filename is None:
+        if self.download is None:
             print("No download")
             return
-        dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
-        m = self.entries.get(self.download_lognum, None)
-        if m is None:
-            size = 0
-        else:
+        print("Downloading %s - %s" % (self.download.filename, self.download.status()))
+        if self.download_queue:
+            print("%u logs queued" % len(self.download_queue))
+
+    def log_download(self, log_num, filename, size_known=True):
+        '''download a log file, returning False if it is already downloaded.
+        If the log size isn't known from a log list its LOG_ENTRY is
+        asked for first, as without the size a download can't be
+        resumed or skipped. size_known=False downloads without it'''
+        if self.download is not None:
+            self.download.close()
+            self.download = None
+        m = self.entries.get(log_num, None)
+        size = None
+        if m is not None:
             size = m.size
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        print("Downloading %s - %u/%u bytes %.1f kbyte/s (%u retries %u missing)" % (self.download_filename,
-                                                                                     os.path.getsize(self.download_filename),
-                                                                                     size,
-                                                                                     speed,
-                                                                                     self.retries,
-                                                                                     len(diff)))
-
-    def log_download(self, log_num, filename):
-        '''download a log file'''
-        print("Downloading log %u as %s" % (log_num, filename))
+            if mp_logdownload.log_downloaded(filename, size):
+                print("Log %u already downloaded as %s" % (log_num, filename))
+                return False
+        elif size_known:
+            self.entry_wait = (log_num, filename, time.time())
+            self.master.mav.log_request_list_send(self.target_system,
+                                                  self.target_component,
+                                                  log_num, log_num)
+            return True
         self.download_lognum = log_num
-        self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(self.target_system,
-                                                   self.target_component,
-                                                   log_num, 0, 0xFFFFFFFF)
-        self.download_filename = filename
-        self.download_set = set()
-        self.download_start = time.time()
-        self.download_last_timestamp = time.time()
-        self.download_ofs = 0
-        self.retries = 0
+        self.download = mp_logdownload.LogDownload(filename, size, self.send_log_request,
+                                                   window=self.log_settings.window)
+        if self.download.resumed:
+            print("Resuming log %u as %s (%u bytes already downloaded)" % (
+                log_num, filename, self.download.received_bytes))
+        else:
+            print("Downloading log %u as %s" % (log_num, filename))
+        self.download.start()
+        if self.download.complete():
+            self.download = None
+        return True
+
+    def next_download(self):
+        '''start the next queued download'''
+        while self.download is None and self.entry_wait is None and self.download_queue:
+            (log_num, filename) = self.download_queue.pop(0)
+            self.log_download(log_num, filename)
+
+    def queue_downloads(self, log_nums, directory):
+        '''download a list of logs into a directory, one at a time'''
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        for log_num in sorted(set(log_nums)):
+            self.download_queue.append((log_num, os.path.join(directory, "log%u.bin" % log_num)))
+        print("Queued %u logs" % len(self.download_queue))
+        if self.download is None:
+            self.next_download()
+
+    def parse_log_range(self, arg):
+        '''parse a list of log numbers like 3-7,9'''
+        ret = []
+        for a in arg.split(','):
+            if '-' in a:
+                (first, last) = a.split('-', 1)
+                ret.extend(range(int(first), int(last)+1))
+            else:
+                ret.append(int(a))
+        return ret
 
     def cmd_log(self, args):
         '''log commands'''
         if len(args) < 1:
-            print("usage: log <list|download|erase|resume|status|cancel>")
+            print("usage: log <list|download|download-all|erase|resume|status|cancel|set>")
             return
 
         if args[0] == "status":
             self.log_status()
-        if args[0] == "list":
+        if args[0] == "set":
+            self.log_settings.command(args[1:])
+        elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
             self.master.mav.log_request_list_send(self.target_system,
                                                        self.target_component,
                                                        0, 0xffff)
@@ -161,13 +168,36 @@ class LogModule(mp_module.MPModule):
                                                       self.target_component)
 
         elif args[0] == "cancel":
-            if self.download_file is not None:
-                self.download_file.close()
+            if self.download is not None:
+                self.download.close()
+                print("Saved partial download of %s" % self.download.filename)
             self.reset()
 
+        elif args[0] == "download-all":
+            if len(self.entries.keys()) == 0:
+                print("Please use log list first")
+                return
+            if len(args) > 1:
+                directory = args[1]
+            else:
+                directory = ''
+            self.queue_downloads(self.entries.keys(), directory)
+
         elif args[0] == "download":
             if len(args) < 2:
-                print("usage: log download <lognumber> <filename>")
+                print("usage: log download <lognumber|latest|first-last> <filename|directory>")
+                return
+            if '-' in args[1] or ',' in args[1]:
+                try:
+                    log_nums = self.parse_log_range(args[1])
+                except ValueError:
+                    print("Bad log range %s" % args[1])
+                    return
+                if len(args) > 2:
+                    directory = args[2]
+                else:
+                    directory = ''
+                self.queue_downloads(log_nums, directory)
                 return
             if args[1] == 'latest':
                 if len(self.entries.keys()) == 0:
@@ -182,11 +212,22 @@ class LogModule(mp_module.MPModule):
                 filename = "log%u.bin" % log_num
             self.log_download(log_num, filename)
 
+    def unload(self):
+        '''save the state of a partial download'''
+        if self.download is not None:
+            self.download.close()
+
     def idle_task(self):
         '''handle missing log data'''
-        if self.download_last_timestamp is not None and time.time() - self.download_last_timestamp > 0.7:
-            self.download_last_timestamp = time.time()
-            self.handle_log_data_missing()
+        if self.download is not None:
+            self.download.update()
+        if self.entry_wait is not None:
+            (log_num, filename, t) = self.entry_wait
+            if time.time() - t > mp_logdownload.LOG_ENTRY_TIMEOUT:
+                print("No LOG_ENTRY for log %u, downloading without its size" % log_num)
+                self.entry_wait = None
+                if not self.log_download(log_num, filename, size_known=False):
+                    self.next_download()
 
 def init(mpstate):
     '''initialise module'''
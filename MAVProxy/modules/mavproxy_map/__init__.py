@@ -7,6 +7,7 @@ June 2012
 
 import sys, os, math
 import functools
+import threading
 import time
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.lib import mp_util
@@ -18,6 +19,9 @@ from pymavlink import mavutil
 class MapModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(MapModule, self).__init__(mpstate, "map", "map display", public = True)
+        self.subscribe('HEARTBEAT', 'SIMSTATE', 'AHRS2', 'AHRS3', 'GPS_RAW_INT',
+                       'GPS2_RAW', 'GLOBAL_POSITION_INT', 'LOCAL_POSITION_NED',
+                       'NAV_CONTROLLER_OUTPUT', 'ADSB_VEHICLE')
         self.lat = None
         self.lon = None
         self.heading = 0
@@ -39,8 +43,7 @@ class MapModule(mp_module.MPModule):
         self.have_global_position = False
         self.vehicle_type_name = 'plane'
         self.ElevationMap = mp_elevation.ElevationModel()
-        self.last_unload_check_time = time.time()
-        self.unload_check_interval = 0.1 # seconds
+        self.add_periodic(self.check_updates, 0.1)
         self.map_settings = mp_settings.MPSettings(
             [ ('showgpspos', int, 0),
               ('showgps2pos', int, 1),
@@ -51,16 +54,28 @@ class MapModule(mp_module.MPModule):
               ('rallycircle', bool, False),
               ('loitercircle',bool, False)])
         service='OviHybrid'
+        if 'MAP_SERVICE_URL' in os.environ:
+            # the Custom tile service, see mp_tile.py
+            service = 'Custom'
         if 'MAP_SERVICE' in os.environ:
             service = os.environ['MAP_SERVICE']
+        tile_store = 'dir'
+        if 'MAP_TILESTORE' in os.environ:
+            tile_store = os.environ['MAP_TILESTORE']
         import platform
         from MAVProxy.modules.mavproxy_map import mp_slipmap
-        mpstate.map = mp_slipmap.MPSlipMap(service=service, elevation=True, title='Map')
+        mpstate.map = mp_slipmap.MPSlipMap(service=service, elevation=True, title='Map',
+                                           tile_store=tile_store)
+        self.service = service
+        self.tile_store = tile_store
+        self.seeders = None
         mpstate.map_functions = { 'draw_lines' : self.draw_lines }
     
         mpstate.map.add_callback(functools.partial(self.map_callback))
         self.add_command('map', self.cmd_map, "map control", ['icon',
-                                      'set (MAPSETTING)'])
+                                      'set (MAPSETTING)',
+                                      'seed <mission|fence|estimate|status|stop>',
+                                      'status'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
         self.default_popup = MPMenuSubMenu('Popup', items=[])
@@ -113,8 +128,109 @@ class MapModule(mp_module.MPModule):
             self.mpstate.map.add_object(mp_slipmap.SlipBrightness(self.map_settings.brightness))
         elif args[0] == "sethome":
             self.cmd_set_home(args)
+        elif args[0] == "seed":
+            self.cmd_seed(args[1:])
+        elif args[0] == "status":
+            print(self.mpstate.map.queue_status())
         else:
-            print("usage: map <icon|set>")
+            print("usage: map <icon|set|seed|status>")
+
+    def seed_area(self, area, buffer):
+        '''return a SeedArea for the map seed command'''
+        from MAVProxy.modules.mavproxy_map import mp_seed
+        if area == 'mission':
+            points = self.module('wp').wploader.polygon()
+            return mp_seed.SeedArea(points, buffer=buffer, closed=False)
+        if area == 'fence':
+            points = self.module('fence').fenceloader.polygon()
+            return mp_seed.SeedArea(points, buffer=buffer)
+        if os.path.exists(area):
+            return mp_seed.SeedArea(mp_util.polygon_load(area), buffer=buffer)
+        (lat1, lon1, lat2, lon2) = mp_seed.parse_bbox(area)
+        return mp_seed.bbox_area(lat1, lon1, lat2, lon2, buffer=buffer)
+
+    def cmd_seed(self, args):
+        '''seed the tile and SRTM caches for offline use'''
+        usage = "usage: map seed [estimate] <mission|fence|POLYGONFILE|LAT1,LON1,LAT2,LON2> [BUFFER] [MINZOOM] [MAXZOOM]\n       map seed <status|stop>"
+        if len(args) == 0:
+            print(usage)
+            return
+        if args[0] == 'status':
+            if self.seeders is None:
+                print("No map seed running")
+            for s in (self.seeders or []):
+                print(s)
+            return
+        if args[0] == 'stop':
+            for s in (self.seeders or []):
+                s.cancelled = True
+            return
+        estimate_only = args[0] == 'estimate'
+        if estimate_only:
+            args = args[1:]
+        if len(args) == 0:
+            print(usage)
+            return
+        if self.seeders is not None and not estimate_only:
+            print("map seed already running")
+            return
+        try:
+            buffer = float(args[1]) if len(args) > 1 else 500.0
+            min_zoom = int(args[2]) if len(args) > 2 else 10
+            max_zoom = int(args[3]) if len(args) > 3 else 17
+            area = self.seed_area(args[0], buffer)
+        except Exception as ex:
+            print("map seed: %s" % ex)
+            print(usage)
+            return
+        from MAVProxy.modules.mavproxy_map import mp_seed, mp_tile
+        mt = mp_tile.MPTile(service=self.service, tile_store=self.tile_store, tile_delay=0)
+        seeders = [mp_seed.TileSeeder(mt, area, min_zoom, max_zoom),
+                   mp_seed.SRTMSeeder(self.ElevationMap.downloader, area)]
+        if not estimate_only:
+            # set before the thread starts so status and stop work
+            # during the estimate, and a second seed is refused
+            self.seeders = seeders
+        t = threading.Thread(target=self.seed_thread, args=(mt, seeders, estimate_only), name='map_seed')
+        t.daemon = True
+        t.start()
+
+    def seed_progress(self, seeder):
+        print("map seed: %s" % seeder)
+
+    def seed_thread(self, mt, seeders, estimate_only):
+        '''run a map seed in the background'''
+        from MAVProxy.modules.mavproxy_map import mp_seed
+        (tiles, srtm) = seeders
+        try:
+            (total, missing, nbytes) = tiles.estimate()
+            if tiles.cancelled:
+                print("map seed cancelled")
+                return
+            print("map seed: %u tiles, %u to fetch (about %s)" % (total, missing, mp_seed.format_bytes(nbytes)))
+            if srtm.wait_filelist():
+                (total, missing, nbytes) = srtm.estimate()
+                print("map seed: %u SRTM files, %u to fetch (about %s)" % (total, missing, mp_seed.format_bytes(nbytes)))
+            elif srtm.cancelled:
+                print("map seed cancelled")
+                return
+            else:
+                print("map seed: SRTM file list unavailable")
+                srtm = None
+            if estimate_only:
+                return
+            if srtm is not None:
+                srtm_thread = threading.Thread(target=srtm.run, name='map_seed_srtm')
+                srtm_thread.daemon = True
+                srtm_thread.start()
+            tiles.run(progress=self.seed_progress, interval=10)
+            if srtm is not None:
+                srtm_thread.join()
+            print("map seed done: %s" % ', '.join([str(s) for s in (tiles, srtm) if s is not None]))
+        finally:
+            mt.close()
+            if not estimate_only:
+                self.seeders = None
     
     def display_waypoints(self):
         '''display the waypoints'''
@@ -324,17 +440,13 @@ class MapModule(mp_module.MPModule):
     
     def unload(self):
         '''unload module'''
+        # a running seed stops and commits the tiles it has fetched
+        for s in (self.seeders or []):
+            s.cancelled = True
         self.mpstate.map.close()
         self.mpstate.map = None
         self.mpstate.map_functions = {}
     
-    def idle_task(self):
-        now = time.time()
-        if self.last_unload_check_time + self.unload_check_interval < now:
-            self.last_unload_check_time = now
-            if not self.mpstate.map.is_alive():
-                self.needs_unloading = True
-
     def create_vehicle_icon(self, name, colour, follow=False, vehicle_type=None):
         '''add a vehicle to the map'''
         from MAVProxy.modules.mavproxy_map import mp_slipmap
@@ -377,7 +489,7 @@ class MapModule(mp_module.MPModule):
     def cmd_set_home(self, args):
         '''called when user selects "Set Home" on map'''
         (lat, lon) = (self.click_position[0], self.click_position[1])
-        alt = self.ElevationMap.GetElevation(lat, lon)
+        alt = self.ElevationMap.GetElevation(lat, lon, timeout=1)
         print("Setting home to: ", lat, lon, alt)
         self.master.mav.command_long_send(
             self.settings.target_system, self.settings.target_component,
@@ -469,7 +581,15 @@ class MapModule(mp_module.MPModule):
             # use plane icon for now
             self.create_vehicle_icon(id, 'green', vehicle_type='plane')
             self.mpstate.map.set_position(id, (m.lat, m.lon), rotation=m.heading)    
-            
+
+    def check_updates(self):
+        '''redisplay changed mission items and handle map events.
+        Called from a timer, as we only subscribe to position messages'''
+        from MAVProxy.modules.mavproxy_map import mp_slipmap
+        if not self.mpstate.map.is_alive():
+            self.needs_unloading = True
+            return
+
         # if the waypoints have changed, redisplay
         last_wp_change = self.module('wp').wploader.last_change
         if self.wp_change_time != last_wp_change and abs(time.time() - last_wp_change) > 1:
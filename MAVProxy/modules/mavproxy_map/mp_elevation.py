@@ -5,25 +5,180 @@ It will grab the altitude of a long,lat pair from the SRTM database
 Created by Stephen Dade (stephen_dade@hotmail.com)
 '''
 
+import collections
 import os
 import sys
+import threading
 import time
 
 import numpy
 
 from MAVProxy.modules.mavproxy_map import srtm
 
+# default limit on the size of open SRTM tiles
+ELEVATION_CACHE_BYTES = 64*1024*1024
+
+# seconds between attempts to load a tile that isn't available
+ELEVATION_RETRY_TIME = 1.0
+
+# seconds a lookup with no timeout given waits the first time a tile
+# is needed, long enough to open a tile that is already downloaded
+ELEVATION_FIRST_WAIT = 1.0
+
+# while a tile loads, lookups within this many degrees of the last
+# known elevation return it instead of None
+ELEVATION_LAST_KNOWN_DEG = 0.01
+
+class TileManager():
+    '''SRTM tiles open in this process, shared by all ElevationModels.
+    Tiles are opened by a background thread, so lookups never wait for
+    a tile to be extracted or downloaded. The least recently used tiles
+    are closed once the tiles open use more than cache_bytes.
+
+    A lookup with no timeout waits up to ELEVATION_FIRST_WAIT the first
+    time each tile is needed, so a tile already on disk is opened
+    before the first lookup returns'''
+    def __init__(self, downloader, cache_bytes=ELEVATION_CACHE_BYTES):
+        self.downloader = downloader
+        self.cache_bytes = cache_bytes
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # TileID -> (tile, bytes), least recently used first
+        self.tiles = collections.OrderedDict()
+        self.bytes = 0
+        # tiles waiting to be loaded, and when to next try missing tiles
+        self.load_queue = []
+        self.retry_time = {}
+        # tiles that have been asked for
+        self.requested = set()
+        self.worker = None
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, TileID, timeout=None):
+        '''return an open tile, or None if it isn't loaded. Waits up to
+        timeout seconds for the tile to load, or if timeout is None up to
+        ELEVATION_FIRST_WAIT the first time the tile is asked for'''
+        with self.lock:
+            entry = self.tiles.pop(TileID, None)
+            if entry is not None:
+                self.tiles[TileID] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            self._request(TileID)
+            if timeout is None:
+                timeout = 0 if TileID in self.requested else ELEVATION_FIRST_WAIT
+            self.requested.add(TileID)
+            if timeout <= 0:
+                return None
+            t0 = time.time()
+            while not TileID in self.tiles:
+                remaining = t0 + timeout - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(min(remaining, ELEVATION_RETRY_TIME))
+                if not TileID in self.tiles:
+                    self._request(TileID)
+            return self.tiles[TileID][0]
+
+    def _request(self, TileID):
+        '''queue a tile for loading, with the lock held'''
+        if TileID in self.load_queue or time.time() < self.retry_time.get(TileID, 0):
+            return
+        self.load_queue.append(TileID)
+        self.cond.notify_all()
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.load_worker, name='srtm_tiles')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def load_worker(self):
+        '''background tile loading thread'''
+        while True:
+            with self.lock:
+                while not self.load_queue:
+                    self.cond.wait()
+                TileID = self.load_queue[0]
+            try:
+                tile = self.downloader.getTile(TileID[0], TileID[1])
+            except Exception as ex:
+                # eg. a corrupt or unreadable file. Keep the thread
+                # alive for other tiles and try this one again later
+                if self.downloader.debug:
+                    print("SRTM tile %s failed: %s" % (str(TileID), str(ex)))
+                tile = 0
+            with self.lock:
+                self.load_queue.pop(0)
+                if tile == 0:
+                    # downloading, failed, or the file list isn't ready
+                    self.retry_time[TileID] = time.time() + ELEVATION_RETRY_TIME
+                    continue
+                self.retry_time.pop(TileID, None)
+                size = getattr(tile, 'size', 0)
+                old = self.tiles.pop(TileID, None)
+                if old is not None:
+                    self.bytes -= old[1]
+                self.tiles[TileID] = (tile, size * size * 2)
+                self.bytes += size * size * 2
+                self.loads += 1
+                self._evict()
+                self.cond.notify_all()
+
+    def _evict(self):
+        '''close old tiles while over the memory limit, with the lock held'''
+        while self.bytes > self.cache_bytes and len(self.tiles) > 1:
+            (TileID, (tile, size)) = self.tiles.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def set_cache_bytes(self, cache_bytes):
+        '''change the memory limit'''
+        with self.lock:
+            self.cache_bytes = cache_bytes
+            self._evict()
+
+    def status(self):
+        '''return a string describing the open tiles'''
+        with self.lock:
+            return ('SRTM tiles=%u bytes=%u/%u hits=%u misses=%u loads=%u evictions=%u loading=%u' %
+                    (len(self.tiles), self.bytes, self.cache_bytes, self.hits, self.misses,
+                     self.loads, self.evictions, len(self.load_queue)))
+
+# one TileManager per offline setting in each process
+tile_managers = {}
+tile_managers_lock = threading.Lock()
+
+def tile_manager(offline=0, debug=False, cache_bytes=None):
+    '''return the TileManager for this process, setting its memory limit
+    if cache_bytes is given'''
+    with tile_managers_lock:
+        if not offline in tile_managers:
+            downloader = srtm.SRTMDownloader(offline=offline, debug=debug)
+            downloader.loadFileList()
+            tile_managers[offline] = TileManager(downloader)
+        manager = tile_managers[offline]
+    if cache_bytes is not None:
+        manager.set_cache_bytes(cache_bytes)
+    return manager
+
 class ElevationModel():
     '''Elevation Model. Only SRTM for now'''
 
-    def __init__(self, database='srtm', offline=0, debug=False):
+    def __init__(self, database='srtm', offline=0, debug=False, cache_bytes=None):
         '''Use offline=1 to disable any downloading of tiles, regardless of whether the
-        tile exists'''
+        tile exists. cache_bytes sets the memory limit of the SRTM tiles
+        open in this process'''
         self.database = database
+        # (lat, lon, alt) of the last elevation found
+        self.last_known = None
         if self.database == 'srtm':
-            self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug)
-            self.downloader.loadFileList()
-            self.tileDict = dict()
+            self.tiles = tile_manager(offline, debug, cache_bytes)
+            self.downloader = self.tiles.downloader
 
         '''Use the Geoscience Australia database instead - watch for the correct database path'''
         if self.database == 'geoscience':
@@ -31,29 +186,70 @@ class ElevationModel():
             self.mappy = GAreader.ERMap()
             self.mappy.read_ermapper(os.path.join(os.environ['HOME'], './Documents/Elevation/Canberra/GSNSW_P756demg'))
 
-    def GetElevation(self, latitude, longitude, timeout=0):
-        '''Returns the altitude (m ASL) of a given lat/long pair, or None if unknown'''
+    def GetTile(self, latitude, longitude, timeout=None):
+        '''Returns the SRTM tile covering a lat/long pair, or None if not
+        available yet. The tile is loaded in the background, waiting up to
+        timeout seconds for it, see TileManager.get()'''
+        TileID = (int(numpy.floor(latitude)), int(numpy.floor(longitude)))
+        return self.tiles.get(TileID, timeout)
+
+    def status(self):
+        '''return a string describing the elevation data in use'''
         if self.database == 'srtm':
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            return self.tiles.status()
+        return self.database
+
+    def GetElevation(self, latitude, longitude, timeout=None):
+        '''Returns the altitude (m ASL) of a given lat/long pair, or None if unknown.
+        While the tile loads, the last elevation found close by is
+        returned as a coarse value'''
+        if self.database == 'srtm':
+            tile = self.GetTile(latitude, longitude, timeout)
+            if tile is None:
+                return self.last_known_elevation(latitude, longitude)
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         if self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
+        if alt is not None:
+            self.last_known = (latitude, longitude, alt)
         return alt
 
+    def last_known_elevation(self, latitude, longitude):
+        '''return the last elevation found if it was close to a lat/long
+        pair, or None'''
+        if self.last_known is None:
+            return None
+        (lat, lon, alt) = self.last_known
+        if (abs(lat - latitude) > ELEVATION_LAST_KNOWN_DEG or
+            abs(lon - longitude) > ELEVATION_LAST_KNOWN_DEG):
+            return None
+        return alt
+
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns a numpy array of the altitudes (m ASL) of arrays of lat/long
+        points, with nan where unknown. Each tile the points fall in is
+        looked up once'''
+        lats = numpy.asarray(latitudes, dtype=float)
+        lons = numpy.asarray(longitudes, dtype=float)
+        alts = numpy.empty(lats.shape)
+        alts.fill(numpy.nan)
+        if self.database == 'geoscience':
+            for i in range(len(lats)):
+                alts[i] = self.mappy.getAltitudeAtPoint(lats[i], lons[i])
+            return alts
+        if len(lats) == 0:
+            return alts
+        # group the points by tile
+        tile_lat = numpy.floor(lats)
+        tile_lon = numpy.floor(lons)
+        tile_key = (tile_lat + 90) * 360 + (tile_lon + 180)
+        for key in numpy.unique(tile_key):
+            idx = numpy.nonzero(tile_key == key)[0]
+            tile = self.GetTile(lats[idx[0]], lons[idx[0]], timeout)
+            if tile is None:
+                continue
+            alts[idx] = tile.getAltitudeArray(lats[idx], lons[idx])
+        return alts
 
 if __name__ == "__main__":
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+'''
+quadtree spatial index
+
+Indexes items by a bounding box of (x, y, w, h), the same form as the
+(lat, lon, dlat, dlon) bounds of slipmap objects, so that the objects in
+a view or near a click can be found without visiting every object.
+
+Each item is held in the smallest node that wholly contains its box,
+so an item can be moved or removed without rebuilding the tree. Nodes
+are created as needed and pruned once empty.
+'''
+
+# depth of the smallest nodes. With the whole earth at the root, nodes
+# at this depth are about 40m across
+QUADTREE_MAX_DEPTH = 20
+
+class QuadNode(object):
+    '''a node covering a box, with up to four child quadrants'''
+    __slots__ = ['box', 'parent', 'children', 'items']
+
+    def __init__(self, box, parent=None):
+        self.box = box
+        self.parent = parent
+        self.children = None
+        # item -> bounds
+        self.items = {}
+
+    def child_containing(self, bounds):
+        '''return the child quadrant wholly containing bounds, creating
+        it if needed, or None if bounds spans more than one quadrant'''
+        (x, y, w, h) = self.box
+        (bx, by, bw, bh) = bounds
+        midx = x + w * 0.5
+        midy = y + h * 0.5
+        if bx >= midx:
+            i = 1
+        elif bx + bw < midx:
+            i = 0
+        else:
+            return None
+        if by >= midy:
+            i += 2
+        elif by + bh >= midy:
+            return None
+        if bx < x or by < y or bx + bw > x + w or by + bh > y + h:
+            # outside this node altogether
+            return None
+        if self.children is None:
+            self.children = [None, None, None, None]
+        child = self.children[i]
+        if child is None:
+            cx = x
+            if i & 1:
+                cx = midx
+            cy = y
+            if i & 2:
+                cy = midy
+            child = QuadNode((cx, cy, w * 0.5, h * 0.5), self)
+            self.children[i] = child
+        return child
+
+    def empty(self):
+        return not self.items and (self.children is None or self.children == [None, None, None, None])
+
+def overlap(b1, b2):
+    '''return True if two boxes overlap, including touching edges. This
+    matches mp_util.bounds_overlap()'''
+    (x1, y1, w1, h1) = b1
+    (x2, y2, w2, h2) = b2
+    return not (x1 + w1 < x2 or x2 + w2 < x1 or y1 + h1 < y2 or y2 + h2 < y1)
+
+class QuadTree(object):
+    '''index of items by bounding box. Items with bounds of None are
+    returned by every query'''
+    def __init__(self, box=(-90.0, -180.0, 180.0, 360.0), max_depth=QUADTREE_MAX_DEPTH):
+        self.root = QuadNode(box)
+        self.max_depth = max_depth
+        # item -> node holding it
+        self.where = {}
+        self.unbounded = set()
+
+    def __len__(self):
+        return len(self.where) + len(self.unbounded)
+
+    def __contains__(self, item):
+        return item in self.where or item in self.unbounded
+
+    def insert(self, item, bounds):
+        '''add an item, or move it if already present'''
+        self.remove(item)
+        if bounds is None:
+            self.unbounded.add(item)
+            return
+        node = self.root
+        depth = 0
+        while depth < self.max_depth:
+            child = node.child_containing(bounds)
+            if child is None:
+                break
+            node = child
+            depth += 1
+        node.items[item] = bounds
+        self.where[item] = node
+
+    def remove(self, item):
+        '''remove an item if present'''
+        self.unbounded.discard(item)
+        node = self.where.pop(item, None)
+        if node is None:
+            return
+        node.items.pop(item)
+        # prune empty nodes
+        while node.parent is not None and node.empty():
+            parent = node.parent
+            parent.children[parent.children.index(node)] = None
+            node = parent
+
+    def query(self, bounds):
+        '''return a list of items whose bounds overlap bounds, plus the
+        items with no bounds'''
+        ret = list(self.unbounded)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for (item, b) in node.items.iteritems():
+                if overlap(b, bounds):
+                    ret.append(item)
+            if node.children is not None:
+                for child in node.children:
+                    if child is not None and overlap(child.box, bounds):
+                        stack.append(child)
+        return ret
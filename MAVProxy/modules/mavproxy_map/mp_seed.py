@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+'''
+offline seeding of map tiles and SRTM elevation data
+
+Fills the tile store and the SRTM cache for an area ahead of time, for
+use in the field with no connectivity. The area is a closed polygon
+(a bounding box, polygon file or fence) or an open path (a mission),
+plus a buffer distance in meters around it.
+
+Tiles and elevation files already on disk are skipped, so an
+interrupted seed is resumed by running it again.
+'''
+
+import math, threading, time
+
+# rough sizes used for download estimates
+SEED_TILE_BYTES = 20*1024
+SEED_SRTM_BYTES = 2*1024*1024
+
+# number of tile downloads queued at once
+SEED_QUEUE_LENGTH = 64
+
+# meters per degree of latitude
+METERS_PER_DEGREE = 111319.5
+
+class SeedArea(object):
+    '''an area to seed. points is a list of (lat,lon). If closed is
+    True the points form a polygon and everything inside it is included,
+    otherwise they form a path. Everything within buffer meters of the
+    polygon or path is also included'''
+    def __init__(self, points, buffer=0, closed=True):
+        if len(points) == 0:
+            raise ValueError("empty seed area")
+        self.points = points
+        self.buffer = buffer
+        self.closed = closed and len(points) > 2
+        # local flat earth projection about the first point
+        (self.lat0, self.lon0) = points[0]
+        self.lon_scale = math.cos(math.radians(self.lat0))
+        self.xy = [self.project(lat, lon) for (lat, lon) in points]
+        if self.closed and points[0] != points[-1]:
+            self.xy.append(self.xy[0])
+
+    def project(self, lat, lon):
+        '''return (x,y) in meters relative to the first point'''
+        return ((lon - self.lon0) * METERS_PER_DEGREE * self.lon_scale,
+                (lat - self.lat0) * METERS_PER_DEGREE)
+
+    def bounds(self):
+        '''return (lat_min, lon_min, lat_max, lon_max) including the buffer'''
+        lats = [p[0] for p in self.points]
+        lons = [p[1] for p in self.points]
+        dlat = self.buffer / METERS_PER_DEGREE
+        dlon = dlat / max(self.lon_scale, 0.01)
+        return (max(min(lats) - dlat, -85.0), min(lons) - dlon,
+                min(max(lats) + dlat, 85.0), max(lons) + dlon)
+
+    def inside(self, x, y):
+        '''return True if a projected point is inside the polygon'''
+        if not self.closed:
+            return False
+        ret = False
+        xy = self.xy
+        for i in range(len(xy)-1):
+            ((x1, y1), (x2, y2)) = (xy[i], xy[i+1])
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                ret = not ret
+        return ret
+
+    def distance(self, x, y):
+        '''return distance in meters from a projected point to the edges'''
+        xy = self.xy
+        if len(xy) == 1:
+            return math.hypot(x - xy[0][0], y - xy[0][1])
+        ret = None
+        for i in range(len(xy)-1):
+            ((x1, y1), (x2, y2)) = (xy[i], xy[i+1])
+            (dx, dy) = (x2 - x1, y2 - y1)
+            l2 = dx*dx + dy*dy
+            t = 0.0
+            if l2 > 0:
+                t = max(0.0, min(1.0, ((x - x1)*dx + (y - y1)*dy) / l2))
+            d = math.hypot(x - (x1 + t*dx), y - (y1 + t*dy))
+            if ret is None or d < ret:
+                ret = d
+        return ret
+
+    def covers(self, lat1, lon1, lat2, lon2):
+        '''return True if any of a lat/lon rectangle is in the area. This
+        is conservative, and may include rectangles just outside'''
+        (x1, y1) = self.project(lat1, lon1)
+        (x2, y2) = self.project(lat2, lon2)
+        (cx, cy) = ((x1 + x2) * 0.5, (y1 + y2) * 0.5)
+        if self.inside(cx, cy):
+            return True
+        radius = 0.5 * math.hypot(x2 - x1, y2 - y1)
+        return self.distance(cx, cy) <= self.buffer + radius
+
+def bbox_area(lat1, lon1, lat2, lon2, buffer=0):
+    '''return a SeedArea for a bounding box'''
+    return SeedArea([(lat1, lon1), (lat1, lon2), (lat2, lon2), (lat2, lon1)], buffer=buffer)
+
+def parse_bbox(s):
+    '''parse a LAT1,LON1,LAT2,LON2 bounding box'''
+    a = [float(v) for v in s.split(',')]
+    if len(a) != 4:
+        raise ValueError("bounding box must be LAT1,LON1,LAT2,LON2")
+    return a
+
+class TileSeeder(object):
+    '''fetch map tiles covering an area over a zoom range, using the
+    download pool of an MPTile'''
+    def __init__(self, mt, area, min_zoom, max_zoom):
+        self.mt = mt
+        self.area = area
+        self.zooms = range(min_zoom, max_zoom+1)
+        self.total = 0
+        self.missing = 0
+        self.done = 0
+        self.errors = 0
+        self.cancelled = False
+
+    def tiles(self, zoom):
+        '''generate the tiles covering the area at one zoom level'''
+        from MAVProxy.modules.mavproxy_map import mp_tile
+        (lat_min, lon_min, lat_max, lon_max) = self.area.bounds()
+        tile_min = self.mt.coord_to_tile(lat_max, lon_min, zoom)
+        tile_max = self.mt.coord_to_tile(lat_min, lon_max, zoom)
+        for y in range(tile_min.y, tile_max.y+1):
+            for x in range(tile_min.x, tile_max.x+1):
+                tile = mp_tile.TileInfo((x, y), zoom, self.mt.service)
+                (lat1, lon1) = tile.coord((0, 0))
+                (lat2, lon2) = tile.coord((mp_tile.TILES_WIDTH, mp_tile.TILES_HEIGHT))
+                if self.area.covers(lat1, lon1, lat2, lon2):
+                    yield tile
+
+    def estimate(self):
+        '''count the tiles needed and those not yet in the store. Returns
+        (total, missing, estimated_bytes)'''
+        self.total = 0
+        self.missing = 0
+        for zoom in self.zooms:
+            for tile in self.tiles(zoom):
+                if self.cancelled:
+                    return (self.total, self.missing, self.missing * SEED_TILE_BYTES)
+                self.total += 1
+                if not self.mt.tile_store.contains(tile):
+                    self.missing += 1
+        return (self.total, self.missing, self.missing * SEED_TILE_BYTES)
+
+    def run(self, progress=None, interval=2.0):
+        '''download missing tiles, calling progress(self) periodically'''
+        if self.total == 0:
+            self.estimate()
+        mt = self.mt
+        errors0 = mt.download_errors
+        submitted = 0
+        last_progress = time.time()
+        for zoom in self.zooms:
+            for tile in self.tiles(zoom):
+                if self.cancelled:
+                    return
+                if mt.tile_store.contains(tile):
+                    continue
+                while mt.tiles_pending() >= SEED_QUEUE_LENGTH and not self.cancelled:
+                    time.sleep(0.1)
+                mt.request_download(tile)
+                submitted += 1
+                self.done = submitted - mt.tiles_pending()
+                self.errors = mt.download_errors - errors0
+                if progress is not None and time.time() - last_progress >= interval:
+                    progress(self)
+                    last_progress = time.time()
+        while mt.tiles_pending() > 0 and not self.cancelled:
+            time.sleep(0.2)
+            if progress is not None and time.time() - last_progress >= interval:
+                self.done = submitted - mt.tiles_pending()
+                progress(self)
+                last_progress = time.time()
+        self.done = submitted - mt.tiles_pending()
+        self.errors = mt.download_errors - errors0
+        mt.tile_store.flush()
+
+    def __str__(self):
+        return "tiles %u/%u downloaded, %u errors" % (self.done, self.missing, self.errors)
+
+class SRTMSeeder(object):
+    '''fetch the SRTM files covering an area, using several threads'''
+    def __init__(self, downloader, area, workers=2):
+        self.downloader = downloader
+        self.area = area
+        self.workers = workers
+        self.total = 0
+        self.missing = 0
+        self.done = 0
+        self.errors = 0
+        self.cancelled = False
+
+    def wait_filelist(self, timeout=120):
+        '''wait for the SRTM file list, returning False if unavailable'''
+        self.downloader.loadFileList()
+        t0 = time.time()
+        while not self.downloader.fileListReady():
+            if time.time() - t0 > timeout or self.cancelled:
+                return False
+            time.sleep(0.5)
+        return True
+
+    def files(self):
+        '''return list of (continent, filename) covering the area'''
+        (lat_min, lon_min, lat_max, lon_max) = self.area.bounds()
+        ret = []
+        for lat in range(int(math.floor(lat_min)), int(math.floor(lat_max))+1):
+            for lon in range(int(math.floor(lon_min)), int(math.floor(lon_max))+1):
+                if not self.area.covers(lat+1, lon, lat, lon+1):
+                    continue
+                f = self.downloader.tileFile(lat, lon)
+                if f is not None:
+                    # None is ocean, which needs no data
+                    ret.append(f)
+        return ret
+
+    def missing_files(self):
+        import os
+        return [(c, f) for (c, f) in self.files()
+                if not os.path.exists(os.path.join(self.downloader.cachedir, f))]
+
+    def estimate(self):
+        '''return (total, missing, estimated_bytes)'''
+        self.total = len(self.files())
+        self.missing = len(self.missing_files())
+        return (self.total, self.missing, self.missing * SEED_SRTM_BYTES)
+
+    def run(self, progress=None):
+        '''download missing files'''
+        todo = self.missing_files()
+        self.missing = len(todo)
+        lock = threading.Lock()
+        def worker():
+            while not self.cancelled:
+                with lock:
+                    if not todo:
+                        return
+                    (continent, filename) = todo.pop(0)
+                ok = self.downloader.fetchTile(continent, filename)
+                with lock:
+                    if ok:
+                        self.done += 1
+                    else:
+                        self.errors += 1
+                if progress is not None:
+                    progress(self)
+        threads = [threading.Thread(target=worker, name='srtm_seed') for i in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+    def __str__(self):
+        return "SRTM %u/%u downloaded, %u errors" % (self.done, self.missing, self.errors)
+
+def format_bytes(n):
+    '''format a byte count for display'''
+    if n >= 1024*1024*1024:
+        return "%.1fGB" % (n / (1024.0*1024*1024))
+    if n >= 1024*1024:
+        return "%.1fMB" % (n / (1024.0*1024))
+    return "%.0fkB" % (n / 1024.0)
@@ -22,6 +22,9 @@ from MAVProxy.modules.lib import mp_util
 from mp_slipmap_util import *
 
 
+# position updates are sent to the map at most this often
+SLIPMAP_UPDATE_INTERVAL = 0.1
+
 class MPSlipMap():
     '''
     a generic map viewer widget for use in mavproxy
@@ -39,7 +42,8 @@ class MPSlipMap():
                  debug=False,
                  brightness=1.0,
                  elevation=False,
-                 download=True):
+                 download=True,
+                 tile_store='dir'):
         import multiprocessing
 
         self.lat = lat
@@ -50,6 +54,7 @@ class MPSlipMap():
         self.download = download
         self.service = service
         self.tile_delay = tile_delay
+        self.tile_store = tile_store
         self.debug = debug
         self.max_zoom = max_zoom
         self.elevation = elevation
@@ -68,6 +73,18 @@ class MPSlipMap():
         self.child.start()
         self._callbacks = set()
 
+        # objects waiting to be sent to the map, with the index in
+        # _pending of the position update of each (key, layer)
+        import threading
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_positions = {}
+        self._last_flush = time.time()
+        self.position_updates = 0
+        self.positions_coalesced = 0
+        self.messages_sent = 0
+        self.objects_sent = 0
+
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -83,7 +100,8 @@ class MPSlipMap():
                                  service=self.service,
                                  tile_delay=self.tile_delay,
                                  debug=self.debug,
-                                 max_zoom=self.max_zoom)
+                                 max_zoom=self.max_zoom,
+                                 tile_store=self.tile_store)
         state.layers = {}
         state.info = {}
         state.need_redraw = True
@@ -93,6 +111,9 @@ class MPSlipMap():
         self.app.frame = MPSlipMapFrame(state=self)
         self.app.frame.Show()
         self.app.MainLoop()
+        # atexit handlers don't run in a multiprocessing child, so
+        # commit any queued tiles here
+        self.mt.tile_store.flush()
 
     def close(self):
         '''close the window'''
@@ -111,24 +132,75 @@ class MPSlipMap():
         '''check if graph is still going'''
         return self.child.is_alive()
 
+    def _flush(self):
+        if not self._pending:
+            return
+        if len(self._pending) == 1:
+            self.object_queue.put(self._pending[0])
+        else:
+            self.object_queue.put(SlipBatch(self._pending))
+        self.messages_sent += 1
+        self.objects_sent += len(self._pending)
+        self._pending = []
+        self._pending_positions = {}
+        self._last_flush = time.time()
+
+    def flush(self):
+        '''send any pending position updates to the map'''
+        with self._lock:
+            self._flush()
+
+    def _send(self, obj):
+        '''send an object to the map, after any pending position updates'''
+        with self._lock:
+            self._pending.append(obj)
+            self._flush()
+
     def add_object(self, obj):
         '''add or update an object on the map'''
-        self.object_queue.put(obj)
+        self._send(obj)
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
-        self.object_queue.put(SlipRemoveObject(key))
+        self._send(SlipRemoveObject(key))
 
     def hide_object(self, key, hide=True):
         '''hide an object on the map by key'''
-        self.object_queue.put(SlipHideObject(key, hide))
+        self._send(SlipHideObject(key, hide))
 
     def set_position(self, key, latlon, layer=None, rotation=0):
-        '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation))
+        '''move an object on the map. Updates are sent in batches, and
+        only the latest position of each object in a batch is sent'''
+        pos = SlipPosition(key, latlon, layer, rotation)
+        with self._lock:
+            self.position_updates += 1
+            idx = self._pending_positions.get((key, layer), None)
+            if idx is not None:
+                self._pending[idx] = pos
+                self.positions_coalesced += 1
+            else:
+                self._pending_positions[(key, layer)] = len(self._pending)
+                self._pending.append(pos)
+            if time.time() - self._last_flush >= SLIPMAP_UPDATE_INTERVAL:
+                self._flush()
+
+    def queue_status(self):
+        '''return a string describing the object queue'''
+        try:
+            depth = '%u' % self.object_queue.qsize()
+        except NotImplementedError:
+            depth = 'unknown'
+        coalesced = 0.0
+        if self.position_updates > 0:
+            coalesced = (100.0 * self.positions_coalesced) / self.position_updates
+        return ('positions=%u coalesced=%u (%.0f%%) messages=%u objects=%u pending=%u queue=%s' %
+                (self.position_updates, self.positions_coalesced, coalesced,
+                 self.messages_sent, self.objects_sent, len(self._pending), depth))
 
     def event_count(self):
         '''return number of events waiting to be processed'''
+        # callers poll this regularly, so it sends the last positions
+        self.flush()
         return self.event_queue.qsize()
 
     def get_event(self):
@@ -164,6 +236,7 @@ if __name__ == "__main__":
     parser.add_option("--service", default="MicrosoftSat", help="tile service")
     parser.add_option("--offline", action='store_true', default=False, help="no download")
     parser.add_option("--delay", type='float', default=0.3, help="tile download delay")
+    parser.add_option("--tile-store", default="dir", choices=["dir", "mbtiles"], help="tile store")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     parser.add_option("--boundary", default=None, help="show boundary")
@@ -183,7 +256,8 @@ if __name__ == "__main__":
                    debug=opts.debug,
                    max_zoom=opts.max_zoom,
                    elevation=opts.elevation,
-                   tile_delay=opts.delay)
+                   tile_delay=opts.delay,
+                   tile_store=opts.tile_store)
 
     if opts.boundary:
         boundary = mp_util.polygon_load(opts.boundary)
@@ -1,6 +1,7 @@
 from MAVProxy.modules.lib.mp_menu import *
 from ..lib.wx_loader import wx
 import mp_elevation
+import mp_quadtree
 import os
 import functools
 from mp_slipmap_util import *
@@ -10,6 +11,9 @@ try:
 except ImportError:
     import cv
 
+# layers unchanged for this many seconds are drawn from cached rasters
+SLIPMAP_STATIC_TIME = 2.0
+
 class MPSlipMapFrame(wx.Frame):
     """ The main frame of the viewer
     """
@@ -24,6 +28,13 @@ class MPSlipMapFrame(wx.Frame):
         state.popup_latlon = None
         state.popup_started = False
         state.default_popup = None
+        # per layer change count and time of the last change
+        state.layer_version = {}
+        state.layer_time = {}
+        # per layer spatial index of object keys, and the largest
+        # click_radius() of any object
+        state.layer_index = {}
+        state.click_margin = 0
         state.panel = MPSlipMapPanel(self, state)
         self.Bind(wx.EVT_IDLE, self.on_idle)
         self.Bind(wx.EVT_SIZE, state.panel.on_size)
@@ -117,6 +128,28 @@ class MPSlipMapFrame(wx.Frame):
         (lat, lon) = object.latlon
         state.panel.re_center(state.width/2, state.height/2, lat, lon)
 
+    def layer_changed(self, layer):
+        '''note a change to the objects in a layer'''
+        state = self.state
+        state.layer_version[layer] = state.layer_version.get(layer, 0) + 1
+        state.layer_time[layer] = time.time()
+
+    def index_object(self, obj):
+        '''add or move an object in the spatial index of its layer'''
+        state = self.state
+        if not obj.layer in state.layer_index:
+            state.layer_index[obj.layer] = mp_quadtree.QuadTree()
+        state.layer_index[obj.layer].insert(obj.key, obj.bounds())
+        state.click_margin = max(state.click_margin, obj.click_radius())
+
+    def pop_object(self, layer, key):
+        '''remove an object from a layer'''
+        state = self.state
+        if state.layers[layer].pop(key, None) is None:
+            return
+        state.layer_index[layer].remove(key)
+        self.layer_changed(layer)
+
     def add_object(self, obj):
         '''add an object to a later'''
         state = self.state
@@ -124,15 +157,82 @@ class MPSlipMapFrame(wx.Frame):
             # its a new layer
             state.layers[obj.layer] = {}
         state.layers[obj.layer][obj.key] = obj
+        self.index_object(obj)
+        self.layer_changed(obj.layer)
         state.need_redraw = True
 
     def remove_object(self, key):
         '''remove an object by key from all layers'''
         state = self.state
         for layer in state.layers:
-            state.layers[layer].pop(key, None)
+            self.pop_object(layer, key)
         state.need_redraw = True
 
+    def process_object(self, obj):
+        '''handle an object received from the parent'''
+        state = self.state
+
+        if isinstance(obj, SlipObject):
+            self.add_object(obj)
+
+        if isinstance(obj, SlipPosition):
+            # move an object
+            object = self.find_object(obj.key, obj.layer)
+            if object is not None:
+                object.update_position(obj)
+                self.index_object(object)
+                self.layer_changed(object.layer)
+                if getattr(object, 'follow', False):
+                    self.follow(object)
+                state.need_redraw = True
+
+        if isinstance(obj, SlipDefaultPopup):
+            state.default_popup = obj
+
+        if isinstance(obj, SlipInformation):
+            # see if its a existing one or a new one
+            if obj.key in state.info:
+#                print('update %s' % str(obj.key))
+                state.info[obj.key].update(obj)
+            else:
+#                print('add %s' % str(obj.key))
+                state.info[obj.key] = obj
+            state.need_redraw = True
+
+        if isinstance(obj, SlipCenter):
+            # move center
+            (lat,lon) = obj.latlon
+            state.panel.re_center(state.width/2, state.height/2, lat, lon)
+            state.need_redraw = True
+
+        if isinstance(obj, SlipBrightness):
+            # set map brightness
+            state.brightness = obj.brightness
+            state.need_redraw = True
+
+        if isinstance(obj, SlipClearLayer):
+            # remove all objects from a layer
+            if obj.layer in state.layers:
+                state.layers.pop(obj.layer)
+                state.layer_index.pop(obj.layer, None)
+                self.layer_changed(obj.layer)
+            state.need_redraw = True
+
+        if isinstance(obj, SlipRemoveObject):
+            # remove an object by key
+            for layer in state.layers:
+                self.pop_object(layer, obj.key)
+            state.need_redraw = True
+
+        if isinstance(obj, SlipHideObject):
+            # hide an object by key
+            for layer in state.layers:
+                if obj.key in state.layers[layer]:
+                    state.layers[layer][obj.key].set_hidden(obj.hide)
+                    self.index_object(state.layers[layer][obj.key])
+                    self.layer_changed(layer)
+            state.need_redraw = True
+
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
         state = self.state
@@ -145,62 +245,11 @@ class MPSlipMapFrame(wx.Frame):
 
         while not state.object_queue.empty():
             obj = state.object_queue.get()
-
-            if isinstance(obj, SlipObject):
-                self.add_object(obj)
-
-            if isinstance(obj, SlipPosition):
-                # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    state.need_redraw = True
-
-            if isinstance(obj, SlipDefaultPopup):
-                state.default_popup = obj
-
-            if isinstance(obj, SlipInformation):
-                # see if its a existing one or a new one
-                if obj.key in state.info:
-#                    print('update %s' % str(obj.key))
-                    state.info[obj.key].update(obj)
-                else:
-#                    print('add %s' % str(obj.key))
-                    state.info[obj.key] = obj
-                state.need_redraw = True
-
-            if isinstance(obj, SlipCenter):
-                # move center
-                (lat,lon) = obj.latlon
-                state.panel.re_center(state.width/2, state.height/2, lat, lon)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipBrightness):
-                # set map brightness
-                state.brightness = obj.brightness
-                state.need_redraw = True
-
-            if isinstance(obj, SlipClearLayer):
-                # remove all objects from a layer
-                if obj.layer in state.layers:
-                    state.layers.pop(obj.layer)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipRemoveObject):
-                # remove an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer].pop(obj.key)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipHideObject):
-                # hide an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer][obj.key].set_hidden(obj.hide)
-                state.need_redraw = True
+            if isinstance(obj, SlipBatch):
+                for o in obj.objects:
+                    self.process_object(o)
+            else:
+                self.process_object(obj)
         
         if obj is None:
             time.sleep(0.05)
@@ -216,6 +265,9 @@ class MPSlipMapPanel(wx.Panel):
         self.state = state
         self.img = None
         self.map_img = None
+        self.layer_cache = SlipLayerCache()
+        # layer -> (version, True if it has additive objects)
+        self.layer_additive = {}
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
@@ -340,6 +392,7 @@ class MPSlipMapPanel(wx.Panel):
             pending = state.mt.tiles_pending()
         if pending:
             newtext += ' Map Downloading %u ' % pending
+        newtext += ' ' + state.mt.cache_status()
         if alt == -1:
             newtext += ' SRTM Downloading '
         newtext += '\n'
@@ -370,15 +423,42 @@ class MPSlipMapPanel(wx.Panel):
         (lat,lon) = (latlon[0], latlon[1])
         return state.mt.coord_to_pixel(state.lat, state.lon, state.width, state.ground_width, lat, lon)
 
-    def draw_objects(self, objects, bounds, img):
-        '''draw objects on the image'''
-        keys = objects.keys()
+    def draw_objects(self, layer, bounds, img):
+        '''draw the objects of a layer within bounds on the image'''
+        state = self.state
+        objects = state.layers[layer]
+        keys = state.layer_index[layer].query(bounds)
         keys.sort()
         for k in keys:
-            obj = objects[k]
-            bounds2 = obj.bounds()
-            if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
-                obj.draw(img, self.pixmapper, bounds)
+            objects[k].draw(img, self.pixmapper, bounds)
+
+    def layer_is_static(self, layer):
+        '''return True if a layer can be drawn from a cached raster'''
+        state = self.state
+        if time.time() - state.layer_time.get(layer, 0) < SLIPMAP_STATIC_TIME:
+            # recently changed, such as a moving vehicle
+            return False
+        version = state.layer_version.get(layer, 0)
+        (v, additive) = self.layer_additive.get(layer, (None, False))
+        if v != version:
+            additive = False
+            for obj in state.layers[layer].values():
+                if obj.additive:
+                    additive = True
+                    break
+            self.layer_additive[layer] = (version, additive)
+        return not additive
+
+    def draw_static_layers(self, layers, view, bounds, img):
+        '''draw a run of static layers using the layer cache'''
+        if not layers:
+            return
+        state = self.state
+        stamp = (view, [state.layer_version.get(k, 0) for k in layers])
+        def draw(dest):
+            for k in layers:
+                self.draw_objects(k, bounds, dest)
+        self.layer_cache.draw(tuple(layers), stamp, img, draw)
 
     def redraw_map(self):
         '''redraw the map with current settings'''
@@ -391,7 +471,8 @@ class MPSlipMapPanel(wx.Panel):
 
         # get the new map
         self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
+                                              state.width, state.height, state.ground_width,
+                                              incremental=True)
         if state.brightness != 1.0:
             cv.ConvertScale(self.map_img, self.map_img, scale=state.brightness)
 
@@ -400,18 +481,28 @@ class MPSlipMapPanel(wx.Panel):
         (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
         bounds = (lat2, state.lon, state.lat-lat2, lon2-state.lon)
 
-        # get the image
-        img = cv.CloneImage(self.map_img)
+        # area_to_image() gives a new image each time, so we can draw on it
+        img = self.map_img
 
         # possibly draw a grid
         if state.grid:
             SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
 
-        # draw layer objects
+        # draw layer objects. Runs of layers that are not changing are
+        # drawn from cached rasters
+        view = (state.lat, state.lon, state.width, state.height, state.ground_width)
         keys = state.layers.keys()
         keys.sort()
+        static = []
         for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+            if self.layer_is_static(k):
+                static.append(k)
+                continue
+            self.draw_static_layers(static, view, bounds, img)
+            static = []
+            self.draw_objects(k, bounds, img)
+        self.draw_static_layers(static, view, bounds, img)
+        self.layer_cache.expire()
 
         # draw information objects
         for key in state.info:
@@ -460,8 +551,13 @@ class MPSlipMapPanel(wx.Panel):
         state = self.state
         selected = []
         (px, py) = pos
+        # only objects with bounds near the click can be clicked on
+        m = state.click_margin
+        (lat1, lon1) = self.coordinates(px-m, py-m)
+        (lat2, lon2) = self.coordinates(px+m, py+m)
+        bounds = (lat2, lon1, lat1-lat2, lon2-lon1)
         for layer in state.layers:
-            for key in state.layers[layer]:
+            for key in state.layer_index[layer].query(bounds):
                 obj = state.layers[layer][key]
                 distance = obj.clicked(px, py)
                 if distance is not None:
@@ -550,7 +646,7 @@ class MPSlipMapPanel(wx.Panel):
             for key in keys:
                 if (isinstance(state.layers[l][key], SlipThumbnail)
                     and not isinstance(state.layers[l][key], SlipIcon)):
-                    state.layers[l].pop(key)
+                    state.frame.pop_object(l, key)
 
     def on_key_down(self, event):
         '''handle keyboard input'''
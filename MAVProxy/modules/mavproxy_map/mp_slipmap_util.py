@@ -23,6 +23,10 @@ from MAVProxy.modules.lib import mp_util
 
 class SlipObject:
     '''an object to display on the map'''
+    # objects that blend with the map below them can't be drawn from
+    # a cached layer raster
+    additive = False
+
     def __init__(self, key, layer, popup_menu=None):
         self.key = key
         self.layer = layer
@@ -76,6 +80,11 @@ class SlipObject:
         '''return bounding box or None'''
         return None
 
+    def click_radius(self):
+        '''return the distance in pixels from the bounding box within
+        which clicked() may accept a click'''
+        return 6
+
     def set_hidden(self, hidden):
         '''set hidden attribute'''
         self.hidden = hidden
@@ -140,6 +149,7 @@ class SlipPolygon(SlipObject):
         self.linewidth = linewidth
         self._bounds = mp_util.polygon_bounds(self.points)
         self._pix_points = []
+        self._pix_bounds = None
         self._selected_vertex = None
 
     def bounds(self):
@@ -177,12 +187,22 @@ class SlipPolygon(SlipObject):
                 colour = self.colour
             self.draw_line(img, pixmapper, self.points[i], self.points[i+1],
                            colour, self.linewidth)
+        # pixel bounding box of the drawn points, for clicked()
+        pix = [p for p in self._pix_points if p is not None]
+        if pix:
+            self._pix_bounds = (min([p[0] for p in pix]), min([p[1] for p in pix]),
+                                max([p[0] for p in pix]), max([p[1] for p in pix]))
+        else:
+            self._pix_bounds = None
 
     def clicked(self, px, py):
         '''see if the polygon has been clicked on.
         Consider it clicked if the pixel is within 6 of the point
         '''
-        if self.hidden:
+        if self.hidden or self._pix_bounds is None:
+            return None
+        (minx, miny, maxx, maxy) = self._pix_bounds
+        if px <= minx - 6 or px >= maxx + 6 or py <= miny - 6 or py >= maxy + 6:
             return None
         for i in range(len(self._pix_points)):
             if self._pix_points[i] is None:
@@ -264,6 +284,10 @@ class SlipThumbnail(SlipObject):
             return None
         return (self.latlon[0], self.latlon[1], 0, 0)
 
+    def click_radius(self):
+        '''return click distance in pixels'''
+        return max(self.width, self.height)
+
     def img(self):
         '''return a cv image for the thumbnail'''
         if self._img is not None:
@@ -338,6 +362,8 @@ class SlipTrail:
 
 class SlipIcon(SlipThumbnail):
     '''a icon to display on the map'''
+    additive = True
+
     def __init__(self, key, latlon, img, layer=1, rotation=0,
                  follow=False, trail=None, popup_menu=None):
         SlipThumbnail.__init__(self, key, latlon, layer, img, popup_menu=popup_menu)
@@ -391,6 +417,62 @@ class SlipIcon(SlipThumbnail):
         self.posy = py+h/2
 
 
+class SlipLayerCache:
+    '''rasters of groups of map layers that are not changing, which are
+    composited onto each new map image instead of being drawn object by
+    object. The stamp given with a group identifies its contents and the
+    view. A raster is only made the second time a group is drawn with
+    the same stamp, so groups that change every frame (such as when
+    panning) are drawn directly'''
+    # background of a raster, pixels of any other colour are copied
+    key_colour = (1, 2, 3)
+
+    def __init__(self):
+        self.rasters = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def draw(self, group, stamp, img, draw):
+        '''draw a group of layers on img, calling draw(img) to draw them'''
+        self.used.add(group)
+        entry = self.rasters.get(group, None)
+        if entry is None or entry[0] != stamp:
+            self.rasters[group] = (stamp, None, None)
+            self.misses += 1
+            draw(img)
+            return
+        (stamp, raster, mask) = entry
+        if raster is None:
+            raster = cv.CreateImage((img.width, img.height), 8, 3)
+            cv.Set(raster, self.key_colour)
+            draw(raster)
+            mask = self.raster_mask(raster)
+            self.rasters[group] = (stamp, raster, mask)
+        else:
+            self.hits += 1
+        cv.Copy(raster, img, mask)
+
+    def raster_mask(self, raster):
+        '''return a mask of the drawn pixels of a raster'''
+        size = (raster.width, raster.height)
+        channels = [cv.CreateImage(size, 8, 1) for i in range(3)]
+        cv.Split(raster, channels[0], channels[1], channels[2], None)
+        mask = cv.CreateImage(size, 8, 1)
+        cv.SetZero(mask)
+        for i in range(3):
+            cv.CmpS(channels[i], self.key_colour[i], channels[i], cv.CV_CMP_NE)
+            cv.Or(mask, channels[i], mask)
+        return mask
+
+    def expire(self):
+        '''forget rasters of groups not drawn since the last expire()'''
+        for group in self.rasters.keys():
+            if not group in self.used:
+                self.rasters.pop(group)
+        self.used = set()
+
+
 class SlipPosition:
     '''an position object to move an existing object on the map'''
     def __init__(self, key, latlon, layer=None, rotation=0):
@@ -399,6 +481,11 @@ class SlipPosition:
         self.latlon = latlon
         self.rotation = rotation
 
+class SlipBatch:
+    '''a list of objects sent to the map in one message'''
+    def __init__(self, objects):
+        self.objects = objects
+
 class SlipCenter:
     '''an object to move the view center'''
     def __init__(self, latlon):
@@ -9,10 +9,12 @@ May 2012
 released under GNU GPL v3 or later
 '''
 
-import collections
 import errno
 import hashlib
+import heapq
+import httplib
 import urllib2
+import urlparse
 import math
 import threading
 import os
@@ -26,6 +28,8 @@ except ImportError:
 	import cv
 
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map import mp_tilecache
+from MAVProxy.modules.mavproxy_map import mp_tilestore
 
 class TileException(Exception):
 	'''tile error class'''
@@ -54,6 +58,16 @@ TILE_SERVICES = {
         
 	}
 
+# a tile server given by URL template, eg. a local tile server
+# http://localhost:8000/${ZOOM}/${X}/${Y}.png
+CUSTOM_SERVICE = "Custom"
+if 'MAP_SERVICE_URL' in os.environ:
+	TILE_SERVICES[CUSTOM_SERVICE] = os.environ['MAP_SERVICE_URL']
+
+def set_custom_service(url):
+	'''set the URL template of the Custom tile service'''
+	TILE_SERVICES[CUSTOM_SERVICE] = url
+
 # these are the md5sums of "unavailable" tiles
 BLANK_TILES = set(["d16657bbee25d7f15c583f5c5bf23f50",
                    "c0e76e6e90ff881da047c15dbea380c7",
@@ -63,6 +77,31 @@ BLANK_TILES = set(["d16657bbee25d7f15c583f5c5bf23f50",
 TILES_WIDTH = 256
 TILES_HEIGHT = 256
 
+# number of download workers, and the maximum number of concurrent
+# connections per tile service. The OpenStreetMap tile usage policy
+# asks for at most 2
+TILE_WORKERS = 4
+TILE_SERVICE_CONNECTIONS = {
+	"OpenStreetMap"  : 2,
+	"OSMARender"     : 2,
+	"OpenCycleMap"   : 2,
+	}
+TILE_DEFAULT_CONNECTIONS = 4
+
+# download priority is distance from the view centre in tiles, plus
+# this many tiles per second of request age, so the newest requests
+# near the centre are fetched first
+TILE_AGE_WEIGHT = 1.0
+# and this many tiles per zoom level away from the view
+TILE_ZOOM_WEIGHT = 4.0
+
+# idle workers exit after this many seconds
+TILE_WORKER_IDLE = 5.0
+
+# number of tiles kept around the view in the map mosaic, so small pans
+# don't need any new tiles
+MOSAIC_MARGIN = 1
+
 class TileServiceInfo:
 	'''a lookup object for the URL templates'''
 	def __init__(self, x, y, zoom):
@@ -157,11 +196,71 @@ class TileInfoScaled(TileInfo):
 
 
 
+class TileMosaic:
+	'''a tile aligned map image larger than the view, which is reused
+	while panning at a fixed zoom and scale. Positions are in scaled
+	tile pixels, where tile (x,y) starts at (x*tile_width, y*tile_height)'''
+	def __init__(self, key, tx0, ty0, ncols, nrows, tile_width, tile_height):
+		self.key = key
+		(self.tx0, self.ty0) = (tx0, ty0)
+		(self.ncols, self.nrows) = (ncols, nrows)
+		(self.tile_width, self.tile_height) = (tile_width, tile_height)
+		self.img = cv.CreateImage((ncols*tile_width, nrows*tile_height), 8, 3)
+		cv.SetZero(self.img)
+		# (x,y) -> True if the real tile has been drawn, False if a
+		# placeholder was drawn
+		self.drawn = {}
+		self.generation = None
+
+	def covers(self, px, py, width, height):
+		'''return True if a view is within the mosaic'''
+		x0 = self.tx0 * self.tile_width
+		y0 = self.ty0 * self.tile_height
+		return (px >= x0 and py >= y0 and
+			px + width <= x0 + self.ncols * self.tile_width and
+			py + height <= y0 + self.nrows * self.tile_height)
+
+	def tiles(self):
+		'''return list of (x,y) of all tiles in the mosaic'''
+		return [(x, y) for y in range(self.ty0, self.ty0+self.nrows)
+			for x in range(self.tx0, self.tx0+self.ncols)]
+
+	def tile_rect(self, xy):
+		'''return the rectangle of a tile within the mosaic image'''
+		return ((xy[0] - self.tx0) * self.tile_width, (xy[1] - self.ty0) * self.tile_height,
+			self.tile_width, self.tile_height)
+
+	def copy_tile(self, src, xy):
+		'''copy a drawn tile from another mosaic with the same key'''
+		cv.SetImageROI(src.img, src.tile_rect(xy))
+		cv.SetImageROI(self.img, self.tile_rect(xy))
+		cv.Copy(src.img, self.img)
+		cv.ResetImageROI(self.img)
+		cv.ResetImageROI(src.img)
+		self.drawn[xy] = src.drawn[xy]
+
+	def draw_tile(self, xy, img):
+		'''draw a scaled tile image'''
+		cv.SetImageROI(self.img, self.tile_rect(xy))
+		cv.Copy(img, self.img)
+		cv.ResetImageROI(self.img)
+
+	def window(self, px, py, width, height):
+		'''return a copy of part of the mosaic'''
+		img = cv.CreateImage((width,height),8,3)
+		cv.SetImageROI(self.img, (px - self.tx0 * self.tile_width, py - self.ty0 * self.tile_height,
+					  width, height))
+		cv.Copy(self.img, img)
+		cv.ResetImageROI(self.img)
+		return img
+
+
 class MPTile:
 	'''map tile object'''
 	def __init__(self, cache_path=None, download=True, cache_size=500,
 		     service="MicrosoftSat", tile_delay=0.3, debug=False,
-		     max_zoom=19, refresh_age=30*24*60*60):
+		     max_zoom=19, refresh_age=30*24*60*60, cache_bytes=None,
+		     tile_store='dir'):
 		
 		if cache_path is None:
 			try:
@@ -186,18 +285,36 @@ class MPTile:
 		if service not in TILE_SERVICES:
 			raise TileException('unknown tile service %s' % service)
 
-		# _download_pending is a dictionary of TileInfo objects
+		# _download_pending is a dictionary of TileInfo objects, with
+		# _download_queue a heap of (priority, seq, key).
+		# _download_queued maps each key to the seq of its live heap
+		# entry. Re-prioritised and cancelled entries are left in the
+		# heap and skipped
 		self._download_pending = {}
-		self._download_thread = None
+		self._download_queue = []
+		self._download_queued = {}
+		self._download_seq = 0
+		self._download_active = {}
+		self._download_lock = threading.Condition()
+		self._download_workers = []
+		self.max_workers = TILE_WORKERS
+		self._closing = False
+		self._view = None
+		# changes each time a download completes
+		self._download_generation = 0
+		self._mosaic = None
+		# download statistics
+		self.downloads = 0
+		self.download_errors = 0
+		self.download_cancelled = 0
                 self._loading = mp_icon('loading.jpg')
 		self._unavailable = mp_icon('unavailable.jpg')
-		try:
-			self._tile_cache = collections.OrderedDict()
-		except AttributeError:
-			# OrderedDicts in python 2.6 come from the ordereddict module
-			# which is a 3rd party package, not in python2.6 distribution
-			import ordereddict
-			self._tile_cache = ordereddict.OrderedDict()
+		# decoded tiles, by default cache_size full tiles worth of memory
+		if cache_bytes is None:
+			cache_bytes = cache_size * TILES_WIDTH * TILES_HEIGHT * 3
+		self._tile_cache = mp_tilecache.TileCache(cache_bytes, self.load_image)
+		# downloaded tiles, as files or in an MBTiles database
+		self.tile_store = mp_tilestore.open_store(tile_store, cache_path)
 
         def set_service(self, service):
                 '''set tile service'''
@@ -229,9 +346,18 @@ class MPTile:
 		return TileInfo((int(x) % world_tiles, int(y) % world_tiles), zoom, self.service, offset=(offsetx, offsety))
 
 	def tile_to_path(self, tile):
-		'''return full path to a tile'''
+		'''return full path to a tile in the directory tile store'''
 		return os.path.join(self.cache_path, self.service, tile.path())
 
+	def load_image(self, tile):
+		'''decode a tile from the tile store, returning (image, fetch_time)'''
+		(data, fetch_time) = self.tile_store.read(tile)
+		img = decode_image(data)
+		if img is None:
+			# a corrupt tile, fetch it again
+			raise IOError(errno.ENOENT, 'bad tile image', str(tile.key()))
+		return (img, fetch_time)
+
 	def coord_to_tilepath(self, lat, lon, zoom):
 		'''return the tile ID that covers a latitude/longitude at
 		a specified zoom level
@@ -243,79 +369,232 @@ class MPTile:
 		'''return number of tiles pending download'''
 		return len(self._download_pending)
 
-	def downloader(self):
-		'''the download thread'''
-		while self.tiles_pending() > 0:
-			time.sleep(self.tile_delay)
+	def tile_priority(self, tile):
+		'''return download priority of a tile, lowest first'''
+		prio = -TILE_AGE_WEIGHT * tile.request_time
+		if self._view is not None:
+			(lat, lon, zoom, keys) = self._view
+			centre = self.coord_to_tile(lat, lon, tile.zoom)
+			x = centre.x + centre.offsetx / float(TILES_WIDTH)
+			y = centre.y + centre.offsety / float(TILES_HEIGHT)
+			prio += math.hypot(tile.x + 0.5 - x, tile.y + 0.5 - y)
+			prio += TILE_ZOOM_WEIGHT * abs(tile.zoom - zoom)
+		return prio
+
+	def _queue_download(self, tile):
+		'''add a tile to the download queue, replacing any entry it
+		already has. Called with the lock held'''
+		self._download_seq += 1
+		self._download_queued[tile.key()] = self._download_seq
+		heapq.heappush(self._download_queue, (self.tile_priority(tile), self._download_seq, tile.key()))
+		if len(self._download_queue) > 2 * len(self._download_queued) + 16:
+			# too many stale entries, drop them
+			self._download_queue = [e for e in self._download_queue if self._download_queued.get(e[2], None) == e[1]]
+			heapq.heapify(self._download_queue)
+
+	def request_download(self, tile):
+		'''ask for a tile to be downloaded, or re-prioritise it if it
+		is already pending'''
+		key = tile.key()
+		with self._download_lock:
+			if key in self._download_pending:
+				tile = self._download_pending[key]
+			else:
+				self._download_pending[key] = tile
+			tile.refresh_time()
+			if key not in self._download_active:
+				self._queue_download(tile)
+				self._download_lock.notify()
+		self.start_download_thread()
 
-			keys = self._download_pending.keys()[:]
+	def set_view(self, lat, lon, zoom, tiles):
+		'''set the view centre and the list of tiles in view. Pending
+		downloads of tiles no longer in view are cancelled, and the
+		rest are ordered by distance from the new centre'''
+		keys = set([t.key() for t in tiles])
+		with self._download_lock:
+			if self._view is not None and self._view[3] == keys:
+				return
+			self._view = (lat, lon, zoom, keys)
+			for key in self._download_pending.keys():
+				if key not in keys and key not in self._download_active:
+					self._download_pending.pop(key)
+					self.download_cancelled += 1
+			self._download_queue = []
+			self._download_queued = {}
+			for tile in self._download_pending.values():
+				if tile.key() not in self._download_active:
+					self._queue_download(tile)
+
+	def _next_download(self):
+		'''return the next tile to download, or None after an idle
+		timeout. Called with the lock held'''
+		deadline = time.time() + TILE_WORKER_IDLE
+		while not self._closing:
+			deferred = []
+			tile = None
+			while self._download_queue:
+				entry = heapq.heappop(self._download_queue)
+				key = entry[2]
+				if self._download_queued.get(key, None) != entry[1]:
+					# a stale entry
+					continue
+				t = self._download_pending.get(key, None)
+				if t is None or key in self._download_active:
+					# cancelled or done
+					self._download_queued.pop(key)
+					continue
+				limit = self._service_limit(t.service)
+				active = len([k for k in self._download_active if k[2] == t.service])
+				if active >= limit:
+					deferred.append(entry)
+					continue
+				self._download_queued.pop(key)
+				tile = t
+				break
+			for entry in deferred:
+				heapq.heappush(self._download_queue, entry)
+			if tile is not None:
+				self._download_active[tile.key()] = tile
+				return tile
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				return None
+			self._download_lock.wait(timeout)
+		return None
 
-			# work out which one to download next, choosing by request_time
-			tile_info = self._download_pending[keys[0]]
-			for key in keys:
-				if self._download_pending[key].request_time > tile_info.request_time:
-					tile_info = self._download_pending[key]
+	def _service_limit(self, service):
+		'''return the number of connections allowed to a tile service'''
+		return TILE_SERVICE_CONNECTIONS.get(service, TILE_DEFAULT_CONNECTIONS)
 
-			url = tile_info.url(self.service)
-			path = self.tile_to_path(tile_info)
-			key = tile_info.key()
+	def _download_done(self, tile, img):
+		'''finish a download. img is None if the tile is unavailable'''
+		key = tile.key()
+		with self._download_lock:
+			if img is None:
+				self._tile_cache.set_unavailable(key)
+			else:
+				# drop any stale or synthesized image
+				self._tile_cache.discard(key)
+			self._download_generation += 1
+			self._download_active.pop(key, None)
+			self._download_pending.pop(key, None)
+			# a slot for this service is free
+			self._download_lock.notify_all()
+			idle = len(self._download_pending) == 0
+		if idle:
+			self.tile_store.flush()
+
+	def fetch_url(self, connections, url):
+		'''fetch a tile URL, reusing a keep-alive connection to the
+		server. Returns (content_type, data)'''
+		u = urlparse.urlsplit(url)
+		conkey = (u.scheme, u.netloc)
+		path = u.path
+		if u.query:
+			path += '?' + u.query
+		headers = { 'User-Agent' : 'MAVProxy' }
+		if url.find('google') != -1:
+			headers['Referer'] = 'https://maps.google.com/'
+		for attempt in range(2):
+			con = connections.get(conkey, None)
+			if con is None:
+				if u.scheme == 'https':
+					con = httplib.HTTPSConnection(u.netloc, timeout=10)
+				else:
+					con = httplib.HTTPConnection(u.netloc, timeout=10)
+				connections[conkey] = con
+			try:
+				con.request('GET', path, headers=headers)
+				resp = con.getresponse()
+				data = resp.read()
+			except (httplib.HTTPException, IOError) as e:
+				# the server may have closed an idle connection, retry once
+				con.close()
+				connections.pop(conkey, None)
+				if attempt == 1:
+					raise urllib2.URLError(e)
+				continue
+			if resp.getheader('connection', '').lower() == 'close':
+				con.close()
+				connections.pop(conkey, None)
+			if resp.status in [301, 302, 303, 307]:
+				# let urllib2 follow redirects
+				req = urllib2.Request(url, headers=headers)
+				resp = urllib2.urlopen(req)
+				return (resp.info().get('content-type', ''), resp.read())
+			if resp.status != 200:
+				raise urllib2.URLError("HTTP status %u" % resp.status)
+			return (resp.getheader('content-type', ''), data)
+
+	def downloader(self):
+		'''a download worker thread'''
+		connections = {}
+		while True:
+			with self._download_lock:
+				tile_info = self._next_download()
+				if tile_info is None:
+					self._download_workers.remove(threading.current_thread())
+					break
+				left = len(self._download_pending)
+
+			url = tile_info.url(tile_info.service)
 
 			try:
 				if self.debug:
-					print("Downloading %s [%u left]" % (url, len(keys)))
-                                req = urllib2.Request(url)
-                                if url.find('google') != -1:
-                                        req.add_header('Referer', 'https://maps.google.com/')
-				resp = urllib2.urlopen(req)
-				headers = resp.info()
-			except urllib2.URLError as e:
+					print("Downloading %s [%u left]" % (url, left))
+				(content_type, img) = self.fetch_url(connections, url)
+			except Exception as e:
 				#print('Error loading %s' % url)
-                                if not key in self._tile_cache:
-                                        self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
+				self.download_errors += 1
+				self._download_done(tile_info, None)
 				if self.debug:
 					print("Failed %s: %s" % (url, str(e)))
 				continue
-			if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                                if not key in self._tile_cache:
-                                        self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
+			if content_type.find('image') == -1:
+				self._download_done(tile_info, None)
 				if self.debug:
 					print("non-image response %s" % url)
 				continue
-			else:
-				img = resp.read()
 
 			# see if its a blank/unavailable tile
 			md5 = hashlib.md5(img).hexdigest()
 			if md5 in BLANK_TILES:
 				if self.debug:
 					print("blank tile %s" % url)
-                                if not key in self._tile_cache:
-                                        self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
+				self._download_done(tile_info, None)
 				continue
 
-			mp_util.mkdir_p(os.path.dirname(path))
-			h = open(path+'.tmp','wb')
-			h.write(img)
-			h.close()
-                        try:
-                                os.unlink(path)
-                        except Exception:
-                                pass
-                        os.rename(path+'.tmp', path)
-			self._download_pending.pop(key)
-		self._download_thread = None
+			self.tile_store.write(tile_info, img)
+			self.downloads += 1
+			self._download_done(tile_info, img)
+			if self.tile_delay > 0:
+				time.sleep(self.tile_delay)
+		for con in connections.values():
+			con.close()
+
+	def close(self):
+		'''stop the download workers and close the tile store'''
+		with self._download_lock:
+			self._closing = True
+			self._download_lock.notify_all()
+			workers = self._download_workers[:]
+		for t in workers:
+			t.join(10)
+		self.tile_store.close()
 
 	def start_download_thread(self):
-		'''start the downloader'''
-		if self._download_thread:
-			return
-		t = threading.Thread(target=self.downloader)
-		t.daemon = True
-		self._download_thread = t
-		t.start()
+		'''start download workers, up to one per pending tile and no
+		more than the services of the pending tiles allow'''
+		with self._download_lock:
+			services = set([t.service for t in self._download_pending.values()])
+			limit = min(self.max_workers, sum([self._service_limit(s) for s in services]))
+			while (len(self._download_workers) < limit and
+			       len(self._download_workers) < len(self._download_pending)):
+				t = threading.Thread(target=self.downloader, name='tile_downloader')
+				t.daemon = True
+				self._download_workers.append(t)
+				t.start()
 
 	def load_tile_lowres(self, tile):
 		'''load a lower resolution tile from cache to fill in a
@@ -340,18 +619,12 @@ class MPTile:
 
 			# see if its in the tile cache
 			key = tile_info.key()
-			if key in self._tile_cache:
-				img = self._tile_cache[key]
-				if img == self._unavailable:
-					continue
-			else:
-				path = self.tile_to_path(tile_info)
+			if self._tile_cache.is_unavailable(key):
+				continue
+			img = self._tile_cache.get(mp_tilecache.NS_TILE, key)
+			if img is None:
 				try:
-					img = cv.LoadImage(path)
-					# add it to the tile cache
-					self._tile_cache[key] = img
-					while len(self._tile_cache) > self.cache_size:
-						self._tile_cache.popitem(0)
+					(img, fetch_time) = self._tile_cache.decode(tile_info)
 				except IOError as e:
 					continue
 
@@ -372,38 +645,37 @@ class MPTile:
 			scaled = cv.CreateImage((TILES_WIDTH, TILES_HEIGHT), 8, 3)
 			cv.Resize(img2, scaled)
 			#cv.Rectangle(scaled, (0,0), (255,255), (0,255,0), 1)
+			self._tile_cache.put(mp_tilecache.NS_LOWRES, tile.key(), scaled)
 			return scaled
 		return None
 
+	def cached_lowres(self, tile):
+		'''return a lowres tile, synthesizing it if not cached'''
+		img = self._tile_cache.get(mp_tilecache.NS_LOWRES, tile.key())
+		if img is None:
+			img = self.load_tile_lowres(tile)
+		return img
+
 	def load_tile(self, tile):
 		'''load a tile from cache or tile server'''
 
 		# see if its in the tile cache
 		key = tile.key()
-		if key in self._tile_cache:
-			img = self._tile_cache[key]
-			if img == self._unavailable:
-				img = self.load_tile_lowres(tile)
-				if img is None:
-					img = self._unavailable
-				return img
-
+		if self._tile_cache.is_unavailable(key):
+			img = self.cached_lowres(tile)
+			if img is None:
+				img = self._unavailable
+			return img
+		img = self._tile_cache.get(mp_tilecache.NS_TILE, key)
+		if img is not None:
+			return img
 
-		path = self.tile_to_path(tile)
 		try:
-			ret = cv.LoadImage(path)
+			(ret, fetch_time) = self._tile_cache.decode(tile)
 
                         # if it is an old tile, then try to refresh
-                        if os.path.getmtime(path) + self.refresh_age < time.time():
-                                try:
-                                        self._download_pending[key].refresh_time()
-                                except Exception:
-                                        self._download_pending[key] = tile
-                                self.start_download_thread()
-			# add it to the tile cache
-			self._tile_cache[key] = ret
-			while len(self._tile_cache) > self.cache_size:
-				self._tile_cache.popitem(0)
+                        if fetch_time + self.refresh_age < time.time():
+                                self.request_download(tile)
 			return ret
 		except IOError as e:
 			# windows gives errno 0 for some versions of python, treat that as ENOENT
@@ -412,18 +684,14 @@ class MPTile:
 				raise
 			pass
 		if not self.download:
-			img = self.load_tile_lowres(tile)
+			img = self.cached_lowres(tile)
 			if img is None:
 				img = self._unavailable
 			return img
 
-		try:
-			self._download_pending[key].refresh_time()
-		except Exception:
-			self._download_pending[key] = tile
-		self.start_download_thread()
+		self.request_download(tile)
 
-		img = self.load_tile_lowres(tile)
+		img = self.cached_lowres(tile)
 		if img is None:
 			img = self._loading
 		return img
@@ -526,21 +794,112 @@ class MPTile:
 			srcy = 0
 		return ret
 
-	def area_to_image(self, lat, lon, width, height, ground_width, zoom=None, ordered=True):
+	def prefetch_around(self, tlist, lat, lon, border=1):
+		'''decode tiles from disk in the background in a border around
+		the view, so they are ready when the map is panned'''
+		zoom = tlist[0].zoom
+		xs = [t.x for t in tlist]
+		ys = [t.y for t in tlist]
+		world_tiles = 1<<zoom
+		keys = set([t.key() for t in tlist])
+		border_tiles = []
+		for y in range(min(ys)-border, max(ys)+border+1):
+			for x in range(min(xs)-border, max(xs)+border+1):
+				if y < 0 or y >= world_tiles:
+					continue
+				tile = TileInfo((x % world_tiles, y), zoom, self.service)
+				if not tile.key() in keys:
+					border_tiles.append(tile)
+		border_tiles.sort(key=lambda t: t.distance(lat, lon))
+		self._tile_cache.prefetch(border_tiles)
+
+	def cache_status(self):
+		'''return a short tile cache status string'''
+		return self._tile_cache.status()
+
+	def tile_is_final(self, tile):
+		'''return True if a tile has been loaded or is known to be unavailable'''
+		key = tile.key()
+		return (self._tile_cache.contains(mp_tilecache.NS_TILE, key) or
+			self._tile_cache.is_unavailable(key))
+
+	def mosaic_image(self, tlist, width, height):
+		'''return a BGR image of the view from the mosaic, drawing only
+		tiles that have scrolled into the mosaic or were drawn with a
+		placeholder before the last download. Returns None if the view
+		can't use a mosaic'''
+		t0 = tlist[0]
+		tile_width = int(TILES_WIDTH / t0.scale)
+		tile_height = int(TILES_HEIGHT / t0.scale)
+		xs = set([t.x for t in tlist])
+		ys = set([t.y for t in tlist])
+		if max(xs) - min(xs) + 1 != len(xs):
+			# the view wraps around the world
+			return None
+		# tlist[0] is the top left tile
+		px = t0.x * tile_width + t0.srcx
+		py = t0.y * tile_height + t0.srcy
+		# the zoom level and scaled tile size fix the tile images
+		key = (self.service, t0.zoom, tile_width, tile_height)
+
+		m = self._mosaic
+		if m is None or m.key != key or not m.covers(px, py, width, height):
+			old = m
+			m = TileMosaic(key, min(xs) - MOSAIC_MARGIN, min(ys) - MOSAIC_MARGIN,
+				       len(xs) + 2*MOSAIC_MARGIN, len(ys) + 2*MOSAIC_MARGIN,
+				       tile_width, tile_height)
+			if old is not None and old.key == key:
+				for xy in m.tiles():
+					if old.drawn.get(xy, False):
+						m.copy_tile(old, xy)
+			self._mosaic = m
+
+		# placeholders are only redrawn when a download has finished
+		retry = m.generation != self._download_generation
+		m.generation = self._download_generation
+		world_tiles = 1<<t0.zoom
+		for xy in m.tiles():
+			drawn = m.drawn.get(xy, None)
+			if drawn or (drawn is not None and not retry):
+				continue
+			if xy[0] < 0 or xy[1] < 0 or xy[0] >= world_tiles or xy[1] >= world_tiles:
+				# off the edge of the world
+				m.drawn[xy] = True
+				continue
+			tile = TileInfoScaled(xy, t0.zoom, t0.scale, (0,0), (0,0), self.service)
+			m.draw_tile(xy, self.scaled_tile(tile))
+			m.drawn[xy] = self.tile_is_final(tile)
+		return m.window(px, py, width, height)
+
+	def area_to_image(self, lat, lon, width, height, ground_width, zoom=None, ordered=True, incremental=False):
 		'''return an RGB image for an area of land, with ground_width
 		in meters, and width/height in pixels.
 
 		lat/lon is the top left corner. The zoom is automatically
-		chosen to avoid having to grow the tiles'''
+		chosen to avoid having to grow the tiles.
 
-		img = cv.CreateImage((width,height),8,3)
+		With incremental set, a mosaic larger than the view is kept
+		between calls, so panning only draws newly exposed tiles'''
 
 		tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-		# order the display by distance from the middle, so the download happens
-		# close to the middle of the image first
+		# downloads are prioritised by distance from the middle of the
+		# view, and tiles that have scrolled out of view are cancelled
+		(midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+		if len(tlist) > 0:
+			self.set_view(midlat, midlon, tlist[0].zoom, tlist)
+			self.prefetch_around(tlist, midlat, midlon)
+
+		if incremental and len(tlist) > 0:
+			img = self.mosaic_image(tlist, width, height)
+			if img is not None:
+				cv.CvtColor(img, img, cv.CV_BGR2RGB)
+				return img
+
+		img = cv.CreateImage((width,height),8,3)
+
+		# order the display by distance from the middle
 		if ordered:
-			(midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
 			tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
 		for t in tlist:
@@ -571,6 +930,10 @@ def mp_icon(filename):
                 raw = pkg_resources.resource_stream(name, "data/%s" % filename).read()
         except Exception:
                 raw = open(os.path.join(__file__, 'data', filename)).read()
+        return decode_image(raw)
+
+def decode_image(raw):
+        '''decode a compressed image to an OpenCV image'''
         imagefiledata = cv.CreateMatHeader(1, len(raw), cv.CV_8UC1)
         cv.SetData(imagefiledata, raw, len(raw))
         img = cv.DecodeImage(imagefiledata, cv.CV_LOAD_IMAGE_COLOR)
@@ -590,6 +953,7 @@ if __name__ == "__main__":
 	parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
 	parser.add_option("--boundary", default=None, help="region boundary")
 	parser.add_option("--debug", action='store_true', default=False, help="show debug info")
+	parser.add_option("--tile-store", default='dir', choices=mp_tilestore.TILE_STORES, help="tile store")
 	(opts, args) = parser.parse_args()
 
 	lat = opts.lat
@@ -606,7 +970,8 @@ if __name__ == "__main__":
 		print lat, lon, ground_width
 
 	mt = MPTile(debug=opts.debug, service=opts.service,
-		    tile_delay=opts.delay, max_zoom=opts.max_zoom)
+		    tile_delay=opts.delay, max_zoom=opts.max_zoom,
+		    tile_store=opts.tile_store)
 	if opts.zoom is None:
 		zooms = range(mt.min_zoom, mt.max_zoom+1)
 	else:
@@ -620,4 +985,5 @@ if __name__ == "__main__":
 		while mt.tiles_pending() > 0:
 			time.sleep(2)
 			print("Waiting on %u tiles" % mt.tiles_pending())
+	mt.close()
 	print('Done')
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+'''
+decoded map tile cache
+
+Holds decoded tile images within a memory budget in bytes, evicting the
+least recently used tiles first. Tiles loaded from the tile cache
+directory and lowres tiles synthesized from lower zoom levels are kept
+in separate namespaces, so a synthesized tile never hides a real one.
+Tiles known to be unavailable are remembered separately, as they use no
+image memory.
+
+A background thread can decode tiles from disk ahead of need, so
+panning doesn't stall the render path on image decoding.
+'''
+
+import collections, threading, time
+
+NS_TILE = 'tile'
+NS_LOWRES = 'lowres'
+
+def image_bytes(img):
+    '''return the memory used by an OpenCV image'''
+    try:
+        return img.width * img.height * img.nChannels * ((img.depth & 0xFF) // 8)
+    except AttributeError:
+        # assume a 256x256 RGB tile
+        return 256 * 256 * 3
+
+class TileCache(object):
+    '''LRU cache of decoded tiles with a byte budget. load(tile) is used
+    to decode a tile from the tile store, returning (image, fetch_time)
+    or raising IOError if it is missing'''
+    def __init__(self, budget, load):
+        self.budget = budget
+        self.load = load
+        self.lock = threading.Lock()
+        # (namespace, key) -> (image, bytes), least recently used first
+        try:
+            self.entries = collections.OrderedDict()
+        except AttributeError:
+            # python 2.6 needs the 3rd party ordereddict module
+            import ordereddict
+            self.entries = ordereddict.OrderedDict()
+        self.unavailable = set()
+        self.bytes = 0
+
+        # tiles to prefetch, newest view replaces the old list
+        self.prefetch_cond = threading.Condition(self.lock)
+        self.prefetch_list = []
+        self.prefetch_thread = None
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.decodes = 0
+        self.decode_time = 0.0
+        self.prefetched = 0
+
+    def get(self, namespace, key):
+        '''return a cached image, or None'''
+        with self.lock:
+            entry = self.entries.pop((namespace, key), None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # reinsert to make it the most recently used
+            self.entries[(namespace, key)] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, namespace, key, img):
+        '''add an image to the cache, evicting old tiles if over budget'''
+        size = image_bytes(img)
+        with self.lock:
+            self._remove((namespace, key))
+            self.entries[(namespace, key)] = (img, size)
+            self.bytes += size
+            if namespace == NS_TILE:
+                self.unavailable.discard(key)
+            while self.bytes > self.budget and len(self.entries) > 1:
+                (k, (old, oldsize)) = self.entries.popitem(last=False)
+                self.bytes -= oldsize
+                self.evictions += 1
+
+    def _remove(self, k):
+        entry = self.entries.pop(k, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def contains(self, namespace, key):
+        '''return True if an image is cached, without counting a lookup'''
+        return (namespace, key) in self.entries
+
+    def discard(self, key):
+        '''forget all cached images of a tile, eg. after it is downloaded'''
+        with self.lock:
+            self._remove((NS_TILE, key))
+            self._remove((NS_LOWRES, key))
+            self.unavailable.discard(key)
+
+    def set_unavailable(self, key):
+        '''mark a tile as unavailable from the tile server'''
+        with self.lock:
+            if not (NS_TILE, key) in self.entries:
+                self.unavailable.add(key)
+
+    def is_unavailable(self, key):
+        return key in self.unavailable
+
+    def decode(self, tile):
+        '''decode a tile from the store and add it to the cache, returning
+        (image, fetch_time). Raises IOError if it isn't in the store'''
+        t0 = time.time()
+        (img, fetch_time) = self.load(tile)
+        dt = time.time() - t0
+        with self.lock:
+            self.decodes += 1
+            self.decode_time += dt
+        self.put(NS_TILE, tile.key(), img)
+        return (img, fetch_time)
+
+    def prefetch(self, tiles):
+        '''decode a list of tiles in the background'''
+        with self.lock:
+            self.prefetch_list = [t for t in tiles
+                                  if not (NS_TILE, t.key()) in self.entries and not t.key() in self.unavailable]
+            # take the nearest tiles first
+            self.prefetch_list.reverse()
+            self.prefetch_cond.notify()
+        if self.prefetch_thread is None:
+            self.prefetch_thread = threading.Thread(target=self.prefetch_worker, name='tile_prefetch')
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
+
+    def prefetch_worker(self):
+        '''background tile decoding thread'''
+        while True:
+            with self.lock:
+                while not self.prefetch_list:
+                    self.prefetch_cond.wait()
+                tile = self.prefetch_list.pop()
+                if (NS_TILE, tile.key()) in self.entries:
+                    continue
+            try:
+                self.decode(tile)
+                self.prefetched += 1
+            except IOError:
+                pass
+
+    def hit_rate(self):
+        '''return percentage of lookups that hit'''
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return (100.0 * self.hits) / total
+
+    def decode_ms(self):
+        '''return average decode time in milliseconds'''
+        if self.decodes == 0:
+            return 0.0
+        return (1000.0 * self.decode_time) / self.decodes
+
+    def status(self):
+        '''return a short status string for the map status bar'''
+        return 'Tiles %.0f/%.0fMB hit %.0f%% decode %.1fms' % (
+            self.bytes / (1024.0*1024.0), self.budget / (1024.0*1024.0),
+            self.hit_rate(), self.decode_ms())
+
+    def __str__(self):
+        return ('tiles=%u bytes=%u/%u hits=%u misses=%u evictions=%u decodes=%u decode=%.1fms prefetched=%u unavailable=%u' %
+                (len(self.entries), self.bytes, self.budget, self.hits, self.misses, self.evictions,
+                 self.decodes, self.decode_ms(), self.prefetched, len(self.unavailable)))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+'''
+on disk map tile stores
+
+DirTileStore is the original layout of one file per tile, at
+CACHE/SERVICE/ZOOM/Y/X.img.
+
+MBTileStore keeps all tiles in a single SQLite file using WAL mode.
+Tiles of every service are held in the map_tiles table, keyed by
+(service, zoom, x, y) along with the time each tile was fetched, so
+refresh checks don't need a stat() call. Writes from the downloader are
+queued and inserted in batches. The file also has the MBTiles metadata
+table and a tiles view of the service named in the metadata, using the
+MBTiles TMS row numbering, so it can be opened by MBTiles readers.
+
+The map and a map seed may write to the same file. A commit waits up to
+MBTILES_BUSY_TIMEOUT for the other to finish, and if the file is still
+locked the batch is kept and committed later. Queued tiles are also
+committed at exit.
+'''
+
+import atexit, errno, os, threading, time
+
+from MAVProxy.modules.lib import mp_util
+
+# tile stores that can be selected
+TILE_STORES = ['dir', 'mbtiles']
+
+MBTILES_FILENAME = 'tilecache.mbtiles'
+
+# queued tile writes are committed in batches of this many tiles, or
+# after this many seconds
+MBTILES_BATCH = 32
+MBTILES_BATCH_TIME = 2.0
+
+# seconds to wait for another process to finish writing to the file
+MBTILES_BUSY_TIMEOUT = 30.0
+
+def missing_tile(tile):
+    return IOError(errno.ENOENT, 'tile not in store', str(tile.key()))
+
+class DirTileStore(object):
+    '''one image file per tile'''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+
+    def path(self, tile):
+        '''return full path to a tile'''
+        return os.path.join(self.cache_path, tile.service, tile.path())
+
+    def read(self, tile):
+        '''return (data, fetch_time) of a tile. Raises IOError if the
+        tile is not in the store'''
+        path = self.path(tile)
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        return (data, os.path.getmtime(path))
+
+    def contains(self, tile):
+        '''return True if a tile is in the store'''
+        return os.path.exists(self.path(tile))
+
+    def write(self, tile, data, fetch_time=None):
+        '''store a downloaded tile'''
+        path = self.path(tile)
+        mp_util.mkdir_p(os.path.dirname(path))
+        h = open(path+'.tmp','wb')
+        h.write(data)
+        h.close()
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(path+'.tmp', path)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class MBTileStore(object):
+    '''all tiles in one SQLite file'''
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        self.lock = threading.Lock()
+        # the downloader, prefetch and render threads all use the store
+        self.db = sqlite3.connect(filename, timeout=MBTILES_BUSY_TIMEOUT, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS map_tiles (
+                           service TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                           tile_data BLOB, fetch_time REAL)''')
+        self.db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS map_tiles_index
+                           ON map_tiles (service, zoom_level, tile_column, tile_row)''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+        self.db.execute('''CREATE VIEW IF NOT EXISTS tiles AS
+                           SELECT zoom_level, tile_column, ((1 << zoom_level) - 1 - tile_row) AS tile_row, tile_data
+                           FROM map_tiles WHERE service = (SELECT value FROM metadata WHERE name = 'name')''')
+        self.db.commit()
+        # tiles waiting to be inserted, keyed by tile key
+        self.pending = {}
+        self.last_flush = time.time()
+        # no commit is tried before this time after the file was locked
+        self.retry_time = 0
+        self.closed = False
+        self.have_name = self.db.execute("SELECT value FROM metadata WHERE name = 'name'").fetchone() is not None
+        # (service, format) metadata written with the first commit
+        self.name = None
+        self.inserts = 0
+        self.commits = 0
+        self.lock_errors = 0
+        atexit.register(self.flush)
+
+    def read(self, tile):
+        '''return (data, fetch_time) of a tile. Raises IOError if the
+        tile is not in the store'''
+        (x, y) = tile.tile
+        with self.lock:
+            p = self.pending.get(tile.key(), None)
+            if p is not None:
+                return (p[4], p[5])
+            row = self.db.execute('''SELECT tile_data, fetch_time FROM map_tiles WHERE
+                                     service = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?''',
+                                  (tile.service, tile.zoom, x, y)).fetchone()
+        if row is None:
+            raise missing_tile(tile)
+        return (str(row[0]), row[1])
+
+    def contains(self, tile):
+        '''return True if a tile is in the store'''
+        (x, y) = tile.tile
+        with self.lock:
+            if tile.key() in self.pending:
+                return True
+            row = self.db.execute('''SELECT 1 FROM map_tiles WHERE
+                                     service = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?''',
+                                  (tile.service, tile.zoom, x, y)).fetchone()
+        return row is not None
+
+    def write(self, tile, data, fetch_time=None):
+        '''queue a downloaded tile for insertion'''
+        (x, y) = tile.tile
+        self.put(tile.service, tile.zoom, x, y, data, fetch_time)
+
+    def put(self, service, zoom, x, y, data, fetch_time=None):
+        '''queue a tile for insertion'''
+        if fetch_time is None:
+            fetch_time = time.time()
+        with self.lock:
+            if not self.have_name and self.name is None:
+                # the tiles view shows the first service stored
+                self.name = (service, image_format(data))
+            # keyed the same as TileInfo.key()
+            self.pending[((x, y), zoom, service)] = (service, zoom, x, y, data, fetch_time)
+            now = time.time()
+            if now >= self.retry_time and (len(self.pending) >= MBTILES_BATCH or
+                                           now - self.last_flush >= MBTILES_BATCH_TIME):
+                self._flush()
+
+    def _flush(self):
+        if self.pending and not self.closed:
+            import sqlite3
+            rows = [(s, z, x, y, sqlite3.Binary(data), t) for (s, z, x, y, data, t) in self.pending.values()]
+            try:
+                if self.name is not None:
+                    self.db.execute("INSERT INTO metadata VALUES ('name', ?)", (self.name[0],))
+                    self.db.execute("INSERT INTO metadata VALUES ('format', ?)", (self.name[1],))
+                self.db.executemany('INSERT OR REPLACE INTO map_tiles VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self.db.commit()
+            except sqlite3.OperationalError:
+                # locked by another process for longer than the busy
+                # timeout, keep the tiles and try again later
+                self.db.rollback()
+                self.lock_errors += 1
+                self.retry_time = time.time() + MBTILES_BATCH_TIME
+                return
+            if self.name is not None:
+                self.have_name = True
+                self.name = None
+            self.inserts += len(rows)
+            self.commits += 1
+            self.pending = {}
+        self.last_flush = time.time()
+
+    def flush(self):
+        '''commit queued tiles'''
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.db.close()
+
+def image_format(data):
+    '''return the MBTiles format name of image data'''
+    if data.startswith('\x89PNG'):
+        return 'png'
+    return 'jpg'
+
+def open_store(store, cache_path):
+    '''open a tile store by name'''
+    if store == 'mbtiles':
+        return MBTileStore(os.path.join(cache_path, MBTILES_FILENAME))
+    if store == 'dir':
+        return DirTileStore(cache_path)
+    raise ValueError('unknown tile store %s' % store)
+
+def import_dir(cache_path, dest, progress=None):
+    '''copy all tiles from a directory cache into an MBTileStore,
+    keeping their fetch times. Returns the number of tiles imported'''
+    count = 0
+    for service in sorted(os.listdir(cache_path)):
+        sdir = os.path.join(cache_path, service)
+        if not os.path.isdir(sdir):
+            continue
+        for (dirpath, dirnames, filenames) in os.walk(sdir):
+            rel = os.path.relpath(dirpath, sdir).split(os.sep)
+            if len(rel) != 2:
+                continue
+            try:
+                (zoom, y) = (int(rel[0]), int(rel[1]))
+            except ValueError:
+                continue
+            for f in filenames:
+                if not f.endswith('.img'):
+                    continue
+                try:
+                    x = int(f[:-4])
+                except ValueError:
+                    continue
+                path = os.path.join(dirpath, f)
+                data = open(path, 'rb').read()
+                dest.put(service, zoom, x, y, data, os.path.getmtime(path))
+                count += 1
+                if progress is not None and count % 1000 == 0:
+                    progress(count)
+    dest.flush()
+    return count
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("mp_tilestore.py [options]")
+    parser.add_option("--cache", default=None, help="tile cache directory")
+    parser.add_option("--output", default=None, help="MBTiles file to create")
+    (opts, args) = parser.parse_args()
+
+    cache_path = opts.cache
+    if cache_path is None:
+        cache_path = os.path.join(os.environ['HOME'], '.tilecache')
+    output = opts.output
+    if output is None:
+        output = os.path.join(cache_path, MBTILES_FILENAME)
+
+    def progress(count):
+        print("Imported %u tiles" % count)
+
+    dest = MBTileStore(output)
+    t0 = time.time()
+    count = import_dir(cache_path, dest, progress)
+    dest.close()
+    print("Imported %u tiles to %s in %.1fs" % (count, output, time.time() - t0))
@@ -13,9 +13,9 @@ import pickle
 import os.path
 import os
 import zipfile
-import array
 import math
 import multiprocessing
+import numpy
 from MAVProxy.modules.lib import mp_util
 import tempfile
 
@@ -244,6 +244,49 @@ class SRTMDownloader():
         except InvalidTileError:
             return 0
 
+    def fileListReady(self):
+        """return True once the file list is available"""
+        global childFileListDownload
+        if childFileListDownload is not None and childFileListDownload.is_alive():
+            return False
+        if not self.filelist:
+            try:
+                data = open(self.filelist_file, 'rb')
+                self.filelist = pickle.load(data)
+                data.close()
+            except Exception:
+                return False
+        return len(self.filelist) > self.min_filelist_len
+
+    def tileFile(self, lat, lon):
+        """return (continent, filename) of the tile covering a lat/lon
+            integer square, or None for ocean"""
+        return self.filelist.get((int(lat), int(lon)), None)
+
+    def fetchTile(self, continent, filename):
+        """download a tile in this process, returning True on success. The
+            file is only renamed into place once complete"""
+        if self.offline == 1:
+            return False
+        path = os.path.join(self.cachedir, filename)
+        conn = httplib.HTTPConnection(self.server, timeout=60)
+        try:
+            conn.request("GET", "%s%s%s" % (self.directory, continent, filename))
+            r1 = conn.getresponse()
+            if r1.status != 200:
+                return False
+            data = r1.read()
+        except Exception:
+            return False
+        finally:
+            conn.close()
+        tmpname = path + ".tmp"
+        f = open(tmpname, 'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmpname, path)
+        return True
+
     def downloadTile(self, continent, filename):
         #Use HTTP
         mp_util.child_close_fds()
@@ -273,6 +316,22 @@ class SRTMDownloader():
             pass
 
 
+# Currently only SRTM1/3 is supported
+SRTM_SIZES = (1201, 3601)
+
+def _rawSize(nbytes):
+    """return the tile size for raw data of nbytes, or None if invalid"""
+    size = int(math.sqrt(nbytes/2)) # 2 bytes per sample
+    if size not in SRTM_SIZES or size * size * 2 != nbytes:
+        return None
+    return size
+
+def _avgArray(value1, value2, weight):
+    """SRTMTile._avg() for arrays, with nan in place of None"""
+    value = value2 * weight + value1 * (1 - weight)
+    value = numpy.where(numpy.isnan(value1), value2, value)
+    return numpy.where(numpy.isnan(value2), value1, value)
+
 class SRTMTile:
     """Base class for all SRTM tiles.
         Each SRTM tile is size x size pixels big and contains
@@ -280,26 +339,49 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The zipped HGT file is extracted once to a raw big endian file
+        next to it, which is memory mapped, so only the pages used are
+        read from disk.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        raw = self.extract(f)
+        self.size = _rawSize(os.path.getsize(raw))
+        try:
+            grid = numpy.memmap(raw, dtype='>i2', mode='r', shape=(self.size, self.size))
+        except Exception:
+            raise InvalidTileError(lat, lon)
+        # plain array views of the map are faster to index
+        self.grid = grid.view(numpy.ndarray)
+        self.data = self.grid.reshape(-1)
+
+    def extract(self, f):
+        """return the raw HGT file of a zipped tile, extracting it if
+            needed"""
+        raw = f
+        if raw.endswith('.zip'):
+            raw = raw[:-4]
+        if os.path.exists(raw) and _rawSize(os.path.getsize(raw)) is not None:
+            return raw
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
-            raise InvalidTileError(lat, lon)            
+            raise InvalidTileError(self.lat, self.lon)
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+        if _rawSize(len(data)) is None:
+            raise InvalidTileError(self.lat, self.lon)
+        # other processes may be extracting the same tile
+        tmpname = "%s.%u.tmp" % (raw, os.getpid())
+        out = open(tmpname, 'wb')
+        out.write(data)
+        out.close()
+        os.rename(tmpname, raw)
+        return raw
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -341,9 +423,9 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print offset
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
-            return -1 # -32768 is a special value for areas with no data
+            return None # -32768 is a special value for areas with no data
         return value
 
 
@@ -374,6 +456,34 @@ class SRTMTile:
         value  = self._avg(value1,  value2, y_frac)
         # print "%4d %4d | %4d\n%4d %4d | %4d\n-------------\n%4d" % (
         #        value00, value10, value1, value01, value11, value2, value)
+        if value is None:
+            return -1 # no data
+        return value
+
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes of arrays of lat/lon points in this tile,
+            interpolated the same way as getAltitudeFromLatLon().
+        """
+        x = (numpy.asarray(lons, dtype=float) - self.lon) * (self.size - 1)
+        y = (numpy.asarray(lats, dtype=float) - self.lat) * (self.size - 1)
+        if len(x) and (x.min() < 0 or y.min() < 0 or x.max() >= self.size-1 or y.max() >= self.size-1):
+            raise WrongTileError(self.lat, self.lon, numpy.min(lats), numpy.min(lons))
+        x_int = x.astype(int)
+        x_frac = x - x_int
+        y_int = y.astype(int)
+        y_frac = y - y_int
+        # rows are stored from north to south
+        row = self.size - 1 - y_int
+        values = []
+        for (r, c) in ((row, x_int), (row, x_int+1), (row-1, x_int), (row-1, x_int+1)):
+            v = self.grid[r, c].astype(float)
+            v[v == -32768] = numpy.nan
+            values.append(v)
+        (value00, value10, value01, value11) = values
+        value1 = _avgArray(value00, value10, x_frac)
+        value2 = _avgArray(value01, value11, x_frac)
+        value = _avgArray(value1, value2, y_frac)
+        value[numpy.isnan(value)] = -1 # no data
         return value
 
 class SRTMOceanTile(SRTMTile):
@@ -385,6 +495,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(len(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
@@ -63,6 +63,7 @@ class OutputModule(mp_module.MPModule):
             print("Failed to connect to %s" % device)
             return
         self.mpstate.mav_outputs.append(conn)
+        self.mpstate.register_output(conn)
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -84,8 +85,10 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             pass
         if sysid in self.mpstate.sysid_outputs:
+            self.mpstate.unregister_output(self.mpstate.sysid_outputs[sysid])
             self.mpstate.sysid_outputs[sysid].close()
         self.mpstate.sysid_outputs[sysid] = conn
+        self.mpstate.register_output(conn)
 
     def cmd_output_remove(self, args):
         '''remove an output'''
@@ -98,6 +101,7 @@ class OutputModule(mp_module.MPModule):
                     mp_util.child_fd_list_add(conn.port.fileno())
                 except Exception:
                     pass
+                self.mpstate.unregister_output(conn)
                 conn.close()
                 self.mpstate.mav_outputs.pop(i)
                 return
@@ -40,10 +40,11 @@ class RallyModule(mp_module.MPModule):
                                          MPMenuItem('Add', 'Add', '# rally add ',
                                                     handler=MPMenuCallTextDialog(title='Rally Altitude (m)',
                                                                                  default=100))])
+        self.add_periodic(self.check_menus, 1.0)
+        self.add_periodic(self.check_abort, 0.2)
 
-
-    def idle_task(self):
-        '''called on idle'''
+    def check_menus(self):
+        '''add our menu once the console or map is loaded'''
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -51,6 +52,7 @@ class RallyModule(mp_module.MPModule):
             self.menu_added_map = True
             self.module('map').add_menu(self.menu)
 
+    def check_abort(self):
         '''handle abort command; it is critical that the AP to receive it'''
         if self.abort_ack_received is False:
             #only send abort every second (be insistent, but don't spam)
@@ -9,6 +9,7 @@ from MAVProxy.modules.lib import mp_module
 class SerialModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(SerialModule, self).__init__(mpstate, "serial", "serial control handling")
+        self.subscribe('SERIAL_CONTROL')
         self.add_command('serial', self.cmd_serial,
                          'remote serial control',
                          ['<lock|unlock|send>',
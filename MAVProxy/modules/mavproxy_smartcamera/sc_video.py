@@ -14,7 +14,9 @@ import time
 import math
 from multiprocessing import Process, Pipe
 import cv2
+import numpy
 import sc_config
+from MAVProxy.modules.lib import mp_framering
 
 class SmartCameraVideo:
 
@@ -41,6 +43,10 @@ class SmartCameraVideo:
         self.parent_conn = None     # parent end of communicatoin pipe
         self.img_counter = 0        # num images requested so far
 
+        # images are passed from the background process in shared memory
+        self.shared_memory = sc_config.config.get_boolean('camera','shared_memory',True)
+        self.frame_ring = None      # shared frame buffers
+
     # __str__ - print position vector as string
     def __str__(self):
         return "SmartCameraVideo Object W:%d H:%d" % (self.img_width, self.img_height)
@@ -118,8 +124,15 @@ class SmartCameraVideo:
                 if recv_obj == -1:
                     break
 
-                # otherwise we return the latest image
-                imgcap_connection.send(latest_image)
+                # otherwise we return the latest image, through shared memory if possible
+                ref = None
+                if latest_image is not None and self.frame_ring is not None:
+                    latest_image = numpy.ascontiguousarray(latest_image)
+                    ref = self.frame_ring.put(latest_image, latest_image.shape, str(latest_image.dtype))
+                if ref is not None:
+                    imgcap_connection.send(ref)
+                else:
+                    imgcap_connection.send(latest_image)
 
         # release camera when exiting
         camera.release()
@@ -129,6 +142,10 @@ class SmartCameraVideo:
         # create pipe
         self.parent_conn, imgcap_conn = Pipe()
 
+        # create shared frame buffers, images are requested one at a time so two are enough
+        if self.shared_memory:
+            self.frame_ring = mp_framering.FrameRing(2, self.img_width * self.img_height * 3)
+
         # create and start the sub process and pass it it's end of the pipe
         self.proc = Process(target=self.image_capture_background, args=(imgcap_conn,))
         self.proc.start()
@@ -155,6 +172,10 @@ class SmartCameraVideo:
         # wait endlessly until image is returned
         recv_img = self.parent_conn.recv()
 
+        # copy image out of shared memory
+        if isinstance(recv_img, mp_framering.FrameRef):
+            recv_img = self.frame_ring.get_array(recv_img)
+
         # return image to caller
         return recv_img
 
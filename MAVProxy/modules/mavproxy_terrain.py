@@ -8,15 +8,26 @@ from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_terrain
+
+# bytes of a TERRAIN_DATA message on the link
+TERRAIN_DATA_BYTES = 51
 
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=False)
+        self.subscribe('TERRAIN_REQUEST', 'TERRAIN_REPORT')
 
-        self.ElevationModel = mp_elevation.ElevationModel()
         self.current_request = None
+        self.current_grid = None
+        # blocks that may be sent now, topped up at the send rate
+        self.send_tokens = 0.0
+        # grids to compute ahead of time along the mission
+        self.precompute_list = []
+        self.mission_change = None
+        self.grid_spacing = None
         self.sent_mask = 0
-        self.last_send_time = time.time()
+        self.token_time = time.time()
         self.requests_received = 0
         self.blocks_sent = 0
         self.check_lat = 0
@@ -25,9 +36,18 @@ class TerrainModule(mp_module.MPModule):
                          ["<status|check>",
                           'set (TERRAINSETTING)'])
         self.terrain_settings = mp_settings.MPSettings(
-            [ ('debug', int, 0) ]
+            [ ('debug', int, 0),
+              ('srtm_cache_mb', int, mp_elevation.ELEVATION_CACHE_BYTES//(1024*1024)),
+              ('max_rate', float, 20.0),
+              ('link_fraction', float, 0.2),
+              ('precompute', int, 1),
+              ('spacing', int, 100) ]
             )
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
+        self.ElevationModel = mp_elevation.ElevationModel(cache_bytes=self.terrain_settings.srtm_cache_mb*1024*1024)
+        self.grids = mp_terrain.TerrainGridCache(self.ElevationModel)
+        self.add_periodic(self.send_terrain_data, 0.05)
+        self.add_periodic(self.precompute_grids, 0.5)
 
     def cmd_terrain(self, args):
         '''terrain command parser'''
@@ -36,11 +56,15 @@ class TerrainModule(mp_module.MPModule):
             print(usage)
             return
         if args[0] == "status":
-            print("blocks_sent: %u requests_received: %u" % (
+            print("blocks_sent: %u requests_received: %u rate: %.1f/s" % (
                 self.blocks_sent,
-                self.requests_received))
+                self.requests_received,
+                self.send_rate()))
+            print("%s precompute=%u" % (self.grids, len(self.precompute_list)))
+            print(self.ElevationModel.status())
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
+            self.ElevationModel.tiles.set_cache_bytes(self.terrain_settings.srtm_cache_mb*1024*1024)
         elif args[0] == "check":
             self.cmd_terrain_check(args[1:])
         else:
@@ -70,6 +94,8 @@ class TerrainModule(mp_module.MPModule):
         # add some status fields
         if type == 'TERRAIN_REQUEST':
             self.current_request = msg
+            self.current_grid = self.grids.get(msg.lat, msg.lon, msg.grid_spacing)
+            self.grid_spacing = msg.grid_spacing
             self.sent_mask = 0
             self.requests_received += 1
         elif type == 'TERRAIN_REPORT':
@@ -81,64 +107,97 @@ class TerrainModule(mp_module.MPModule):
                 self.check_lon = 0
             
     def send_terrain_data_bit(self, bit):
-        '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
+        '''send some terrain data, returning False if it isn't available'''
+        grid = self.current_grid
+        if not grid.valid[bit]:
+            # wait for the SRTM tile, then compute the grid again
+            self.current_grid = self.grids.get(self.current_request.lat,
+                                               self.current_request.lon,
+                                               self.current_request.grid_spacing)
+            grid = self.current_grid
+            if not grid.valid[bit]:
                 if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
+                    print("no alt for block %u" % bit)
+                return False
+        data = grid.data[bit]
         self.master.mav.terrain_data_send(self.current_request.lat,
                                           self.current_request.lon,
                                           self.current_request.grid_spacing,
                                           bit,
                                           data)
         self.blocks_sent += 1
-        self.last_send_time = time.time()
         self.sent_mask |= 1<<bit
         if self.terrain_settings.debug and bit == 55:
+            # the heights sent for the SW and NE corners of the grid
             lat = self.current_request.lat * 1.0e-7
             lon = self.current_request.lon * 1.0e-7
-            print("--lat=%f --lon=%f %.1f" % (
-                lat, lon, self.ElevationModel.GetElevation(lat, lon)))
+            if grid.valid[0]:
+                print("--lat=%f --lon=%f %d" % (lat, lon, grid.data[0][0]))
             (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=32*self.current_request.grid_spacing,
-                                             north=28*self.current_request.grid_spacing)
-            print("--lat=%f --lon=%f %.1f" % (
-                lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
-                                             
+                                             east=31*self.current_request.grid_spacing,
+                                             north=27*self.current_request.grid_spacing)
+            print("--lat=%f --lon=%f %d" % (lat2, lon2, data[15]))
+        return True
+
+    def send_rate(self):
+        '''return blocks per second to send. On a serial link this is
+        limited to link_fraction of the link bandwidth'''
+        rate = self.terrain_settings.max_rate
+        baud = getattr(self.master, 'baud', None)
+        if baud:
+            rate = min(rate, self.terrain_settings.link_fraction * baud / (10.0 * TERRAIN_DATA_BYTES))
+        return max(rate, 0.1)
 
     def send_terrain_data(self):
         '''send some terrain data'''
+        now = time.time()
+        rate = self.send_rate()
+        # allow a burst of up to a quarter second of blocks
+        self.send_tokens = min(self.send_tokens + rate * (now - self.token_time), max(1.0, rate * 0.25))
+        self.token_time = now
+        if self.current_request is None:
+            return
         for bit in range(56):
-            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
-                self.send_terrain_data_bit(bit)
+            if self.send_tokens < 1:
                 return
+            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
+                if not self.send_terrain_data_bit(bit):
+                    return
+                self.send_tokens -= 1
+        if self.sent_mask & self.current_request.mask != self.current_request.mask:
+            return
         # no bits to send
         self.current_request = None
+        self.current_grid = None
         self.sent_mask = 0
 
-    def idle_task(self):
-        '''called when idle'''
-        if self.current_request is None:
+    def precompute_grids(self):
+        '''compute terrain grids along the mission ahead of requests'''
+        if not self.terrain_settings.precompute:
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
+        try:
+            wploader = self.module('wp').wploader
+        except Exception:
             return
-        self.send_terrain_data()
+        spacing = self.grid_spacing
+        if spacing is None:
+            spacing = self.terrain_settings.spacing
+        if wploader.last_change != self.mission_change:
+            self.mission_change = wploader.last_change
+            points = [(wp.x, wp.y) for wp in [wploader.wp(i) for i in range(wploader.count())]
+                      if wp.x != 0 or wp.y != 0]
+            self.precompute_list = [g for g in mp_terrain.path_grids(points, spacing)
+                                    if not self.grids.contains(g[0], g[1], spacing)]
+        # a few grids at a time, so the main loop isn't held up
+        for i in range(4):
+            if not self.precompute_list:
+                return
+            (lat_e7, lon_e7) = self.precompute_list.pop(0)
+            grid = self.grids.get(lat_e7, lon_e7, spacing)
+            if not grid.complete:
+                # try again once the SRTM tile is loaded
+                self.precompute_list.append((lat_e7, lon_e7))
+                return
 
 def init(mpstate):
     '''initialise module'''
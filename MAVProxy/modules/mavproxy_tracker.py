@@ -27,6 +27,7 @@ class TrackerModule(mp_module.MPModule):
     def __init__(self, mpstate):
         from pymavlink import mavparm
         super(TrackerModule, self).__init__(mpstate, "tracker", "antenna tracker control module")
+        self.subscribe('GLOBAL_POSITION_INT', 'SCALED_PRESSURE')
         self.connection = None
         self.tracker_param = mavparm.MAVParmDict()
         self.pstate = ParamState(self.tracker_param, self.logdir, self.vehicle_name, 'tracker.parm')
@@ -17,7 +17,6 @@ class WPModule(mp_module.MPModule):
         self.loading_waypoints = False
         self.loading_waypoint_lasttime = time.time()
         self.last_waypoint = 0
-        self.wp_period = mavutil.periodic_event(0.5)
         self.undo_wp = None
         self.undo_type = None
         self.undo_wp_idx = -1
@@ -50,6 +49,8 @@ class WPModule(mp_module.MPModule):
                                                                                  default=100)),
                                          MPMenuItem('Undo', 'Undo', '# wp undo'),
                                          MPMenuItem('Loop', 'Loop', '# wp loop')])
+        self.add_periodic(self.check_missing, 2.0)
+        self.add_periodic(self.check_menus, 1.0)
 
 
     def mavlink_packet(self, m):
@@ -102,14 +103,16 @@ class WPModule(mp_module.MPModule):
                     self.say("waypoint %u" % m.seq,priority='message')
 
 
-    def idle_task(self):
+    def check_missing(self):
         '''handle missing waypoints'''
-        if self.wp_period.trigger():
-            # cope with packet loss fetching mission
-            if self.master is not None and self.master.time_since('MISSION_ITEM') >= 2 and self.wploader.count() < getattr(self.wploader,'expected_count',0):
-                seq = self.wploader.count()
-                print("re-requesting WP %u" % seq)
-                self.master.waypoint_request_send(seq)
+        # cope with packet loss fetching mission
+        if self.master is not None and self.master.time_since('MISSION_ITEM') >= 2 and self.wploader.count() < getattr(self.wploader,'expected_count',0):
+            seq = self.wploader.count()
+            print("re-requesting WP %u" % seq)
+            self.master.waypoint_request_send(seq)
+
+    def check_menus(self):
+        '''add our menu once the console or map is loaded'''
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -293,8 +296,8 @@ class WPModule(mp_module.MPModule):
 
         (lat, lon) = latlon
         if getattr(self.console, 'ElevationMap', None) is not None and wp.frame != mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT:
-            alt1 = self.console.ElevationMap.GetElevation(lat, lon)
-            alt2 = self.console.ElevationMap.GetElevation(wp.x, wp.y)
+            alt1 = self.console.ElevationMap.GetElevation(lat, lon, timeout=1)
+            alt2 = self.console.ElevationMap.GetElevation(wp.x, wp.y, timeout=1)
             if alt1 is not None and alt2 is not None:
                 wp.z += alt1 - alt2
         wp.x = lat
@@ -367,8 +370,8 @@ class WPModule(mp_module.MPModule):
                 (newlat, newlon) = mp_util.gps_newpos(lat, lon, b2+rotation, d2)
                 
             if getattr(self.console, 'ElevationMap', None) is not None and wp.frame != mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT:
-                alt1 = self.console.ElevationMap.GetElevation(newlat, newlon)
-                alt2 = self.console.ElevationMap.GetElevation(wp.x, wp.y)
+                alt1 = self.console.ElevationMap.GetElevation(newlat, newlon, timeout=1)
+                alt2 = self.console.ElevationMap.GetElevation(wp.x, wp.y, timeout=1)
                 if alt1 is not None and alt2 is not None:
                     wp.z += alt1 - alt2
             wp.x = newlat
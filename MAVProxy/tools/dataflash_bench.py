@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+'''
+benchmark the dataflash_logger remote log receiver
+
+A synthetic stream of REMOTE_LOG_DATA_BLOCK messages is generated at
+each of the given block rates, with random loss. NACKed blocks are
+sent again by the simulated vehicle after a round trip, as ArduPilot
+does. The stream is fed to the receiver with ACKs and NACKs sent
+from the idle loop, and the log written is checked against the
+blocks sent.
+'''
+
+import os, random, tempfile, time
+
+from MAVProxy.modules.lib import mp_remotelog
+
+from optparse import OptionParser
+parser = OptionParser("dataflash_bench.py [options]")
+parser.add_option("--rates", default="100,500,1000,2000", help="comma separated block rates in blocks/s")
+parser.add_option("--seconds", type='int', default=10, help="seconds of logging to generate per rate")
+parser.add_option("--loss", type='float', default=0.02, help="fraction of blocks lost")
+parser.add_option("--rtt", type='float', default=0.1, help="round trip time in seconds")
+parser.add_option("--idle-rate", type='int', default=100, help="idle loop rate in Hz")
+parser.add_option("--block-size", type='int', default=200, help="block size in bytes")
+(opts, args) = parser.parse_args()
+
+class RemoteLogDataBlock(object):
+    '''a REMOTE_LOG_DATA_BLOCK message'''
+    def __init__(self, block_cnt, block_size, data):
+        self.block_cnt = block_cnt
+        self.block_size = block_size
+        self.data = data
+
+def generate(nblocks, size):
+    '''return the payloads of a log, as lists of byte values'''
+    return [[random.randint(0, 255) for i in range(size)] for b in range(nblocks)]
+
+def bench(rate, seconds, loss):
+    '''return (blocks received, seconds of CPU, statuses sent, receiver, correct)'''
+    blocks = generate(rate * seconds, opts.block_size)
+    (fd, filename) = tempfile.mkstemp(suffix='.BIN')
+    os.close(fd)
+    nacked = []
+    statuses = [0]
+    def send_status(block, status):
+        statuses[0] += 1
+        if status == mp_remotelog.BLOCK_NACK:
+            nacked.append((now + opts.rtt, block))
+    receiver = mp_remotelog.RemoteLogReceiver(filename, send_status)
+    received = 0
+    dt = 0.0
+    idle_every = max(1, rate // opts.idle_rate)
+    # run on past the end of the log for the last retransmissions
+    for i in range(rate * (seconds + 1)):
+        now = i / float(rate)
+        msgs = []
+        if i < len(blocks):
+            msgs.append(RemoteLogDataBlock(i, opts.block_size, blocks[i]))
+        while nacked and nacked[0][0] <= now:
+            block = nacked.pop(0)[1]
+            msgs.append(RemoteLogDataBlock(block, opts.block_size, blocks[block]))
+        t0 = time.time()
+        for m in msgs:
+            if random.random() < loss:
+                continue
+            receiver.handle_block(m.block_cnt, m.block_size, m.data, now)
+            received += 1
+        if i % idle_every == 0:
+            receiver.send_acks_and_nacks(now)
+        dt += time.time() - t0
+    receiver.close()
+    data = open(filename, 'rb').read()
+    os.unlink(filename)
+    correct = True
+    for b in range(len(blocks)):
+        got = bytearray(data[b*opts.block_size:(b+1)*opts.block_size])
+        if got != bytearray(blocks[b]) and any(got):
+            correct = False
+    return (received, dt, statuses[0], receiver, correct)
+
+print("%6s %8s %12s %8s %8s %8s %8s %8s" % ("Rate", "Blocks", "Blocks/s", "CPU", "Status", "Fixed", "Abandon", "Correct"))
+for rate in [int(r) for r in opts.rates.split(',')]:
+    (received, dt, statuses, receiver, correct) = bench(rate, opts.seconds, opts.loss)
+    # CPU is the fraction of one core needed to keep up with the stream
+    print("%6u %8u %12.0f %7.1f%% %8u %8u %8u %8s" % (rate, received, received/dt,
+                                                     100.0*dt/opts.seconds, statuses,
+                                                     receiver.missing_found, receiver.abandoned, correct))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+'''
+benchmark MAVLink receive throughput with full and lazy decoding
+
+A synthetic telemetry stream is generated with ATTITUDE and RAW_IMU at
+each of the given stream rates, plus the usual lower rate messages.
+It is then parsed with pymavlink's parse_buffer (full decode) and with
+the MAVProxy framer and LazyMessage (lazydecode). Each message is
+passed to mavutil's post_message(), as the link module's
+master_callback() does, then to a consumer that reads a few fields of
+ATTITUDE and GLOBAL_POSITION_INT only.
+'''
+
+import sys, time
+
+from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_framer
+
+from optparse import OptionParser
+parser = OptionParser("mavdecode_bench.py [options]")
+parser.add_option("--rates", default="10,50,100,200", help="comma separated ATTITUDE/RAW_IMU rates in Hz")
+parser.add_option("--seconds", type='int', default=10, help="seconds of telemetry to generate per rate")
+parser.add_option("--chunk", type='int', default=16*1024, help="read size")
+(opts, args) = parser.parse_args()
+
+mavlink = mavutil.mavlink
+
+def generate(rate, seconds):
+    '''return a buffer of synthetic telemetry'''
+    mav = mavlink.MAVLink(None, srcSystem=1, srcComponent=1)
+    buf = []
+    for tick in range(rate * seconds):
+        t_ms = int(tick * 1000 / rate)
+        buf.append(mav.attitude_encode(t_ms, 0.1, 0.2, 0.3, 0.01, 0.02, 0.03).pack(mav))
+        buf.append(mav.raw_imu_encode(t_ms*1000, 1, 2, 3, 4, 5, 6, 7, 8, 9).pack(mav))
+        if tick % max(1, rate//5) == 0:
+            buf.append(mav.global_position_int_encode(t_ms, -353632610, 1491652300, 584000, 100000, 1, 2, 3, 9000).pack(mav))
+            buf.append(mav.vfr_hud_encode(20, 21, 90, 50, 100, 1).pack(mav))
+            buf.append(mav.gps_raw_int_encode(t_ms*1000, 3, -353632610, 1491652300, 584000, 100, 100, 2000, 9000, 10).pack(mav))
+        if tick % rate == 0:
+            buf.append(mav.heartbeat_encode(1, 3, 217, 10, 4).pack(mav))
+            buf.append(mav.sys_status_encode(0, 0, 0, 500, 12000, 1000, 80, 0, 0, 0, 0, 0, 0).pack(mav))
+    return ''.join(buf)
+
+def consume(m):
+    '''a typical consumer, only interested in a couple of message types'''
+    mtype = m.get_type()
+    if mtype == 'ATTITUDE':
+        return m.roll + m.pitch + m.yaw
+    if mtype == 'GLOBAL_POSITION_INT':
+        return m.lat + m.lon
+    return 0
+
+def bench_full(data, chunk):
+    master = mavutil.mavfile(None, 'bench')
+    mav = master.mav
+    count = 0
+    t0 = time.time()
+    for i in range(0, len(data), chunk):
+        msgs = mav.parse_buffer(data[i:i+chunk])
+        if msgs:
+            for m in msgs:
+                master.post_message(m)
+                consume(m)
+            count += len(msgs)
+    return (count, time.time() - t0, master.uptime)
+
+def bench_lazy(data, chunk):
+    master = mavutil.mavfile(None, 'bench')
+    mav = master.mav
+    framer = mp_framer.MAVFramer(mp_framer.crc_extra_map(mavlink))
+    msginfo = mp_framer.message_info_map(mavlink)
+    count = 0
+    decoded = 0
+    t0 = time.time()
+    for i in range(0, len(data), chunk):
+        for f in framer.feed(data[i:i+chunk]):
+            m = mp_framer.LazyMessage(f, msginfo[f.msgid], mav)
+            master.post_message(m)
+            consume(m)
+            if m.is_decoded():
+                decoded += 1
+            count += 1
+    return (count, time.time() - t0, decoded, master.uptime)
+
+print("%6s %8s %12s %12s %12s %8s %8s %8s" % ("Rate", "Msgs", "Full(msg/s)", "Lazy(msg/s)", "Speedup", "Full CPU", "Lazy CPU", "Decoded"))
+for rate in [int(r) for r in opts.rates.split(',')]:
+    data = generate(rate, opts.seconds)
+    (count1, dt1, uptime1) = bench_full(data, opts.chunk)
+    (count2, dt2, decoded, uptime2) = bench_lazy(data, opts.chunk)
+    if count1 != count2:
+        print("WARNING: message count mismatch %u %u" % (count1, count2))
+    if uptime1 != uptime2:
+        print("WARNING: uptime mismatch %f %f" % (uptime1, uptime2))
+    # CPU is the fraction of one core needed to keep up with the stream
+    print("%6u %8u %12.0f %12.0f %11.1fx %7.1f%% %7.1f%% %7.1f%%" % (rate, count1,
+                                                                     count1/dt1, count2/dt2, dt1/dt2,
+                                                                     100.0*dt1/opts.seconds, 100.0*dt2/opts.seconds,
+                                                                     100.0*decoded/count2))
@@ -9,6 +9,7 @@ import sys, time, os
 from pymavlink import mavutil, mavwp, mavextra
 from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_tlogindex
 import functools
 
 try:
@@ -291,7 +292,19 @@ def mavflightview_mav(mlog, options=None, title=None):
 
 def mavflightview(filename, options):
     print("Loading %s ..." % filename)
-    mlog = mavutil.mavlink_connection(filename)
+    index = None
+    if filename.endswith('.tlog') and options.condition is None:
+        # conditions may use any message, so need a full scan
+        index = mp_tlogindex.load_index(filename)
+        if index is None and options.index:
+            # no index, or one that does not cover the whole log
+            print("Indexing %s ..." % filename)
+            mp_tlogindex.build_index(filename)
+            index = mp_tlogindex.load_index(filename)
+    if index is not None:
+        mlog = mp_tlogindex.IndexedTLog(filename, index)
+    else:
+        mlog = mavutil.mavlink_connection(filename)
     mavflightview_mav(mlog, options, title=filename)
 
 class mavflightview_options(object):
@@ -313,6 +326,7 @@ class mavflightview_options(object):
         self.types = None
         self.ekf_sample = 1
         self.rate = 0
+        self.index = False
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -334,6 +348,7 @@ if __name__ == "__main__":
     parser.add_option("--types", default=None, help="types of position messages to show")
     parser.add_option("--ekf-sample", type='int', default=1, help="sub-sampling of EKF messages")
     parser.add_option("--rate", type='int', default=0, help="maximum message rate to display (0 means all points)")
+    parser.add_option("--index", action='store_true', default=False, help="build a tlog index if there isn't one")
     
     (opts, args) = parser.parse_args()
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+'''
+seed the map tile and SRTM caches for an area, for offline use
+
+The area is a bounding box, a polygon file, a mission (as a corridor
+along the path) or a fence, with a buffer distance around it. Tiles
+and SRTM files already downloaded are skipped, so an interrupted seed
+can be resumed by running the same command again.
+'''
+
+import sys, time, threading
+
+from MAVProxy.modules.mavproxy_map import mp_seed, mp_tile, mp_tilestore, srtm
+from MAVProxy.modules.lib import mp_util
+
+from optparse import OptionParser
+parser = OptionParser("mavseed.py [options]")
+parser.add_option("--bbox", default=None, help="bounding box LAT1,LON1,LAT2,LON2")
+parser.add_option("--polygon", default=None, help="polygon file")
+parser.add_option("--mission", default=None, help="mission file, seeded as a corridor along the path")
+parser.add_option("--fence", default=None, help="fence file")
+parser.add_option("--buffer", type='float', default=500.0, help="buffer distance in meters")
+parser.add_option("--min-zoom", type='int', default=10, help="minimum tile zoom")
+parser.add_option("--max-zoom", type='int', default=17, help="maximum tile zoom")
+parser.add_option("--service", default="MicrosoftSat", help="tile service")
+parser.add_option("--url", default=None, help="tile URL template, eg. http://localhost:8000/${ZOOM}/${X}/${Y}.png, used instead of --service")
+parser.add_option("--tile-store", default='dir', choices=mp_tilestore.TILE_STORES, help="tile store")
+parser.add_option("--cache", default=None, help="tile cache directory")
+parser.add_option("--delay", type='float', default=0.0, help="tile download delay per worker")
+parser.add_option("--workers", type='int', default=mp_tile.TILE_WORKERS, help="tile download workers")
+parser.add_option("--no-srtm", action='store_true', default=False, help="don't fetch SRTM data")
+parser.add_option("--no-tiles", action='store_true', default=False, help="don't fetch map tiles")
+parser.add_option("--estimate", action='store_true', default=False, help="only estimate the download size")
+parser.add_option("--debug", action='store_true', default=False, help="show debug info")
+(opts, args) = parser.parse_args()
+
+if opts.url:
+    mp_tile.set_custom_service(opts.url)
+    opts.service = mp_tile.CUSTOM_SERVICE
+
+if opts.bbox:
+    (lat1, lon1, lat2, lon2) = mp_seed.parse_bbox(opts.bbox)
+    area = mp_seed.bbox_area(lat1, lon1, lat2, lon2, buffer=opts.buffer)
+elif opts.polygon:
+    area = mp_seed.SeedArea(mp_util.polygon_load(opts.polygon), buffer=opts.buffer)
+elif opts.mission:
+    from pymavlink import mavwp
+    wp = mavwp.MAVWPLoader()
+    wp.load(opts.mission)
+    area = mp_seed.SeedArea(wp.polygon(), buffer=opts.buffer, closed=False)
+elif opts.fence:
+    from pymavlink import mavwp
+    fence = mavwp.MAVFenceLoader()
+    fence.load(opts.fence)
+    area = mp_seed.SeedArea(fence.polygon(), buffer=opts.buffer)
+else:
+    print("You must give one of --bbox, --polygon, --mission or --fence")
+    sys.exit(1)
+
+def progress(seeder):
+    print("%s (%.0fs)" % (seeder, time.time() - t0))
+
+t0 = time.time()
+seeders = []
+
+if not opts.no_tiles:
+    mt = mp_tile.MPTile(cache_path=opts.cache, service=opts.service, tile_delay=opts.delay,
+                        debug=opts.debug, max_zoom=opts.max_zoom, tile_store=opts.tile_store)
+    mt.max_workers = opts.workers
+    tiles = mp_seed.TileSeeder(mt, area, opts.min_zoom, opts.max_zoom)
+    (total, missing, nbytes) = tiles.estimate()
+    print("%u tiles for zoom %u to %u, %u to fetch (about %s)" % (
+        total, opts.min_zoom, opts.max_zoom, missing, mp_seed.format_bytes(nbytes)))
+    seeders.append(tiles)
+
+if not opts.no_srtm:
+    downloader = srtm.SRTMDownloader(debug=opts.debug)
+    elevation = mp_seed.SRTMSeeder(downloader, area)
+    if elevation.wait_filelist():
+        (total, missing, nbytes) = elevation.estimate()
+        print("%u SRTM files, %u to fetch (about %s)" % (total, missing, mp_seed.format_bytes(nbytes)))
+        seeders.append(elevation)
+    else:
+        print("SRTM file list unavailable")
+
+if opts.estimate:
+    sys.exit(0)
+
+# elevation data is fetched alongside the tiles
+threads = []
+for s in seeders:
+    t = threading.Thread(target=s.run, kwargs={'progress' : progress})
+    t.daemon = True
+    t.start()
+    threads.append(t)
+try:
+    while [t for t in threads if t.is_alive()]:
+        time.sleep(0.5)
+    for s in seeders:
+        print(s)
+except KeyboardInterrupt:
+    for s in seeders:
+        s.cancelled = True
+    print("Interrupted, run again to resume")
+if not opts.no_tiles:
+    mt.close()
+print("Done in %.1fs" % (time.time() - t0))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+'''
+test map seeding against a local tile server
+
+A threaded BaseHTTPServer on localhost serves a distinct PNG for each
+tile through the Custom tile service. An area is seeded into each
+tile store, and every tile covering it is checked to be in the store
+with the data served for it.
+'''
+
+import BaseHTTPServer, SocketServer, shutil, tempfile, threading, unittest
+
+from MAVProxy.modules.mavproxy_map import mp_seed, mp_tile
+
+PNG_HEADER = '\x89PNG\r\n\x1a\n'
+
+def tile_data(zoom, x, y):
+    '''the image served for a tile'''
+    return PNG_HEADER + 'tile %u/%u/%u' % (zoom, x, y)
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        try:
+            (zoom, x, y) = [int(v) for v in self.path.strip('/').split('.')[0].split('/')]
+        except ValueError:
+            self.send_error(404)
+            return
+        data = tile_data(zoom, x, y)
+        self.server.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''a server for the keep-alive connections of several download workers'''
+    daemon_threads = True
+
+class SeedTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TileServer(('127.0.0.1', 0), TileHandler)
+        self.server.requests = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        mp_tile.set_custom_service('http://127.0.0.1:%u/${ZOOM}/${X}/${Y}.png' % self.server.server_port)
+        self.cache_path = tempfile.mkdtemp()
+        self.area = mp_seed.bbox_area(-35.37, 149.16, -35.35, 149.18, buffer=100)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_path)
+
+    def seed(self, tile_store):
+        mt = mp_tile.MPTile(cache_path=self.cache_path, service=mp_tile.CUSTOM_SERVICE,
+                            tile_delay=0, tile_store=tile_store)
+        seeder = mp_seed.TileSeeder(mt, self.area, 10, 14)
+        (total, missing, nbytes) = seeder.estimate()
+        seeder.run()
+        return (mt, seeder, total, missing)
+
+    def check_store(self, tile_store):
+        (mt, seeder, total, missing) = self.seed(tile_store)
+        self.assertTrue(total > 0)
+        self.assertEqual(missing, total)
+        self.assertEqual(seeder.done, total)
+        self.assertEqual(seeder.errors, 0)
+        self.assertEqual(self.server.requests, total)
+        for zoom in seeder.zooms:
+            for tile in seeder.tiles(zoom):
+                (data, fetch_time) = mt.tile_store.read(tile)
+                self.assertEqual(data, tile_data(tile.zoom, tile.x, tile.y))
+        mt.close()
+
+        # a second seed finds nothing to fetch
+        (mt, seeder, total2, missing) = self.seed(tile_store)
+        self.assertEqual(total2, total)
+        self.assertEqual(missing, 0)
+        self.assertEqual(self.server.requests, total)
+        mt.close()
+
+    def test_dir(self):
+        self.check_store('dir')
+
+    def test_mbtiles(self):
+        self.check_store('mbtiles')
+
+    def test_cancel_estimate(self):
+        mt = mp_tile.MPTile(cache_path=self.cache_path, service=mp_tile.CUSTOM_SERVICE, tile_delay=0)
+        seeder = mp_seed.TileSeeder(mt, self.area, 10, 14)
+        seeder.cancelled = True
+        self.assertEqual(seeder.estimate(), (0, 0, 0))
+        mt.close()
+
+if __name__ == '__main__':
+    unittest.main()